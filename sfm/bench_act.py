@@ -0,0 +1,36 @@
+import importlib
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+
+from vec_env import make_vector_env
+from inference import benchmark_act
+
+## Micro-benchmark of the rollout policy call, get_action_and_value against act()
+
+@dataclass
+class BenchArgs:
+    agents: tuple = ("sfmppo", "sofppo") # trainer modules whose Agent is timed
+    num_envs: int = 1 # batch size of one rollout step
+    num_steps: int = 2000
+    compile: bool = True
+    cuda: bool = False # rollouts at num_envs=1 usually run faster on CPU
+    seed: int = 1
+
+bench_args = BenchArgs()
+
+if __name__ == "__main__":
+    torch.manual_seed(bench_args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() and bench_args.cuda else "cpu")
+    for module_name in bench_args.agents:
+        module = importlib.import_module(module_name)
+        args = module.args
+        envs = make_vector_env([module.make_env(args.env_id, 0, False, "bench", args.gamma, normalize=False)])
+        agent = module.Agent(envs).to(device)
+        obs, _ = envs.reset(seed=bench_args.seed)
+        obs = torch.as_tensor(np.repeat(obs, bench_args.num_envs, axis=0), dtype=torch.float32, device=device)
+        envs.close()
+
+        print(f"{module_name}.Agent, batch {bench_args.num_envs} on {device}:")
+        benchmark_act(agent, obs, bench_args.num_steps, compile=bench_args.compile)
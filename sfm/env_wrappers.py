@@ -7,6 +7,7 @@ from torch.distributions import Normal
 import torch.nn as nn
 from collections import deque
 import random
+from typing import Dict, List, Tuple, Optional, Any, Sequence
 
 ## All wrappers for env modification
 
@@ -265,10 +266,33 @@ class StabilityWrapper(gym.Wrapper):
             
         return observation, modified_reward, terminated, truncated, info
     
-import gym
-import numpy as np
-from collections import deque
-from typing import Dict, Tuple, Optional, Any
+def _delay_groups(delays: np.ndarray) -> List[Tuple[slice, int]]:
+    """
+    Splits per-channel delays into runs of neighbouring channels sharing a delay, so every run
+    is read back from the ring buffer with one slice.
+    """
+    groups = []
+    start = 0
+    for end in range(1, len(delays) + 1):
+        if end == len(delays) or delays[end] != delays[start]:
+            groups.append((slice(start, end), int(delays[start])))
+            start = end
+    return groups
+
+def _channel_delays(obs_dim: int, proprio_delay: int, force_delay: int,
+                    channel_delays: Optional[Sequence[int]]) -> np.ndarray:
+    if channel_delays is not None:
+        delays = np.asarray(channel_delays, dtype=np.int64)
+        assert delays.shape == (obs_dim,), f"channel_delays needs one delay per observation channel ({obs_dim})"
+    else:
+        # Half-Cheetah observation space indices:
+        # [0:8] - positions (proprioception)
+        # [8:17] - velocities (proprioception)
+        # [17:] - external forces/contact forces
+        delays = np.full(obs_dim, force_delay, dtype=np.int64)
+        delays[:17] = proprio_delay
+    assert (delays >= 0).all(), "delays must be non-negative"
+    return delays
 
 class DelayedHalfCheetahEnv(gym.Wrapper):
     """
@@ -276,76 +300,58 @@ class DelayedHalfCheetahEnv(gym.Wrapper):
     The Half-Cheetah observation space consists of:
     - Proprioception (joint angles, velocities): ~20-40ms delay
     - Force/contact sensors: ~40-60ms delay
+    Past observations live in a preallocated ring buffer of max_delay + 1 rows, every channel
+    reads the row written delay steps ago. channel_delays sets an arbitrary delay per channel
+    and overrides the proprioception/force split.
     """
     def __init__(
         self,
         env: gym.Env,
         proprio_delay: int = 2,  # 20ms at 100Hz
         force_delay: int = 5,    # 50ms at 100Hz
+        channel_delays: Optional[Sequence[int]] = None,
     ):
         super().__init__(env)
         self.proprio_delay = proprio_delay
         self.force_delay = force_delay
-        
-        # Initialize buffers for different sensor types
-        self.proprio_buffer = deque(maxlen=proprio_delay + 1)
-        self.force_buffer = deque(maxlen=force_delay + 1)
-        
-        # Half-Cheetah observation space indices:
-        # [0:8] - positions (proprioception)
-        # [8:17] - velocities (proprioception)
-        # [17:] - external forces/contact forces
-        self.proprio_indices = list(range(0, 17))
-        self.force_indices = list(range(17, self.env.observation_space.shape[0]))
-        
-    def _get_delayed_obs(self, observation: np.ndarray) -> np.ndarray:
+
+        obs_dim = self.env.observation_space.shape[0]
+        self.delays = _channel_delays(obs_dim, proprio_delay, force_delay, channel_delays)
+        self.groups = _delay_groups(self.delays)
+        self.buffer = np.zeros((int(self.delays.max()) + 1, obs_dim), dtype=self.env.observation_space.dtype)
+        self.head = 0
+
+    def _get_delayed_obs(self) -> np.ndarray:
         """
         Returns an observation with appropriate delays for each sensor type.
         """
-        delayed_obs = observation.copy()
-        
-        # Get delayed proprioceptive feedback
-        if len(self.proprio_buffer) == self.proprio_delay + 1:
-            delayed_obs[self.proprio_indices] = self.proprio_buffer[0][self.proprio_indices]
-        
-        # Get delayed force feedback
-        if len(self.force_buffer) == self.force_delay + 1:
-            delayed_obs[self.force_indices] = self.force_buffer[0][self.force_indices]
-            
+        num_rows = self.buffer.shape[0]
+        delayed_obs = np.empty_like(self.buffer[0])
+        for channels, delay in self.groups:
+            delayed_obs[channels] = self.buffer[(self.head - delay) % num_rows, channels]
         return delayed_obs
-    
+
     def reset(self, **kwargs) -> Tuple[np.ndarray, Dict[str, Any]]:
         """
-        Resets the environment and initializes the delay buffers.
+        Resets the environment and fills the whole history with the initial observation.
         Handles the new Gymnasium API that returns (obs, info).
         """
         observation, info = self.env.reset(**kwargs)
-        
-        # Clear and initialize all buffers with initial observation
-        self.proprio_buffer.clear()
-        self.force_buffer.clear()
-        
-        for _ in range(max(self.proprio_delay, self.force_delay) + 1):
-            self.proprio_buffer.append(observation)
-            self.force_buffer.append(observation)
-            
-        delayed_obs = self._get_delayed_obs(observation)
-        return delayed_obs, info
-    
+        self.buffer[:] = observation
+        self.head = 0
+        return self._get_delayed_obs(), info
+
     def step(self, action: np.ndarray) -> Tuple[np.ndarray, float, bool, bool, Dict]:
         """
         Takes a step in the environment while maintaining sensory delays.
         Handles the new Gymnasium API that returns (obs, reward, terminated, truncated, info).
         """
         observation, reward, terminated, truncated, info = self.env.step(action)
-        
-        # Update delay buffers
-        self.proprio_buffer.append(observation)
-        self.force_buffer.append(observation)
-        
-        delayed_obs = self._get_delayed_obs(observation)
-        
-        return delayed_obs, reward, terminated, truncated, info
+
+        self.head = (self.head + 1) % self.buffer.shape[0]
+        self.buffer[self.head] = observation
+
+        return self._get_delayed_obs(), reward, terminated, truncated, info
 
     def get_delay_info(self) -> Dict[str, int]:
         """
@@ -354,4 +360,168 @@ class DelayedHalfCheetahEnv(gym.Wrapper):
         return {
             "proprioception_delay_ms": self.proprio_delay * 10,  # Assuming 100Hz
             "force_delay_ms": self.force_delay * 10
-        }
\ No newline at end of file
+        }
+
+class DelayedObservationVectorEnv(gym.vector.VectorEnvWrapper):
+    """
+    DelayedHalfCheetahEnv for a whole vector env: one (max_delay + 1, num_envs, obs_dim) ring
+    buffer and one slice read per delay group for the full batch. Sub-envs autoreset, so the
+    history of every sub-env that just finished is refilled with its new first observation.
+    Sits outside the sub-envs, i.e. it delays whatever observation they return (normalized,
+    if the sub-envs normalize). infos["final_observation"] is passed through undelayed.
+    """
+    def __init__(
+        self,
+        env: gym.vector.VectorEnv,
+        proprio_delay: int = 2,
+        force_delay: int = 5,
+        channel_delays: Optional[Sequence[int]] = None,
+    ):
+        super().__init__(env)
+        self.proprio_delay = proprio_delay
+        self.force_delay = force_delay
+
+        obs_dim = self.single_observation_space.shape[0]
+        self.delays = _channel_delays(obs_dim, proprio_delay, force_delay, channel_delays)
+        self.groups = _delay_groups(self.delays)
+        self.buffer = np.zeros((int(self.delays.max()) + 1, self.num_envs, obs_dim),
+                               dtype=self.single_observation_space.dtype)
+        self.head = 0
+
+    def _get_delayed_obs(self) -> np.ndarray:
+        num_rows = self.buffer.shape[0]
+        delayed_obs = np.empty_like(self.buffer[0])
+        for channels, delay in self.groups:
+            delayed_obs[:, channels] = self.buffer[(self.head - delay) % num_rows, :, channels]
+        return delayed_obs
+
+    def reset(self, **kwargs) -> Tuple[np.ndarray, Dict[str, Any]]:
+        observations, infos = self.env.reset(**kwargs)
+        self.buffer[:] = observations
+        self.head = 0
+        return self._get_delayed_obs(), infos
+
+    def step(self, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, Dict]:
+        observations, rewards, terminations, truncations, infos = self.env.step(actions)
+
+        self.head = (self.head + 1) % self.buffer.shape[0]
+        self.buffer[self.head] = observations
+        done = np.logical_or(terminations, truncations)
+        if done.any():
+            self.buffer[:, done] = observations[done]
+
+        return self._get_delayed_obs(), rewards, terminations, truncations, infos
+
+## Vector env versions of the perturbation wrappers: one call per step for the whole
+## (num_envs, ...) batch and a single seeded np.random.Generator shared by all sub-envs.
+## They expect raw sub-env observations, i.e. a vector env of plain gym.make envs, with
+## episode statistics and normalization applied after them at the vector level.
+
+class VectorPerturbationWrapper(gym.vector.VectorEnvWrapper):
+    def __init__(self, env, seed=None):
+        super().__init__(env)
+        self.rng = np.random.default_rng(seed)
+
+    def reset(self, **kwargs):
+        if kwargs.get("seed") is not None:
+            # same entropy as the env seed, so a seeded reset makes the perturbations reproducible
+            self.rng = np.random.default_rng(kwargs["seed"])
+        return self.env.reset(**kwargs)
+
+def _final_observations(observations, terminations, truncations, infos):
+    '''The observations the sub-envs actually ended on: autoreset already replaced them in
+    observations for every sub-env that finished, the originals are in final_observation'''
+    done = np.logical_or(terminations, truncations)
+    if not done.any() or "final_observation" not in infos:
+        return observations
+    final = observations.copy()
+    for i in np.nonzero(done)[0]:
+        final[i] = infos["final_observation"][i]
+    return final
+
+class TargetVelocityVectorWrapper(VectorPerturbationWrapper):
+    def __init__(self, env, target_velocity=2.0, tolerance=0.5, seed=None):
+        super().__init__(env, seed)
+        self.target_velocity = target_velocity
+        self.tolerance = tolerance
+
+    def step(self, actions):
+        obs, rewards, terminations, truncations, infos = self.env.step(actions)
+        velocity = _final_observations(obs, terminations, truncations, infos)[:, 8]
+        rewards = np.maximum(0, 1 - np.abs(self.target_velocity - velocity) / self.tolerance)
+        return obs, rewards, terminations, truncations, infos
+
+class JumpRewardVectorWrapper(VectorPerturbationWrapper):
+    def __init__(self, env, jump_target_height=1.0, seed=None):
+        super().__init__(env, seed)
+        self.jump_target_height = jump_target_height
+
+    def step(self, actions):
+        obs, rewards, terminations, truncations, infos = self.env.step(actions)
+        torso_height = _final_observations(obs, terminations, truncations, infos)[:, 0]
+        rewards = torso_height / self.jump_target_height
+        return obs, rewards, terminations, truncations, infos
+
+class NoisyObservationVectorWrapper(VectorPerturbationWrapper):
+    def __init__(self, env, noise_scale=0.05, seed=None):
+        super().__init__(env, seed)
+        self.noise_scale = noise_scale
+
+    def observation(self, observations):
+        noise = self.rng.normal(0, self.noise_scale, size=observations.shape)
+        return (observations + noise).astype(observations.dtype, copy=False)
+
+    def reset(self, **kwargs):
+        obs, infos = super().reset(**kwargs)
+        return self.observation(obs), infos
+
+    def step(self, actions):
+        obs, rewards, terminations, truncations, infos = self.env.step(actions)
+        return self.observation(obs), rewards, terminations, truncations, infos
+
+class PartialObservabilityVectorWrapper(VectorPerturbationWrapper):
+    def __init__(self, env, observable_ratio=0.5, seed=None):
+        super().__init__(env, seed)
+        self.observable_ratio = observable_ratio
+
+    def observation(self, observations):
+        mask = self.rng.random(observations.shape) < self.observable_ratio
+        return np.where(mask, observations, 0).astype(observations.dtype, copy=False)
+
+    def reset(self, **kwargs):
+        obs, infos = super().reset(**kwargs)
+        return self.observation(obs), infos
+
+    def step(self, actions):
+        obs, rewards, terminations, truncations, infos = self.env.step(actions)
+        return self.observation(obs), rewards, terminations, truncations, infos
+
+class ActionMaskingVectorWrapper(VectorPerturbationWrapper):
+    def __init__(self, env, mask_prob=0.1, seed=None):
+        super().__init__(env, seed)
+        self.mask_prob = mask_prob
+
+    def step(self, actions):
+        # every sub-env drops its whole action with probability mask_prob
+        masked = self.rng.random(self.num_envs) < self.mask_prob
+        if masked.any():
+            actions = np.where(masked[:, None], 0, actions).astype(actions.dtype, copy=False)
+        return self.env.step(actions)
+
+class NonLinearDynamicsVectorWrapper(VectorPerturbationWrapper):
+    def __init__(self, env, dynamic_change_threshold=100, seed=None):
+        super().__init__(env, seed)
+        self.dynamic_change_threshold = dynamic_change_threshold
+        # per sub-env and, like the single env version, not reset between episodes
+        self.step_count = np.zeros(self.num_envs, dtype=np.int64)
+
+    def step(self, actions):
+        self.step_count += 1
+        active = self.step_count > self.dynamic_change_threshold
+        if active.any():
+            # multiply or divide by a random factor in [1.2, 2.0), chosen per sub-env
+            factor = self.rng.uniform(1.2, 2.0, size=self.num_envs)
+            scale = np.where(self.rng.random(self.num_envs) > 0.5, factor, 1.0 / factor)
+            scale = np.where(active, scale, 1.0)
+            actions = (actions * scale[:, None]).astype(actions.dtype, copy=False)
+        return self.env.step(actions)
@@ -0,0 +1,89 @@
+import time
+import numpy as np
+import torch
+
+## Vectorized policy evaluation shared by the test scripts
+
+def policy_mean(agent, x):
+    '''Mean action of the agent's Gaussian policy. Agents acting on a UPN latent use the
+    encoder output, for the VAE encoders that is mu instead of a sampled z.'''
+    if hasattr(agent, "encode"):
+        encoded = agent.encode(x)
+        z = encoded[0] if isinstance(encoded, tuple) else encoded
+        return agent.actor_mean(z)
+    return agent.actor_mean(x)
+
+def confidence_interval(values, confidence=0.95, num_resamples=10000, seed=0):
+    '''Percentile bootstrap interval of the mean'''
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) < 2:
+        return float("nan"), float("nan")
+    rng = np.random.default_rng(seed)
+    means = values[rng.integers(0, len(values), size=(num_resamples, len(values)))].mean(axis=1)
+    alpha = (1.0 - confidence) / 2
+    low, high = np.quantile(means, [alpha, 1.0 - alpha])
+    return float(low), float(high)
+
+def summarize(values, confidence=0.95):
+    values = np.asarray(values, dtype=np.float64)
+    ci_low, ci_high = confidence_interval(values, confidence)
+    return {
+        "mean": float(values.mean()),
+        "std": float(values.std()),
+        "median": float(np.median(values)),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "ci_low": ci_low,
+        "ci_high": ci_high,
+    }
+
+def evaluate_policy(agent, envs, device, num_episodes=100, deterministic=False, seed=None, confidence=0.95):
+    '''Run num_episodes episodes spread over all sub-envs of a vector env at once.
+
+    Sub-envs autoreset, and every env i keeps running episodes until its share
+    (num_episodes + i) // num_envs is done, so short episodes are not over-represented.
+    Returns and lengths are RecordEpisodeStatistics', i.e. before reward normalization, the same
+    numbers the trainers print. deterministic=True acts with the policy mean instead of sampling.'''
+    num_envs = envs.num_envs
+    targets = np.array([(num_episodes + i) // num_envs for i in range(num_envs)])
+    counts = np.zeros(num_envs, dtype=np.int64)
+    returns, lengths = [], []
+
+    was_training = agent.training
+    agent.eval()
+    start_time = time.time()
+    next_obs, _ = envs.reset(seed=seed)
+    with torch.no_grad():
+        while (counts < targets).any():
+            obs = torch.as_tensor(next_obs, dtype=torch.float32, device=device)
+            if deterministic:
+                action = policy_mean(agent, obs)
+            else:
+                action, _, _, _ = agent.get_action_and_value(obs)
+            next_obs, _, _, _, infos = envs.step(action.cpu().numpy())
+
+            if "final_info" in infos:
+                for i, info in enumerate(infos["final_info"]):
+                    if info and "episode" in info and counts[i] < targets[i]:
+                        returns.append(float(np.squeeze(info["episode"]["r"])))
+                        lengths.append(int(np.squeeze(info["episode"]["l"])))
+                        counts[i] += 1
+    agent.train(was_training)
+    elapsed = time.time() - start_time
+
+    return {
+        "returns": np.array(returns),
+        "lengths": np.array(lengths),
+        "return": summarize(returns, confidence),
+        "length": summarize(lengths, confidence),
+        "deterministic": deterministic,
+        "seconds": elapsed,
+    }
+
+def format_result(name, result):
+    stats = result["return"]
+    mode = "deterministic" if result["deterministic"] else "stochastic"
+    return (f"{name} ({mode}, {len(result['returns'])} episodes in {result['seconds']:.1f}s): "
+            f"return {stats['mean']:.2f} +- {stats['std']:.2f} "
+            f"[CI {stats['ci_low']:.2f}, {stats['ci_high']:.2f}], "
+            f"length {result['length']['mean']:.1f}")
@@ -1,12 +1,29 @@
 import os
+import time
 import torch
 import numpy as np
 import gymnasium as gym
 import random
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from ppo import Agent, Args, make_env
+from demonstrations import ShardedDemoWriter
+from normalization import VectorNormalize, normalizer_path
 
 # ensured good coordinate
 
+@dataclass
+class ExportArgs:
+    model_path: str = 'ppo/ppo_no_flip_jump_intention.pth'
+    data_dirname: str = "imitation_data_ppo_no_flip_jump_intention"
+    num_episodes: int = 50
+    num_workers: int = 0 # 0 collects in this process, >0 fans the episodes out over a process pool
+
+# module level so spawned collection workers see the same settings
+args = Args()
+export_args = ExportArgs()
+
 def load_agent(agent_class, path, envs, device):
     agent = agent_class(envs).to(device)
     try:
@@ -18,95 +35,127 @@ def load_agent(agent_class, path, envs, device):
     agent.eval()
     return agent
 
-def collect_demonstration_data(agent, envs, device, num_episodes=50):
-    """Collect demonstration data over multiple episodes"""
-    state_history = []
-    action_history = []
-    next_state_history = []
+def make_expert_envs(model_path, num_envs, first_idx=0):
+    """Vector env normalized with the expert's frozen training statistics, so the demonstrations
+    see the observations the policy was trained on"""
+    envs = gym.vector.SyncVectorEnv(
+        [make_env(args.env_id, first_idx + i, args.capture_video, args.exp_name, args.gamma, normalize=False)
+         for i in range(num_envs)]
+    )
+    envs = VectorNormalize(envs, gamma=args.gamma)
+    envs.load(normalizer_path(model_path))
+    return envs
+
+def collect_demonstration_data(agent, envs, device, writer, seeds):
+    """Collect one episode per seed, every step is streamed into writer"""
     total_rewards = []
-    
-    for episode in range(num_episodes):
-        obs, _ = envs.reset(seed=args.seed)
-        obs = torch.Tensor(obs).to(device)
+
+    for episode, seed in enumerate(seeds):
+        obs, _ = envs.reset(seed=seed)
         done = False
         episode_reward = 0
-        
+
         while not done:
             with torch.no_grad():
-                action, _, _, _ = agent.get_action_and_value(obs)
-            
-            # Store current state and action
-            state_history.append(obs.cpu().numpy())
-            action_history.append(action.cpu().numpy())
-            
+                action, _, _, _ = agent.get_action_and_value(torch.as_tensor(obs, dtype=torch.float32, device=device))
+            action = action.cpu().numpy()
+
             # Step the environment
-            next_obs, reward, terminations, truncations, infos = envs.step(action.cpu().numpy())
+            next_obs, reward, terminations, truncations, infos = envs.step(action)
             done = np.logical_or(terminations, truncations)[0]  # Take first element since using vectorized env
-            
-            # Store next state
-            next_state_history.append(next_obs)
-            
+
+            # Store current state, action and next state
+            writer.append(states=obs, actions=action, next_states=next_obs)
+
             # Update for next iteration
-            obs = torch.Tensor(next_obs).to(device)
+            obs = next_obs
             episode_reward += reward[0]
-        
-        print(f"Episode {episode + 1} Reward: {episode_reward:.2f}")
+
+        print(f"Episode {episode + 1} (seed {seed}) Reward: {episode_reward:.2f}")
         total_rewards.append(episode_reward)
-    
-    print(f"\nAverage episode reward: {np.mean(total_rewards):.2f}")
-    print(f'{np.array(state_history).shape} Experience generated')
-    
-    return (np.array(state_history), 
-            np.array(action_history), 
-            np.array(next_state_history))
+
+    return total_rewards
+
+def collect_worker(worker_id, seeds, model_path, data_dir):
+    """Pool worker: own single-threaded CPU agent and env, writes into its own part of the dataset"""
+    torch.set_num_threads(1)
+    torch.manual_seed(seeds[0])
+    np.random.seed(seeds[0])
+    envs = make_expert_envs(model_path, 1, first_idx=worker_id)
+    agent = load_agent(Agent, model_path, envs, torch.device("cpu"))
+    if agent is None:
+        raise RuntimeError(f"Worker {worker_id} failed to load agent from {model_path}")
+
+    part_dir = os.path.join(data_dir, f"worker_{worker_id:03d}")
+    with ShardedDemoWriter(part_dir) as writer:
+        rewards = collect_demonstration_data(agent, envs, torch.device("cpu"), writer, seeds)
+    envs.close()
+    return part_dir, rewards
+
+def collect_parallel(model_path, data_dir, num_episodes, num_workers):
+    """Spread episodes over num_workers processes, each with an independent block of seeds,
+    then fold the per-worker shards into data_dir"""
+    seeds = [args.seed + episode for episode in range(num_episodes)]
+    worker_seeds = [seeds[i::num_workers] for i in range(num_workers) if seeds[i::num_workers]]
+    # spawn, forking a process that already holds torch/MuJoCo state is not safe
+    with ProcessPoolExecutor(max_workers=len(worker_seeds), mp_context=mp.get_context("spawn")) as pool:
+        futures = [pool.submit(collect_worker, worker_id, worker_seed, model_path, data_dir)
+                   for worker_id, worker_seed in enumerate(worker_seeds)]
+        results = [future.result() for future in futures]
+
+    total_rewards = []
+    with ShardedDemoWriter(data_dir) as writer:
+        existing = len(writer)
+        for part_dir, rewards in results:
+            writer.absorb(part_dir)
+            total_rewards.extend(rewards)
+        num_transitions = len(writer) - existing
+    return total_rewards, num_transitions
 
 if __name__ == "__main__":
-    # Initialize arguments and set seeds
-    args = Args()
+    # Set seeds
     random.seed(args.seed)
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
     torch.backends.cudnn.deterministic = args.torch_deterministic
-    
-    # Set up device
-    device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
-    print(f"Using device: {device}")
-    
-    # Create environment
-    envs = gym.vector.SyncVectorEnv(
-        [make_env(args.env_id, i, args.capture_video, args.exp_name, args.gamma) for i in range(args.num_envs)]
-    )
-    
-    # Load model
-    model_path = os.path.join(os.getcwd(), 'sfm', 'params', 'ppo/ppo_no_flip_jump_intention.pth')
-    agent = load_agent(Agent, model_path, envs, device)
-    
-    if agent is None:
-        print("Failed to load agent. Exiting...")
-        exit(1)
-    
-    # Collect demonstration data
-    print("\nCollecting demonstration data...")
-    states, actions, next_states = collect_demonstration_data(agent, envs, device)
-    
-    print(f"\nCollected data shapes:")
-    print(f"States: {states.shape}")
-    print(f"Actions: {actions.shape}")
-    print(f"Next States: {next_states.shape}")
-    
-    # Save the demonstration data
+
+    model_path = os.path.join(os.getcwd(), 'sfm', 'params', export_args.model_path)
+
+    # Save the demonstration data as a sharded dataset, written while collecting
     save_dir = os.path.join(os.getcwd(), 'sfm', 'data')
     os.makedirs(save_dir, exist_ok=True)
-    
-    data_filename = "imitation_data_ppo_no_flip_jump_intention.npz"
-    npz_path = os.path.join(save_dir, data_filename)
-    
-    np.savez(npz_path, 
-             states=states,
-             actions=actions, 
-             next_states=next_states)
-    
-    print(f"\nSaved demonstration data to {npz_path}")
-    
-    # Close environment
-    envs.close()
\ No newline at end of file
+    data_dir = os.path.join(save_dir, export_args.data_dirname)
+
+    print("\nCollecting demonstration data...")
+    start_time = time.time()
+    if export_args.num_workers > 0:
+        print(f"Using {export_args.num_workers} collection workers")
+        total_rewards, num_transitions = collect_parallel(model_path, data_dir, export_args.num_episodes, export_args.num_workers)
+    else:
+        # Set up device
+        device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
+        print(f"Using device: {device}")
+
+        # Create environment
+        envs = make_expert_envs(model_path, args.num_envs)
+
+        # Load model
+        agent = load_agent(Agent, model_path, envs, device)
+
+        if agent is None:
+            print("Failed to load agent. Exiting...")
+            exit(1)
+
+        with ShardedDemoWriter(data_dir) as writer:
+            existing = len(writer)
+            seeds = [args.seed + episode for episode in range(export_args.num_episodes)]
+            total_rewards = collect_demonstration_data(agent, envs, device, writer, seeds)
+            num_transitions = len(writer) - existing
+
+        # Close environment
+        envs.close()
+    elapsed = time.time() - start_time
+
+    print(f"\nAverage episode reward: {np.mean(total_rewards):.2f}")
+    print(f"{num_transitions} Experience generated in {elapsed:.1f}s ({num_transitions / elapsed:.0f} transitions/sec)")
+    print(f"\nSaved demonstration data to {data_dir}")
@@ -0,0 +1,53 @@
+import torch
+
+## Opt-in fused update step for the trainers' separate PPO/UPN/eta optimizers
+
+def adam_kwargs(device, fused=False):
+    '''Extra Adam arguments: the fused kernel on CUDA, the foreach implementation elsewhere'''
+    if not fused:
+        return {}
+    return {"fused": True} if torch.device(device).type == "cuda" else {"foreach": True}
+
+class FusedStep:
+    '''Replaces the zero_grad/backward/clip_grad_norm_/step sequence of every optimizer by one
+    zero_grad, one backward of the summed loss and the optimizer steps.
+
+    The summed loss is only correct when every loss reaches its own optimizer's parameters and no
+    other optimizer's: the trainers give PPO a detached latent and the PPO-side constraint terms a
+    detached eta_k for that reason. backward() only accumulates into the optimized parameters.
+    Gradients are still clipped per optimizer (max_grad_norms, None for no clipping), the norms of
+    all of them come from one _foreach_norm call and the scaling from one _foreach_mul_ each.'''
+    def __init__(self, optimizers, max_grad_norms, compile=False):
+        self.optimizers = optimizers
+        self.max_grad_norms = max_grad_norms
+        self.params = [[p for group in optimizer.param_groups for p in group["params"]] for optimizer in optimizers]
+        self.all_params = [p for params in self.params for p in params]
+        # only the clipping is compiled, Adam.step recompiles whenever the annealed lr changes
+        self.clip = torch.compile(self._clip) if compile else self._clip
+
+    def _clip(self, grads, max_grad_norms):
+        norms = torch._foreach_norm([g for group in grads for g in group])
+        offset = 0
+        for group, max_norm in zip(grads, max_grad_norms):
+            total_norm = torch.linalg.vector_norm(torch.stack(norms[offset:offset + len(group)]))
+            offset += len(group)
+            # same coefficient as nn.utils.clip_grad_norm_
+            clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+            torch._foreach_mul_(group, clip_coef)
+
+    def __call__(self, loss):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none=True)
+        loss.backward(inputs=self.all_params)
+
+        grads, max_grad_norms = [], []
+        for params, max_norm in zip(self.params, self.max_grad_norms):
+            group = [p.grad for p in params if p.grad is not None]
+            if max_norm is not None and group:
+                grads.append(group)
+                max_grad_norms.append(max_norm)
+        if grads:
+            self.clip(grads, max_grad_norms)
+
+        for optimizer in self.optimizers:
+            optimizer.step()
@@ -0,0 +1,56 @@
+import math
+import time
+import torch
+
+## Rollout-time action sampling without torch.distributions, and its micro-benchmark
+
+LOG_SQRT_2PI = 0.5 * math.log(2 * math.pi)
+
+def sample_gaussian(action_mean, actor_logstd):
+    '''Sample of the diagonal Gaussian policy and its log prob summed over action dims, the
+    numbers Normal(mean, exp(logstd)).sample()/.log_prob() give but without building the
+    distribution. (action - mean) / std is the noise itself, so the log prob needs no division.'''
+    noise = torch.randn_like(action_mean)
+    action = action_mean + noise * actor_logstd.exp()
+    logprob = (-0.5 * noise.square() - actor_logstd - LOG_SQRT_2PI).sum(1)
+    return action, logprob
+
+def compile_act(agent, enabled=True, mode=None):
+    '''agent.act, compiled into one graph (encoder, actor and critic fused) when torch.compile
+    is available. Parameters are read by reference, so optimizer steps need no recompile.'''
+    if not enabled:
+        return agent.act
+    if not hasattr(torch, "compile"):
+        print("torch.compile needs torch>=2.0, using the eager act()")
+        return agent.act
+    return torch.compile(agent.act, mode=mode, dynamic=False)
+
+def time_per_call(fn, obs, num_steps=1000, warmup=50):
+    '''Mean seconds per rollout step: the policy call plus the action's trip to the host'''
+    sync = torch.cuda.synchronize if obs.is_cuda else (lambda: None)
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(obs)[0].cpu().numpy()
+        sync()
+        start_time = time.perf_counter()
+        for _ in range(num_steps):
+            fn(obs)[0].cpu().numpy()
+        sync()
+    return (time.perf_counter() - start_time) / num_steps
+
+def benchmark_act(agent, obs, num_steps=1000, compile=True):
+    '''Per-step latency of get_action_and_value against act(), eager and compiled'''
+    was_training = agent.training
+    agent.eval()
+    paths = {
+        "get_action_and_value": agent.get_action_and_value,
+        "act": agent.act,
+    }
+    if compile:
+        paths["act (compiled)"] = compile_act(agent)
+    results = {name: time_per_call(fn, obs, num_steps) for name, fn in paths.items()}
+    baseline = results["get_action_and_value"]
+    for name, seconds in results.items():
+        print(f"{name:>22}: {seconds * 1e6:8.1f} us/step ({baseline / seconds:.2f}x)")
+    agent.train(was_training)
+    return results
@@ -0,0 +1,281 @@
+import os
+import copy
+import time
+import random
+import importlib
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.func import functional_call, stack_module_state, vmap
+
+from vec_env import make_vector_env
+from normalization import VectorNormalize, normalizer_path
+from gae import compute_gae
+from demonstrations import ImitationData
+from metrics import MetricsTracker
+from run_logger import RunLogger, make_run_dir
+
+## K independent seeds of sfmppo/sofppo trained in one process with vmapped agents
+
+@dataclass
+class MultiSeedArgs:
+    algo: str = "sfmppo" # "sfmppo" or "sofppo", its Args instance configures the replicas
+    num_seeds: int = 4 # replicas train on args.seed, args.seed + 1, ...
+
+multiseed_args = MultiSeedArgs()
+
+PPO_PARAMS = ("actor_mean.", "actor_logstd", "critic.")
+
+class AgentCall(nn.Module):
+    '''Runs fn(agent, *inputs) as a forward pass, so functional_call can swap in a replica's parameters'''
+    def __init__(self, agent):
+        super().__init__()
+        self.agent = agent
+
+    def forward(self, fn, *inputs):
+        return fn(self.agent, *inputs)
+
+class StackedAgents:
+    '''num_seeds replicas of one Agent with every parameter stacked along a leading seed dimension.
+
+    The stacked tensors are the trainable leaves. A loss summed over seeds gives each slice exactly
+    the gradient of its own replica, and Adam is elementwise, so one optimizer over the stacks
+    steps every replica like a separate optimizer would. Calls are vmapped over the seed
+    dimension, so all replicas share one kernel launch per layer.'''
+    def __init__(self, agents):
+        self.num_seeds = len(agents)
+        self.params, self.buffers = stack_module_state(agents)
+        # stateless copy that only provides the architecture
+        self.module = AgentCall(copy.deepcopy(agents[0]).to("meta"))
+
+    def named_parameters(self, prefixes=None):
+        for name, param in self.params.items():
+            if prefixes is None or name.startswith(prefixes):
+                yield name, param
+
+    def call(self, fn, *inputs):
+        '''fn(agent, *inputs) for every replica. Inputs and outputs carry the seed dimension first,
+        sampling (actions, VAE latents) draws independent noise per replica'''
+        def one(params, buffers, *x):
+            state = {f"agent.{name}": value for name, value in {**params, **buffers}.items()}
+            return functional_call(self.module, state, (fn,) + x)
+        return vmap(one, randomness="different")(self.params, self.buffers, *inputs)
+
+    def state_dict(self, seed_idx):
+        '''Plain Agent state dict of one replica'''
+        return {name: value[seed_idx].detach().clone() for name, value in {**self.params, **self.buffers}.items()}
+
+def clip_grad_norm_per_seed(params, max_norm):
+    '''nn.utils.clip_grad_norm_ applied to every replica on its own slice of the stacked gradients'''
+    grads = [p.grad for p in params if p.grad is not None]
+    norms = torch.stack([g.reshape(g.shape[0], -1).norm(dim=1) for g in grads]).norm(dim=0)
+    scale = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+    for g in grads:
+        g.mul_(scale.view((-1,) + (1,) * (g.dim() - 1)))
+    return norms
+
+def take_rows(x, indices):
+    '''x[k, indices[k]] for every seed k'''
+    return torch.take_along_dim(x, indices.view(indices.shape + (1,) * (x.dim() - 2)), dim=1)
+
+def load_replica(algo, agent, device):
+    args = algo.args
+    params_dir = os.path.join(os.getcwd(), 'sfm', 'params')
+    if args.load_sfmppo is not None:
+        data_path = os.path.join(params_dir, args.load_sfmppo)
+        if hasattr(agent, "load_ppo"):
+            agent.load_ppo(data_path)
+        elif os.path.exists(data_path):
+            agent.load_state_dict(torch.load(data_path, map_location=device))
+    if args.load_upn is not None:
+        agent.load_upn(os.path.join(params_dir, args.load_upn))
+
+def seed_path(path, seed):
+    root, ext = os.path.splitext(path)
+    return f"{root}_seed{seed}{ext}"
+
+def train_multiseed(algo, num_seeds):
+    args = algo.args
+    args.batch_size = args.num_steps * args.num_envs
+    args.minibatch_size = args.batch_size // args.num_minibatches
+    args.iterations = args.total_timesteps // args.batch_size
+    seeds = [args.seed + k for k in range(num_seeds)]
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.backends.cudnn.deterministic = args.torch_deterministic
+    # argument validation in torch.distributions branches on tensor values, which vmap cannot trace
+    torch.distributions.Distribution.set_default_validate_args(False)
+
+    device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
+
+    # one vector env per replica, only the first one records video
+    envs = [VectorNormalize(make_vector_env(
+        [algo.make_env(args.env_id, i, args.capture_video and k == 0, f"{args.exp_name}__{seed}", args.gamma, normalize=False) for i in range(args.num_envs)],
+        backend=args.vector_backend,
+    ), gamma=args.gamma) for k, seed in enumerate(seeds)]
+    single_observation_space, single_action_space = envs[0].single_observation_space, envs[0].single_action_space
+
+    agents = []
+    for seed in seeds:
+        torch.manual_seed(seed)
+        agent = algo.Agent(envs[0]).to(device)
+        load_replica(algo, agent, device)
+        agents.append(agent)
+    stacked = StackedAgents(agents)
+    del agents
+    torch.manual_seed(args.seed)
+
+    ppo_params = [p for _, p in stacked.named_parameters(PPO_PARAMS)]
+    upn_params = [p for _, p in stacked.named_parameters(("upn.",))]
+    ppo_optimizer = optim.Adam(ppo_params, lr=args.ppo_learning_rate, eps=1e-5)
+    upn_optimizer = optim.Adam(upn_params, lr=args.upn_learning_rate, eps=1e-5)
+
+    imitation_data = None
+    if args.mix_coord:
+        data_path = os.path.join(os.getcwd(), 'sfm', 'data', args.imitation_data_path)
+        imitation_data = ImitationData(data_path, device, on_device=args.imitation_on_device)
+
+    # Storage, seed dimension right after time so GAE can treat every (seed, env) pair as an env
+    shape = (args.num_steps, num_seeds, args.num_envs)
+    obs = torch.zeros(shape + single_observation_space.shape, device=device)
+    actions = torch.zeros(shape + single_action_space.shape, device=device)
+    logprobs = torch.zeros(shape, device=device)
+    rewards = torch.zeros(shape, device=device)
+    dones = torch.zeros(shape, device=device)
+    values = torch.zeros(shape, device=device)
+    next_obs_all = torch.zeros(shape + single_observation_space.shape, device=device)
+
+    # separate run log per seed, each readable by report.py
+    log_root = os.path.join(os.getcwd(), 'sfm', args.log_dir)
+    loggers = [RunLogger(make_run_dir(log_root, args.exp_name, seed), config=args) for seed in seeds]
+    trackers = [MetricsTracker(logger) for logger in loggers]
+
+    global_step = 0
+    start_time = time.time()
+    next_obs = torch.tensor(np.stack([e.reset(seed=seed)[0] for e, seed in zip(envs, seeds)]), dtype=torch.float32, device=device)
+    next_done = torch.zeros((num_seeds, args.num_envs), device=device)
+
+    for iteration in range(1, args.iterations + 1):
+        if args.anneal_lr:
+            frac = 1.0 - (iteration - 1.0) / args.iterations
+            ppo_optimizer.param_groups[0]["lr"] = frac * args.ppo_learning_rate
+
+        for step in range(0, args.num_steps):
+            global_step += args.num_envs
+            obs[step] = next_obs
+            dones[step] = next_done
+
+            with torch.no_grad():
+                action, logprob, _, value = stacked.call(algo.Agent.get_action_and_value, next_obs)
+                values[step] = value.squeeze(-1)
+            actions[step] = action
+            logprobs[step] = logprob
+
+            # step every replica's envs together, async backends overlap their workers
+            action_np = action.cpu().numpy()
+            for e, a in zip(envs, action_np):
+                e.step_async(a)
+            results = [e.step_wait() for e in envs]
+
+            next_obs = torch.tensor(np.stack([r[0] for r in results]), dtype=torch.float32, device=device)
+            rewards[step] = torch.tensor(np.stack([r[1] for r in results]), dtype=torch.float32, device=device)
+            next_done = torch.tensor(np.stack([np.logical_or(r[2], r[3]) for r in results]), dtype=torch.float32, device=device)
+            next_obs_all[step] = next_obs
+
+            for tracker, seed, r in zip(trackers, seeds, results):
+                infos = r[4]
+                if "final_info" in infos:
+                    for info in infos["final_info"]:
+                        if info and "episode" in info:
+                            print(f"seed={seed}, global_step={global_step}, episodic_return={info['episode']['r']}")
+                            tracker.log_episode(global_step, info["episode"]["r"], info["episode"]["l"])
+
+        with torch.no_grad():
+            next_value = stacked.call(algo.Agent.get_value, next_obs).reshape(1, -1)
+            flat = (args.num_steps, num_seeds * args.num_envs)
+            advantages, returns = compute_gae(rewards.reshape(flat), values.reshape(flat), dones.reshape(flat),
+                                              next_value, next_done.reshape(-1), args.gamma, args.gae_lambda)
+            advantages, returns = advantages.reshape(shape), returns.reshape(shape)
+
+        if args.mix_coord:
+            mixed = [imitation_data.mixed_batch(obs[:, k], actions[:, k], next_obs_all[:, k], args.imitation_ratio) for k in range(num_seeds)]
+            obs_imitate, actions_imitate, next_obs_imitate = (torch.stack(parts, dim=1) for parts in zip(*mixed))
+        else:
+            obs_imitate, actions_imitate, next_obs_imitate = obs, actions, next_obs_all
+
+        # (seed, time * env, ...), per seed in the same order the single seed trainers flatten
+        def per_seed(x):
+            return x.transpose(0, 1).reshape((num_seeds, args.batch_size) + x.shape[3:])
+        batch = [per_seed(x) for x in (obs, actions, logprobs, advantages, returns, values, obs_imitate, actions_imitate, next_obs_imitate)]
+        b_returns, b_values = batch[4], batch[5]
+
+        clipfracs = torch.zeros(num_seeds, device=device)
+        num_minibatches = 0
+        for epoch in range(args.update_epochs):
+            # independent shuffle per replica
+            b_inds = torch.argsort(torch.rand((num_seeds, args.batch_size), device=device), dim=1)
+            for start in range(0, args.batch_size, args.minibatch_size):
+                mb_inds = b_inds[:, start:start + args.minibatch_size]
+                ppo_loss, upn_loss, stats = stacked.call(algo.compute_minibatch_losses, *(take_rows(x, mb_inds) for x in batch))
+                clipfracs += stats.pop("clipfracs")
+                num_minibatches += 1
+
+                # the PPO loss only sees a detached latent, so both gradients are taken as in the
+                # single seed trainers: PPO loss into actor/critic, UPN loss into the UPN
+                ppo_grads = torch.autograd.grad(ppo_loss.sum(), ppo_params, retain_graph=True, allow_unused=True)
+                upn_grads = torch.autograd.grad(upn_loss.sum(), upn_params, allow_unused=True)
+                for p, g in zip(ppo_params + upn_params, ppo_grads + upn_grads):
+                    p.grad = g
+                clip_grad_norm_per_seed(ppo_params, args.max_grad_norm)
+                clip_grad_norm_per_seed(upn_params, args.max_grad_norm)
+                ppo_optimizer.step()
+                upn_optimizer.step()
+
+                # flags cover all replicas, reported by the first seed's tracker
+                trackers[0].check_grads(stacked.named_parameters())
+
+        var_y = b_returns.var(dim=1, unbiased=False)
+        explained_var = torch.where(var_y == 0, torch.full_like(var_y, float("nan")),
+                                    1 - (b_returns - b_values).var(dim=1, unbiased=False) / var_y)
+
+        # one host transfer for every replica's statistics
+        stats.update(clipfracs=clipfracs / num_minibatches, explained_variances=explained_var)
+        host = torch.stack([value.detach().float() for value in stats.values()]).tolist()
+        lr = ppo_optimizer.param_groups[0]["lr"]
+        for k, tracker in enumerate(trackers):
+            tracker.set("learning_rates", lr)
+            for key, row in zip(stats, host):
+                tracker.set(key, row[k])
+            tracker.flush(global_step=global_step, iteration=iteration)
+
+        sps = int(num_seeds * global_step / (time.time() - start_time))
+        print(f"SPS ({num_seeds} seeds x {args.num_envs} envs): {sps}")
+
+    for e in envs:
+        e.close()
+    for logger in loggers:
+        logger.close()
+    print(f"Run logs written to {os.path.dirname(loggers[0].run_dir)}, plot them with report.py")
+
+    # per seed checkpoints, loadable by the single seed trainers
+    save_dir = os.path.join(os.getcwd(), 'sfm', 'params')
+    for k, seed in enumerate(seeds):
+        state = stacked.state_dict(k)
+        data1_path = os.path.join(save_dir, seed_path(args.save_sfmppo, seed))
+        data2_path = os.path.join(save_dir, seed_path(args.save_sfm, seed))
+        os.makedirs(os.path.dirname(data1_path), exist_ok=True)
+        os.makedirs(os.path.dirname(data2_path), exist_ok=True)
+
+        print('Saved at: ', data1_path)
+        torch.save(state, data1_path)
+        envs[k].save(normalizer_path(data1_path))
+
+        print('Saved at: ', data2_path)
+        torch.save({name[len("upn."):]: value for name, value in state.items() if name.startswith("upn.")}, data2_path)
+
+if __name__ == "__main__":
+    train_multiseed(importlib.import_module(multiseed_args.algo), multiseed_args.num_seeds)
@@ -10,11 +10,16 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.distributions.normal import Normal
-import matplotlib.pyplot as plt
 from gymnasium.experimental.wrappers.rendering import RecordVideoV0 as RecordVideo
 from env_wrappers import (JumpRewardWrapper, TargetVelocityWrapper, DelayedRewardWrapper, MultiTimescaleWrapper, 
                           NoisyObservationWrapper, PartialObservabilityWrapper, MultiStepTaskWrapper, ActionMaskingWrapper,
                           PenalizeLargeActionWrapper, NoFlipWrapper, StabilityWrapper, DelayedHalfCheetahEnv)
+from vec_env import make_vector_env
+from normalization import VectorNormalize, normalizer_path
+from gae import compute_gae
+from overrides import apply_overrides
+from metrics import MetricsTracker
+from run_logger import RunLogger, make_run_dir
 
 @dataclass
 class Args:
@@ -28,6 +33,7 @@ class Args:
     learning_rate: float = 1e-5
     ppo_hidden_layer: int = 256
     num_envs: int = 1
+    vector_backend: str = "sync" # "sync" or "async" (subprocess per env, shared memory obs)
     num_steps: int = 2048
     anneal_lr: bool = True
     gamma: float = 0.99
@@ -45,15 +51,17 @@ class Args:
     action_reg_coef: float = 0.0
     load_model: str = None #"ppo/ppo_stable.pth"
     save_path: str = "ppo/ppo_no_flip_jump_intention.pth"
+    log_dir: str = "runs" # metrics stream to sfm/<log_dir>/<exp_name>__<seed>__<time>/metrics.jsonl, plot with report.py
 
     # to be filled in runtime
     batch_size: int = 0
     minibatch_size: int = 0
     num_iterations: int = 0
 
-args = Args()
+args = apply_overrides(Args())
 
-def make_env(env_id, idx, capture_video, run_name, gamma):
+def make_env(env_id, idx, capture_video, run_name, gamma, normalize=True):
+    '''normalize=False leaves observation/reward normalization to a VectorNormalize around the vector env'''
     def thunk():
         if capture_video and idx==0:
             env = gym.make(env_id, render_mode="rgb_array")
@@ -76,10 +84,11 @@ def make_env(env_id, idx, capture_video, run_name, gamma):
         env = gym.wrappers.FlattenObservation(env)  # deal with dm_control's Dict observation space
         env = gym.wrappers.RecordEpisodeStatistics(env)
         env = gym.wrappers.ClipAction(env)
-        env = gym.wrappers.NormalizeObservation(env)
-        env = gym.wrappers.TransformObservation(env, lambda obs: np.clip(obs, -10, 10))
-        env = gym.wrappers.NormalizeReward(env, gamma=gamma)
-        env = gym.wrappers.TransformReward(env, lambda reward: np.clip(reward, -10, 10))
+        if normalize:
+            env = gym.wrappers.NormalizeObservation(env)
+            env = gym.wrappers.TransformObservation(env, lambda obs: np.clip(obs, -10, 10))
+            env = gym.wrappers.NormalizeReward(env, gamma=gamma)
+            env = gym.wrappers.TransformReward(env, lambda reward: np.clip(reward, -10, 10))
         return env
 
     return thunk
@@ -132,9 +141,11 @@ if __name__ == "__main__":
 
     device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
 
-    envs = gym.vector.SyncVectorEnv(
-        [make_env(args.env_id, i, args.capture_video, args.exp_name, args.gamma) for i in range(args.num_envs)]
+    envs = make_vector_env(
+        [make_env(args.env_id, i, args.capture_video, args.exp_name, args.gamma, normalize=False) for i in range(args.num_envs)],
+        backend=args.vector_backend,
     )
+    envs = VectorNormalize(envs, gamma=args.gamma)
     assert isinstance(envs.single_action_space, gym.spaces.Box), "only continuous action space is supported"
 
     agent = Agent(envs).to(device)
@@ -161,17 +172,11 @@ if __name__ == "__main__":
     # Logging setup
     global_step = 0
     start_time = time.time()
-    episodic_returns = []
-    episodic_lengths = []
-    learning_rates = []
-    value_losses = []
-    policy_losses = []
-    entropies = []
-    old_approx_kls = []
-    approx_kls = []
-    clipfracs = []
-    explained_variances = []
-    sps_history = []
+    # per-iteration values stay on device and are synced once in metrics.flush(),
+    # then streamed to the run log, plot it offline with report.py
+    run_dir = make_run_dir(os.path.join(os.getcwd(), 'sfm', args.log_dir), args.exp_name, args.seed)
+    logger = RunLogger(run_dir, config=args)
+    metrics = MetricsTracker(logger)
 
     next_obs, _ = envs.reset(seed=args.seed)
     next_obs = torch.Tensor(next_obs).to(device)
@@ -184,7 +189,7 @@ if __name__ == "__main__":
             lrnow = frac * args.learning_rate
             optimizer.param_groups[0]["lr"] = lrnow
         
-        learning_rates.append(optimizer.param_groups[0]["lr"])
+        metrics.set("learning_rates", optimizer.param_groups[0]["lr"])
 
         for step in range(0, args.num_steps):
             global_step += args.num_envs
@@ -208,24 +213,12 @@ if __name__ == "__main__":
                 for info in infos["final_info"]:
                     if info and "episode" in info:
                         print(f"global_step={global_step}, episodic_return={info['episode']['r']}")
-                        episodic_returns.append(info["episode"]["r"])
-                        episodic_lengths.append(info["episode"]["l"])
+                        metrics.log_episode(global_step, info["episode"]["r"], info["episode"]["l"])
 
         # bootstrap value if not done
         with torch.no_grad():
             next_value = agent.get_value(next_obs).reshape(1, -1)
-            advantages = torch.zeros_like(rewards).to(device)
-            lastgaelam = 0
-            for t in reversed(range(args.num_steps)):
-                if t == args.num_steps - 1:
-                    nextnonterminal = 1.0 - next_done
-                    nextvalues = next_value
-                else:
-                    nextnonterminal = 1.0 - dones[t + 1]
-                    nextvalues = values[t + 1]
-                delta = rewards[t] + args.gamma * nextvalues * nextnonterminal - values[t]
-                advantages[t] = lastgaelam = delta + args.gamma * args.gae_lambda * nextnonterminal * lastgaelam
-            returns = advantages + values
+            advantages, returns = compute_gae(rewards, values, dones, next_value, next_done, args.gamma, args.gae_lambda)
 
         # flatten the batch
         b_obs = obs.reshape((-1,) + envs.single_observation_space.shape)
@@ -237,7 +230,6 @@ if __name__ == "__main__":
 
         # Optimizing the policy and value network
         b_inds = np.arange(args.batch_size)
-        clipfracs_batch = []
         for epoch in range(args.update_epochs):
             np.random.shuffle(b_inds)
             for start in range(0, args.batch_size, args.minibatch_size):
@@ -252,7 +244,7 @@ if __name__ == "__main__":
                     # calculate approx_kl http://joschu.net/blog/kl-approx.html
                     old_approx_kl = (-logratio).mean()
                     approx_kl = ((ratio - 1) - logratio).mean()
-                    clipfracs_batch += [((ratio - 1.0).abs() > args.clip_coef).float().mean().item()]
+                    metrics.add("clipfracs", ((ratio - 1.0).abs() > args.clip_coef).float().mean())
                 
                 if args.target_kl is not None and approx_kl > args.target_kl:
                     print(f"Early stopping at iteration {iteration} due to reaching target KL.")
@@ -294,90 +286,25 @@ if __name__ == "__main__":
                 nn.utils.clip_grad_norm_(agent.parameters(), args.max_grad_norm)
                 optimizer.step()
 
-        y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
-        var_y = np.var(y_true)
-        explained_var = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
+        var_y = b_returns.var(unbiased=False)
+        explained_var = torch.where(var_y == 0, torch.full_like(var_y, float("nan")),
+                                    1 - (b_returns - b_values).var(unbiased=False) / var_y)
 
         # Logging
-        value_losses.append(v_loss.item())
-        policy_losses.append(pg_loss.item())
-        entropies.append(entropy_loss.item())
-        old_approx_kls.append(old_approx_kl.item())
-        approx_kls.append(approx_kl.item())
-        clipfracs.append(np.mean(clipfracs_batch))
-        explained_variances.append(explained_var)
+        metrics.set("value_losses", v_loss)
+        metrics.set("policy_losses", pg_loss)
+        metrics.set("entropies", entropy_loss)
+        metrics.set("old_approx_kls", old_approx_kl)
+        metrics.set("approx_kls", approx_kl)
+        metrics.set("explained_variances", explained_var)
+        metrics.flush(global_step=global_step, iteration=iteration)
 
         sps = int(global_step / (time.time() - start_time))
-        sps_history.append(sps)
-        print(f"SPS: {sps}")
+        print(f"SPS ({args.vector_backend}, {args.num_envs} envs): {sps}")
 
     envs.close()
-
-    # Plotting
-    plt.figure(figsize=(20, 10))
-
-    plt.subplot(2, 3, 1)
-    plt.plot(episodic_returns)
-    avg_interval = 50
-    # Ensure that metrics["episodic_returns"] is a 1D list or array
-    episodic_returns = np.array(episodic_returns).flatten()
-
-    # Now apply np.convolve to calculate the rolling average
-    if len(episodic_returns) >= avg_interval:
-        avg_returns = np.convolve(episodic_returns, np.ones(avg_interval) / avg_interval, mode='valid')
-        plt.plot(range(avg_interval - 1, len(episodic_returns)), avg_returns, label=f"{avg_interval}-Episode Average", color="orange")
-
-    plt.title('Episodic Returns')
-    plt.xlabel('Episode')
-    plt.ylabel('Return')
-
-    # plt.subplot(2, 3, 2)
-    # plt.plot(episodic_lengths)
-    # plt.title('Episodic Lengths')
-    # plt.xlabel('Episode')
-    # plt.ylabel('Length')
-
-    plt.subplot(2, 3, 2)
-    plt.plot(approx_kls)
-    plt.title('Approx KLs')
-    plt.xlabel('Episode')
-    plt.ylabel('Approx KLs')
-
-    plt.subplot(2, 3, 3)
-    plt.plot(learning_rates)
-    plt.title('Learning Rate')
-    plt.xlabel('Iteration')
-    plt.ylabel('LR')
-
-    plt.subplot(2, 3, 4)
-    plt.plot(value_losses, label='Value Loss')
-    plt.plot(policy_losses, label='Policy Loss')
-    plt.title('Losses')
-    plt.xlabel('Iteration')
-    plt.ylabel('Loss')
-    plt.legend()
-
-    plt.subplot(2, 3, 5)
-    plt.plot(entropies)
-    plt.title('Entropy')
-    plt.xlabel('Iteration')
-    plt.ylabel('Entropy')
-
-    # plt.subplot(2, 3, 6)
-    # plt.plot(sps_history)
-    # plt.title('Steps Per Second')
-    # plt.xlabel('Iteration')
-    # plt.ylabel('SPS')
-
-    plt.subplot(2, 3, 6)
-    plt.plot(explained_variances)
-    plt.title('Explained Variance')
-    plt.xlabel('Iteration')
-    plt.ylabel('Variance')
-
-    plt.tight_layout()
-    plt.savefig('ppo_results.png')
-    plt.show()
+    logger.close()
+    print(f"Run log written to {logger.path}, plot it with report.py")
 
     save_dir = os.path.join(os.getcwd(),'sfm', 'params')
     os.makedirs(save_dir, exist_ok=True)
@@ -389,4 +316,5 @@ if __name__ == "__main__":
 
     data_path = os.path.join(save_dir, args.save_path)
     print('Saved at: ', data_path)
-    torch.save(agent.state_dict(), data_path)
\ No newline at end of file
+    torch.save(agent.state_dict(), data_path)
+    envs.save(normalizer_path(data_path))
\ No newline at end of file
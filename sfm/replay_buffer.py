@@ -0,0 +1,278 @@
+from collections import deque, namedtuple
+from itertools import islice
+
+import numpy as np
+import torch
+
+## Replay storage for off-policy trainers (sac.py)
+
+# same field names as stable_baselines3's ReplayBufferSamples, so update code reads the same
+# discounts holds the bootstrap factor of each row, gamma for one-step and gamma**m for n-step rows
+ReplayBufferSamples = namedtuple("ReplayBufferSamples", ["observations", "actions", "next_observations", "dones", "rewards", "discounts"])
+
+class ReplayBuffer:
+    '''Preallocated ring buffer of transitions stored as torch tensors.
+
+    Rows are laid out flat, one block of num_envs rows per add() call, so a vector env step is
+    written with a single slice copy. storage_device="cuda" keeps the whole buffer next to the
+    networks and sampling never leaves the device, the default keeps it in host memory and
+    moves only the sampled batch. obs_dtype=torch.float16 halves observation memory, samples
+    are returned as float32.
+
+    optimize_memory_usage drops the separate next-observation array: the next observation of
+    row i is row i + num_envs, i.e. the observation written by the following add(). That only
+    breaks where the env was reset in between, so for truncated rows the real final observation
+    is kept in a small side ring (boundary_capacity rows) and patched in when sampled.'''
+    def __init__(self, buffer_size, observation_space, action_space, device, num_envs=1,
+                 storage_device="cpu", obs_dtype=torch.float32, optimize_memory_usage=False,
+                 boundary_capacity=None, gamma=0.99):
+        self.num_envs = num_envs
+        self.gamma = gamma
+        self.buffer_size = max(buffer_size // num_envs, 1) # positions, each holding num_envs rows
+        self.num_rows = self.buffer_size * num_envs
+        self.device = torch.device(device)
+        self.storage_device = torch.device(storage_device)
+        self.obs_dtype = obs_dtype
+        self.optimize_memory_usage = optimize_memory_usage
+        self.obs_shape = observation_space.shape
+        self.action_dim = int(np.prod(action_space.shape))
+        self.pos = 0
+        self.full = False
+
+        def zeros(*shape, dtype=torch.float32):
+            return torch.zeros(shape, dtype=dtype, device=self.storage_device)
+
+        self.observations = zeros(self.num_rows, *self.obs_shape, dtype=obs_dtype)
+        self.next_observations = None if optimize_memory_usage else zeros(self.num_rows, *self.obs_shape, dtype=obs_dtype)
+        self.actions = zeros(self.num_rows, self.action_dim)
+        self.rewards = zeros(self.num_rows)
+        self.dones = zeros(self.num_rows)
+        self.discounts = zeros(self.num_rows)
+
+        if optimize_memory_usage:
+            # episodes are far longer than one step, a 1% side ring is plenty for truncation rows
+            boundary_capacity = boundary_capacity or max(self.num_rows // 100, 4 * num_envs)
+            self.boundary_obs = zeros(boundary_capacity, *self.obs_shape, dtype=obs_dtype)
+            self.boundary_owner = torch.full((boundary_capacity,), -1, dtype=torch.long, device=self.storage_device)
+            self.boundary_index = torch.full((self.num_rows,), -1, dtype=torch.long, device=self.storage_device)
+            self.boundary_pos = 0
+
+    def __len__(self):
+        return self.num_rows if self.full else self.pos * self.num_envs
+
+    def _to_storage(self, value, dtype=torch.float32):
+        return torch.as_tensor(np.asarray(value), device=self.storage_device).to(dtype).reshape(self.num_envs, -1)
+
+    def add(self, obs, next_obs, actions, rewards, dones, truncations=None, discounts=None):
+        '''Store one vector env step, every argument has a leading num_envs dim.
+        next_obs must already hold the real final observation for truncated envs,
+        discounts defaults to gamma (one-step rows).'''
+        rows = slice(self.pos * self.num_envs, (self.pos + 1) * self.num_envs)
+        obs = self._to_storage(obs, self.obs_dtype).reshape(self.num_envs, *self.obs_shape)
+        next_obs = self._to_storage(next_obs, self.obs_dtype).reshape(self.num_envs, *self.obs_shape)
+
+        self.observations[rows] = obs
+        self.actions[rows] = self._to_storage(actions)
+        self.rewards[rows] = self._to_storage(rewards).reshape(-1)
+        self.dones[rows] = self._to_storage(dones).reshape(-1)
+        if discounts is None:
+            self.discounts[rows] = self.gamma
+        else:
+            self.discounts[rows] = self._to_storage(discounts).reshape(-1)
+
+        if self.optimize_memory_usage:
+            # rows of this block are reused now, drop their old boundary entries
+            self.boundary_index[rows] = -1
+            next_rows = slice(((self.pos + 1) % self.buffer_size) * self.num_envs,
+                              ((self.pos + 1) % self.buffer_size + 1) * self.num_envs)
+            # provisional next obs, overwritten by the next add() with the same values unless an env reset
+            self.observations[next_rows] = next_obs
+            if truncations is not None:
+                for env_idx in np.flatnonzero(np.asarray(truncations)):
+                    self._add_boundary(rows.start + int(env_idx), next_obs[env_idx])
+        else:
+            self.next_observations[rows] = next_obs
+
+        self.pos += 1
+        if self.pos == self.buffer_size:
+            self.full = True
+            self.pos = 0
+
+    def _add_boundary(self, row, next_obs):
+        slot = self.boundary_pos
+        owner = self.boundary_owner[slot]
+        if owner >= 0 and self.boundary_index[owner] == slot:
+            self.boundary_index[owner] = -1
+        self.boundary_obs[slot] = next_obs
+        self.boundary_owner[slot] = row
+        self.boundary_index[row] = slot
+        self.boundary_pos = (slot + 1) % self.boundary_obs.shape[0]
+
+    def sample_indices(self, batch_size):
+        '''Uniform row indices on the storage device'''
+        if self.optimize_memory_usage:
+            # the current position only holds the provisional next obs of the previous step
+            if self.full:
+                positions = (self.pos + 1 + torch.randint(0, self.buffer_size - 1, (batch_size,), device=self.storage_device)) % self.buffer_size
+            else:
+                positions = torch.randint(0, self.pos, (batch_size,), device=self.storage_device)
+        else:
+            upper = self.buffer_size if self.full else self.pos
+            positions = torch.randint(0, upper, (batch_size,), device=self.storage_device)
+        env_inds = torch.randint(0, self.num_envs, (batch_size,), device=self.storage_device)
+        return positions * self.num_envs + env_inds
+
+    def sample(self, batch_size):
+        return self.get_samples(self.sample_indices(batch_size))
+
+    def next_observations_at(self, rows):
+        if not self.optimize_memory_usage:
+            return self.next_observations[rows]
+        next_obs = self.observations[(rows + self.num_envs) % self.num_rows]
+        boundary = self.boundary_index[rows]
+        patched = self.boundary_obs[boundary.clamp(min=0)]
+        mask = (boundary >= 0).reshape(-1, *([1] * len(self.obs_shape)))
+        return torch.where(mask, patched, next_obs)
+
+    def get_samples(self, rows):
+        def to_device(tensor):
+            return tensor.to(self.device, non_blocking=True)
+
+        return ReplayBufferSamples(
+            observations=to_device(self.observations[rows]).float(),
+            actions=to_device(self.actions[rows]),
+            next_observations=to_device(self.next_observations_at(rows)).float(),
+            dones=to_device(self.dones[rows]).unsqueeze(1),
+            rewards=to_device(self.rewards[rows]).unsqueeze(1),
+            discounts=to_device(self.discounts[rows]).unsqueeze(1),
+        )
+
+class SumTree:
+    '''Binary sum tree over capacity leaves in one flat tensor, node i has children 2i and 2i + 1.
+    Updates and prefix-sum searches run for a whole batch at once, one tensor op per tree level.'''
+    def __init__(self, capacity, device):
+        self.depth = max(int(np.ceil(np.log2(capacity))), 1)
+        self.capacity = 2 ** self.depth
+        self.tree = torch.zeros(2 * self.capacity, dtype=torch.float64, device=device)
+
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, leaves):
+        return self.tree[leaves + self.capacity]
+
+    def update(self, leaves, values):
+        nodes = leaves + self.capacity
+        self.tree[nodes] = values.to(self.tree.dtype)
+        for _ in range(self.depth):
+            # duplicate parents write the same sum, so no dedup is needed
+            nodes = nodes // 2
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        '''Leaf whose prefix-sum interval contains each value'''
+        values = values.to(self.tree.dtype).clamp(max=self.total() * (1 - 1e-12))
+        nodes = torch.ones_like(values, dtype=torch.long)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_sum = self.tree[left]
+            go_right = values > left_sum
+            values = torch.where(go_right, values - left_sum, values)
+            nodes = torch.where(go_right, left + 1, left)
+        return nodes - self.capacity
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    '''Proportional prioritized replay (Schaul et al.) on top of ReplayBuffer.
+
+    New rows get the largest priority seen so far. sample() draws one stratified value per
+    batch element from a SumTree and returns importance weights (N * P(i))^-beta normalized by
+    the batch max, together with the sampled rows for update_priorities(). Nothing here syncs
+    with the host, so the tree can live on the training device with the buffer.'''
+    def __init__(self, *buffer_args, alpha=0.6, beta=0.4, eps=1e-6, **buffer_kwargs):
+        super().__init__(*buffer_args, **buffer_kwargs)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.tree = SumTree(self.num_rows, self.storage_device)
+        self.max_priority = torch.ones((), dtype=torch.float64, device=self.storage_device)
+
+    def add(self, *add_args, **add_kwargs):
+        rows = torch.arange(self.pos * self.num_envs, (self.pos + 1) * self.num_envs, device=self.storage_device)
+        super().add(*add_args, **add_kwargs)
+        self.tree.update(rows, self.max_priority.expand(self.num_envs) ** self.alpha)
+        if self.optimize_memory_usage:
+            # the block now holding the provisional next obs is not a valid transition
+            provisional = torch.arange(self.pos * self.num_envs, (self.pos + 1) * self.num_envs, device=self.storage_device)
+            self.tree.update(provisional, torch.zeros(self.num_envs, device=self.storage_device))
+
+    def sample(self, batch_size):
+        total = self.tree.total()
+        targets = (torch.arange(batch_size, device=self.storage_device, dtype=torch.float64)
+                   + torch.rand(batch_size, device=self.storage_device, dtype=torch.float64)) * total / batch_size
+        rows = self.tree.find(targets)
+        probs = self.tree[rows] / total
+        weights = (len(self) * probs).pow(-self.beta)
+        weights = (weights / weights.max()).float()
+        return self.get_samples(rows), weights.to(self.device, non_blocking=True).unsqueeze(1), rows
+
+    def update_priorities(self, rows, td_errors):
+        priorities = td_errors.detach().abs().to(self.storage_device, torch.float64) + self.eps
+        self.max_priority = torch.maximum(self.max_priority, priorities.max())
+        self.tree.update(rows, priorities ** self.alpha)
+
+class NStepAccumulator:
+    '''Turns one-step vector env transitions into n-step ones at insertion time.
+
+    push() takes what ReplayBuffer.add() would and returns a list of add() argument tuples, one per
+    step whose window is complete: the discounted reward sum over up to n steps, cut at the first
+    termination or truncation, the observation after the last summed step, whether that step
+    terminated, and the bootstrap discount gamma**m. A step is complete once n steps are queued, or
+    as soon as the episode of every env has ended (terminated or truncated) within the queue, so an
+    episode's last n - 1 steps are emitted right at its end with the shortened horizon. flush() emits
+    whatever is still pending, e.g. at the end of training. Every step is emitted exactly once.'''
+    def __init__(self, n_step, gamma, num_envs):
+        self.n_step = n_step
+        self.gamma = gamma
+        self.num_envs = num_envs
+        self.queue = deque()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def push(self, obs, next_obs, actions, rewards, terminations, truncations):
+        self.queue.append(tuple(np.array(x) for x in (obs, next_obs, actions, rewards, terminations, truncations)))
+        transitions = []
+        while self.queue and (len(self.queue) >= self.n_step or self._episodes_ended()):
+            transitions.append(self._pop_transition())
+        return transitions
+
+    def flush(self):
+        '''Every pending step, each summed over the steps queued after it'''
+        transitions = []
+        while self.queue:
+            transitions.append(self._pop_transition())
+        return transitions
+
+    def _episodes_ended(self):
+        ended = np.zeros(self.num_envs, dtype=bool)
+        for step in self.queue:
+            ended |= step[4].astype(bool) | step[5].astype(bool)
+        return ended.all()
+
+    def _pop_transition(self):
+        first_obs, first_next_obs, first_actions = self.queue[0][:3]
+        returns = np.zeros(self.num_envs, dtype=np.float64)
+        discounts = np.ones(self.num_envs, dtype=np.float64)
+        dones = np.zeros(self.num_envs, dtype=np.float64)
+        truncated = np.zeros(self.num_envs, dtype=bool)
+        next_obs_n = first_next_obs.copy()
+        alive = np.ones(self.num_envs, dtype=bool)
+        for _, step_next_obs, _, step_rewards, step_terms, step_truncs in islice(self.queue, self.n_step):
+            returns += alive * discounts * step_rewards
+            next_obs_n[alive] = step_next_obs[alive]
+            dones = np.where(alive, step_terms, dones)
+            truncated = np.where(alive, step_truncs, truncated)
+            discounts = np.where(alive, discounts * self.gamma, discounts)
+            alive &= ~(step_terms.astype(bool) | step_truncs.astype(bool))
+        self.queue.popleft()
+        return first_obs, next_obs_n, first_actions, returns, dones, truncated, discounts
@@ -0,0 +1,106 @@
+import os
+import atexit
+import json
+import math
+import queue
+import threading
+import time
+from collections import defaultdict
+
+## Append-only JSONL run logs, written from a background thread
+
+LOG_FILE = "metrics.jsonl"
+RUN_ROOT_ENV = "SFM_RUN_ROOT"
+
+def make_run_dir(root, exp_name, seed):
+    '''Fresh run directory root/<exp_name>__<seed>__<unix time>. $SFM_RUN_ROOT replaces root, that
+    is how sweep.py finds the log of every run it launches.'''
+    root = os.environ.get(RUN_ROOT_ENV) or root
+    run_dir = os.path.join(root, f"{exp_name}__{seed}__{int(time.time())}")
+    os.makedirs(run_dir, exist_ok=True)
+    return run_dir
+
+def _encode(value):
+    # json has no NaN/Inf, write them as null so every line stays valid JSON
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if hasattr(value, "item"):
+        return _encode(value.item())
+    return value
+
+class RunLogger:
+    '''Streams dict records to run_dir/metrics.jsonl.
+
+    log() only puts the record on a queue, a daemon thread serialises and appends them in
+    batches of up to flush_every records or every flush_secs seconds, whichever comes first.
+    Every write is flushed to the OS, so a crashed run keeps everything logged up to that point.
+    Records carry a "kind" ("iteration" or "episode") so the report can split them back up.'''
+    def __init__(self, run_dir, flush_every=64, flush_secs=5.0, config=None):
+        os.makedirs(run_dir, exist_ok=True)
+        self.run_dir = run_dir
+        self.path = os.path.join(run_dir, LOG_FILE)
+        self.flush_every = flush_every
+        self.flush_secs = flush_secs
+        if config is not None:
+            with open(os.path.join(run_dir, "config.json"), "w") as f:
+                json.dump({k: _encode(v) for k, v in vars(config).items()}, f, indent=2, default=str)
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="RunLogger", daemon=True)
+        self._thread.start()
+        # drain the queue on interpreter exit too, including after an uncaught exception
+        atexit.register(self.close)
+
+    def log(self, kind, **fields):
+        if self._closed:
+            raise RuntimeError(f"RunLogger for {self.path} is closed")
+        fields = {k: _encode(v) for k, v in fields.items()}
+        self._queue.put({"kind": kind, "time": time.time(), **fields})
+
+    def _run(self):
+        with open(self.path, "a") as f:
+            done = False
+            while not done:
+                batch = []
+                deadline = time.monotonic() + self.flush_secs
+                while len(batch) < self.flush_every:
+                    try:
+                        record = self._queue.get(timeout=max(deadline - time.monotonic(), 0.0))
+                    except queue.Empty:
+                        break
+                    if record is None:
+                        done = True
+                        break
+                    batch.append(record)
+                if batch:
+                    f.write("".join(json.dumps(record) + "\n" for record in batch))
+                    f.flush()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_run(path):
+    '''Load a run log (the run directory or the jsonl file itself) into {kind: {key: [values]}}.
+    A truncated last line from a crashed run is skipped.'''
+    if os.path.isdir(path):
+        path = os.path.join(path, LOG_FILE)
+    runs = defaultdict(lambda: defaultdict(list))
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            kind = record.pop("kind")
+            for key, value in record.items():
+                runs[kind][key].append(float("nan") if value is None else value)
+    return runs
@@ -11,9 +11,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.distributions.normal import Normal
-import matplotlib.pyplot as plt
 from gymnasium.experimental.wrappers.rendering import RecordVideoV0 as RecordVideo
-from stable_baselines3.common.buffers import ReplayBuffer
+from replay_buffer import ReplayBuffer, PrioritizedReplayBuffer, NStepAccumulator
+from overrides import apply_overrides
+from metrics import MetricsTracker
+from run_logger import RunLogger, make_run_dir
 
 @dataclass
 class Args:
@@ -24,7 +26,16 @@ class Args:
     env_id: str = "HalfCheetah-v4"
     capture_video: bool = True
     total_timesteps: int = 500000
+    num_envs: int = 1
     buffer_size: int = int(1e6)
+    buffer_on_device: bool = False # keep the whole replay buffer on the training device
+    buffer_fp16_obs: bool = False # store observations as float16
+    buffer_optimize_memory: bool = False # observations and next observations share one array
+    prioritized_replay: bool = False # proportional prioritized replay over a sum tree
+    per_alpha: float = 0.6 # how strongly TD error shapes the sampling distribution
+    per_beta: float = 0.4 # initial importance-weight exponent, annealed to 1 over training
+    per_eps: float = 1e-6
+    n_step: int = 1 # n-step returns, computed when transitions are inserted
     gamma: float = 0.99
     tau: float = 0.005
     batch_size: int = 256
@@ -36,6 +47,8 @@ class Args:
     alpha: float = 0.2
     autotune: bool = True
     load_model: str = None
+    log_dir: str = "runs" # metrics stream to sfm/<log_dir>/<exp_name>__<seed>__<time>/metrics.jsonl, plot with report.py
+    log_frequency: int = 100 # steps between metric flushes to the run log
 
 def make_env(env_id, idx, capture_video, run_name, gamma):
     def thunk():
@@ -127,7 +140,7 @@ class Actor(nn.Module):
         return action, log_prob, mean
 
 if __name__ == "__main__":
-    args = Args()
+    args = apply_overrides(Args())
     
     random.seed(args.seed)
     np.random.seed(args.seed)
@@ -140,7 +153,7 @@ if __name__ == "__main__":
     torch.set_default_tensor_type(torch.FloatTensor)
 
     envs = gym.vector.SyncVectorEnv(
-        [make_env(args.env_id, 0, args.capture_video, args.exp_name, args.gamma)]
+        [make_env(args.env_id, i, args.capture_video, args.exp_name, args.gamma) for i in range(args.num_envs)]
     )
     assert isinstance(envs.single_action_space, gym.spaces.Box), "only continuous action space is supported"
 
@@ -179,28 +192,33 @@ if __name__ == "__main__":
     else:
         alpha = args.alpha
 
-    rb = ReplayBuffer(
-        args.buffer_size,
-        envs.single_observation_space,
-        envs.single_action_space,
-        device,
-        handle_timeout_termination=False,
+    # n-step next observations are not the following row, so they cannot share storage
+    assert not (args.n_step > 1 and args.buffer_optimize_memory), "n_step > 1 needs buffer_optimize_memory=False"
+    buffer_kwargs = dict(
+        num_envs=args.num_envs,
+        storage_device=device if args.buffer_on_device else "cpu",
+        obs_dtype=torch.float16 if args.buffer_fp16_obs else torch.float32,
+        optimize_memory_usage=args.buffer_optimize_memory,
+        gamma=args.gamma,
     )
+    if args.prioritized_replay:
+        rb = PrioritizedReplayBuffer(args.buffer_size, envs.single_observation_space, envs.single_action_space, device,
+                                     alpha=args.per_alpha, beta=args.per_beta, eps=args.per_eps, **buffer_kwargs)
+    else:
+        rb = ReplayBuffer(args.buffer_size, envs.single_observation_space, envs.single_action_space, device, **buffer_kwargs)
+    n_step_buffer = NStepAccumulator(args.n_step, args.gamma, args.num_envs) if args.n_step > 1 else None
 
     # Start training
     start_time = time.time()
     obs, _ = envs.reset(seed=args.seed)
-    episodic_returns = []
-    episodic_lengths = []
-    q_values = []
-    actor_losses = []
-    alpha_losses = []
-    q_losses = []
-    sps_history = []
+    # losses stay on device and are averaged and synced once per log_frequency steps in metrics.flush()
+    run_dir = make_run_dir(os.path.join(os.getcwd(), 'sfm', args.log_dir), args.exp_name, args.seed)
+    logger = RunLogger(run_dir, config=args)
+    metrics = MetricsTracker(logger)
 
     for global_step in range(args.total_timesteps):
         if global_step < args.learning_starts:
-            actions = np.array([envs.single_action_space.sample()])
+            actions = envs.action_space.sample()
         else:
             actions, _, _ = actor.get_action(torch.Tensor(obs).to(device))
             actions = actions.detach().cpu().numpy()
@@ -211,39 +229,53 @@ if __name__ == "__main__":
             for info in infos["final_info"]:
                 if info and "episode" in info:
                     print(f"global_step={global_step}, episodic_return={info['episode']['r']}")
-                    episodic_returns.append(info["episode"]["r"])
-                    episodic_lengths.append(info["episode"]["l"])
+                    metrics.log_episode(global_step, info["episode"]["r"], info["episode"]["l"])
 
         real_next_obs = next_obs.copy()
         for idx, trunc in enumerate(truncations):
             if trunc:
                 real_next_obs[idx] = infos["final_observation"][idx]
 
-        rb.add(obs, real_next_obs, actions, rewards, terminations, infos)
+        if n_step_buffer is None:
+            rb.add(obs, real_next_obs, actions, rewards, terminations, truncations)
+        else:
+            for transition in n_step_buffer.push(obs, real_next_obs, actions, rewards, terminations, truncations):
+                rb.add(*transition)
         obs = next_obs
 
         if global_step > args.learning_starts:
-            data = rb.sample(args.batch_size)
+            if args.prioritized_replay:
+                rb.beta = args.per_beta + (1.0 - args.per_beta) * global_step / args.total_timesteps
+                data, is_weights, sampled_rows = rb.sample(args.batch_size)
+            else:
+                data = rb.sample(args.batch_size)
             
             with torch.no_grad():
                 next_state_actions, next_state_log_pi, _ = actor.get_action(data.next_observations)
                 qf1_next_target = qf1_target(data.next_observations, next_state_actions)
                 qf2_next_target = qf2_target(data.next_observations, next_state_actions)
                 min_qf_next_target = torch.min(qf1_next_target, qf2_next_target) - alpha * next_state_log_pi
-                next_q_value = data.rewards.flatten() + (1 - data.dones.flatten()) * args.gamma * (min_qf_next_target).view(-1)
+                next_q_value = data.rewards.flatten() + (1 - data.dones.flatten()) * data.discounts.flatten() * (min_qf_next_target).view(-1)
 
             qf1_a_values = qf1(data.observations, data.actions).view(-1)
             qf2_a_values = qf2(data.observations, data.actions).view(-1)
-            qf1_loss = F.mse_loss(qf1_a_values, next_q_value)
-            qf2_loss = F.mse_loss(qf2_a_values, next_q_value)
+            if args.prioritized_replay:
+                # importance weights correct for the non-uniform sampling, new priorities are the mean TD error
+                td1, td2 = qf1_a_values - next_q_value, qf2_a_values - next_q_value
+                qf1_loss = (is_weights.flatten() * td1.pow(2)).mean()
+                qf2_loss = (is_weights.flatten() * td2.pow(2)).mean()
+                rb.update_priorities(sampled_rows, 0.5 * (td1.abs() + td2.abs()))
+            else:
+                qf1_loss = F.mse_loss(qf1_a_values, next_q_value)
+                qf2_loss = F.mse_loss(qf2_a_values, next_q_value)
             qf_loss = qf1_loss + qf2_loss
 
             q_optimizer.zero_grad()
             qf_loss.backward()
             q_optimizer.step()
 
-            q_losses.append(qf_loss.item())
-            q_values.append(qf1_a_values.mean().item())
+            metrics.add("q_losses", qf_loss)
+            metrics.add("q_values", qf1_a_values.mean())
 
             if global_step % args.policy_frequency == 0:
                 for _ in range(args.policy_frequency):
@@ -257,7 +289,7 @@ if __name__ == "__main__":
                     actor_loss.backward()
                     actor_optimizer.step()
 
-                    actor_losses.append(actor_loss.item())
+                    metrics.add("actor_losses", actor_loss)
 
                     if args.autotune:
                         with torch.no_grad():
@@ -269,7 +301,8 @@ if __name__ == "__main__":
                         a_optimizer.step()
                         alpha = log_alpha.exp().item()
 
-                        alpha_losses.append(alpha_loss.item())
+                        metrics.add("alpha_losses", alpha_loss)
+                    metrics.set("alpha", alpha)
 
             if global_step % args.target_network_frequency == 0:
                 for param, target_param in zip(qf1.parameters(), qf1_target.parameters()):
@@ -277,12 +310,19 @@ if __name__ == "__main__":
                 for param, target_param in zip(qf2.parameters(), qf2_target.parameters()):
                     target_param.data.copy_(args.tau * param.data + (1 - args.tau) * target_param.data)
 
-        if global_step % 100 == 0:
+        if global_step % args.log_frequency == 0:
             sps = int(global_step / (time.time() - start_time))
-            sps_history.append(sps)
+            metrics.set("sps", sps)
+            metrics.flush(global_step=global_step)
             print(f"SPS: {sps}")
 
+    if n_step_buffer is not None:
+        # the last steps never saw n successors, store them with the horizon they have
+        for transition in n_step_buffer.flush():
+            rb.add(*transition)
     envs.close()
+    logger.close()
+    print(f"Run log written to {logger.path}")
 
     # Save the model
     save_dir = os.path.join(os.getcwd(), 'mvp', 'params')
@@ -13,11 +13,20 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.distributions import Normal
-import matplotlib.pyplot as plt
 from gymnasium.experimental.wrappers.rendering import RecordVideoV0 as RecordVideo
 from env_wrappers import (JumpRewardWrapper, TargetVelocityWrapper, DelayedRewardWrapper, MultiTimescaleWrapper, 
                           NoisyObservationWrapper, MultiStepTaskWrapper, PartialObservabilityWrapper, ActionMaskingWrapper,
                           NonLinearDynamicsWrapper, DelayedHalfCheetahEnv)
+from vec_env import make_vector_env
+from normalization import VectorNormalize, normalizer_path
+from gae import compute_gae
+from demonstrations import ImitationData
+from metrics import MetricsTracker
+from run_logger import RunLogger, make_run_dir
+from overrides import apply_overrides
+from fused_update import FusedStep, adam_kwargs
+from precision import autocast, loss_parity
+from inference import sample_gaussian, compile_act
 
 # need good data/consistent data in imitation learning process
 @dataclass
@@ -35,6 +44,11 @@ class Args:
     upn_hidden_layer: int = 64
     ppo_hidden_layer: int = 256
     num_envs: int = 1
+    vector_backend: str = "sync" # "sync" or "async" (subprocess per env, shared memory obs)
+    compile_act: bool = False # torch.compile the rollout act() path, see inference.py
+    fused_update: bool = False # one backward for all losses, per optimizer clipping in one foreach pass, fused/foreach Adam
+    compile_update: bool = False # with fused_update, torch.compile the clipping and the minibatch losses
+    precision: str = "fp32" # "bf16" autocasts the update phase (forward passes and losses), see precision.py
     num_steps: int = 2048
     anneal_lr: bool = True
     gamma: float = 0.99
@@ -53,6 +67,8 @@ class Args:
 
     # this helps greatly
     mix_coord: bool = False
+    imitation_ratio: float = None # share of each UPN batch from imitation data, None mixes by dataset size
+    imitation_on_device: bool = True # False keeps a pinned host copy instead
     
     # Data need to match up, this data may be problematic
     load_upn: str = None #"supp/supervised_diff_intention.pth" #"good/supervised_upn_good.pth" #"supervised_upn_new.pth"
@@ -61,15 +77,17 @@ class Args:
     imitation_data_path: str= "imitation_data_ppo_new.npz"
     save_sfm: str = "sfm/sfm_pretrain.pth"
     save_sfmppo: str = "sfmppo/sfmppo_pretrain.pth"
+    log_dir: str = "runs" # metrics stream to sfm/<log_dir>/<exp_name>__<seed>__<time>/metrics.jsonl, plot with report.py
 
     # to be set at runtime
     batch_size: int = 0 
     minibatch_size: int = 0
     iterations: int = 0
 
-args = Args()
+args = apply_overrides(Args())
 
-def make_env(env_id, idx, capture_video, run_name, gamma):
+def make_env(env_id, idx, capture_video, run_name, gamma, normalize=True):
+    '''normalize=False leaves observation/reward normalization to a VectorNormalize around the vector env'''
     def thunk():
         if capture_video and idx==0:
             env = gym.make(env_id, render_mode="rgb_array")
@@ -89,10 +107,11 @@ def make_env(env_id, idx, capture_video, run_name, gamma):
         env = gym.wrappers.FlattenObservation(env)  # deal with dm_control's Dict observation space
         env = gym.wrappers.RecordEpisodeStatistics(env)
         env = gym.wrappers.ClipAction(env)
-        env = gym.wrappers.NormalizeObservation(env)
-        env = gym.wrappers.TransformObservation(env, lambda obs: np.clip(obs, -10, 10))
-        env = gym.wrappers.NormalizeReward(env, gamma=gamma)
-        env = gym.wrappers.TransformReward(env, lambda reward: np.clip(reward, -10, 10))
+        if normalize:
+            env = gym.wrappers.NormalizeObservation(env)
+            env = gym.wrappers.TransformObservation(env, lambda obs: np.clip(obs, -10, 10))
+            env = gym.wrappers.NormalizeReward(env, gamma=gamma)
+            env = gym.wrappers.TransformReward(env, lambda reward: np.clip(reward, -10, 10))
         return env
     return thunk
 
@@ -150,8 +169,9 @@ class UPN(nn.Module):
             nn.Linear(args.upn_hidden_layer, action_dim)
         )
 
-    def forward(self, state, action, next_state):
-        z = self.encoder(state)
+    def forward(self, state, action, next_state, z=None):
+        if z is None:
+            z = self.encoder(state)
         z_next = self.encoder(next_state)
         z_pred = self.dynamics(torch.cat([z, action], dim=-1))
         action_pred = self.inverse_dynamics(torch.cat([z, z_next], dim=-1))
@@ -184,13 +204,20 @@ class Agent(nn.Module):
         )
         self.actor_logstd = nn.Parameter(torch.zeros(1, action_dim))
 
+    def encode(self, x):
+        '''UPN latent of x, computed once per minibatch and shared by the PPO and UPN losses'''
+        return self.upn.encoder(x)
+
     def get_value(self, x):
         z = self.upn.encoder(x)
         return self.critic(z)
 
-    def get_action_and_value(self, x, action=None):
-        z = self.upn.encoder(x)
-        action_mean = self.actor_mean(z)
+    def get_action_and_value(self, x, action=None, z=None):
+        if z is None:
+            z = self.upn.encoder(x)
+        # the networks may run under autocast, the distribution, the log probs and the value
+        # are kept in fp32 so the PPO ratio and losses are not computed from bf16 values
+        action_mean = self.actor_mean(z).float()
         action_logstd = self.actor_logstd.expand_as(action_mean)
         action_std = torch.exp(action_logstd)
         probs = Normal(action_mean, action_std)
@@ -198,8 +225,14 @@ class Agent(nn.Module):
         if action is None:
             action = probs.sample()
 
-        return action, probs.log_prob(action).sum(1), probs.entropy().sum(1), self.critic(z)
+        return action, probs.log_prob(action).sum(1), probs.entropy().sum(1), self.critic(z).float()
 
+    def act(self, x):
+        '''Rollout fast path of get_action_and_value: sampled action, its log prob and the value,
+        without the Normal object or the unused entropy, so it can go through torch.compile'''
+        z = self.upn.encoder(x)
+        action, logprob = sample_gaussian(self.actor_mean(z), self.actor_logstd)
+        return action, logprob, self.critic(z).flatten()
     
     def load_upn(self, file_path):
         '''Load only the UPN model parameters from the specified file path,
@@ -211,8 +244,10 @@ class Agent(nn.Module):
         else:
             print(f"No existing UPN model found at {file_path}, starting with new parameters.")
 
-def compute_upn_loss(upn, state, action, next_state):
-    z, z_next, z_pred, action_pred, state_recon, next_state_recon, next_state_pred = upn(state, action, next_state)
+def compute_upn_loss(upn, state, action, next_state, z=None):
+    # network outputs to fp32 before the loss math, see get_action_and_value
+    z, z_next, z_pred, action_pred, state_recon, next_state_recon, next_state_pred = \
+        (output.float() for output in upn(state, action, next_state, z=z))
     recon_loss = F.mse_loss(state_recon, state) + F.mse_loss(next_state_recon, next_state)
     consistency_loss = F.mse_loss(next_state_pred, next_state)
     forward_loss = F.mse_loss(z_pred, z_next.detach())
@@ -221,53 +256,78 @@ def compute_upn_loss(upn, state, action, next_state):
 
     return recon_loss, forward_loss, inverse_loss, consistency_loss
 
-def mixed_batch(ppo_states, ppo_actions, ppo_next_states):
-    '''3D: sample_size, env_dim, Dof_dim, no sample, concatination direclty'''
-
-    # Load imitation data
-    save_dir = os.path.join(os.getcwd(), 'sfm', 'data')
-    os.makedirs(save_dir, exist_ok=True)
-    data_path = os.path.join(save_dir, args.imitation_data_path)
-    imitation_data = np.load(data_path)
-    imitation_states = torch.FloatTensor(imitation_data['states']).to(device)
-    imitation_actions = torch.FloatTensor(imitation_data['actions']).to(device)
-    imitation_next_states = torch.FloatTensor(imitation_data['next_states']).to(device)
-
-    print(f'Mixing Imitation Data of Size: {imitation_states.shape[0]}')
-
-    # Ensure imitation data has the same 3D shape as PPO data
-    if imitation_states.dim() == 2:
-        imitation_states = imitation_states.unsqueeze(1)
-        imitation_actions = imitation_actions.unsqueeze(1)
-        imitation_next_states = imitation_next_states.unsqueeze(1)
-
-    # Combine PPO and imitation data
-    mixed_states = torch.cat([ppo_states, imitation_states], dim=0)
-    mixed_actions = torch.cat([ppo_actions, imitation_actions], dim=0)
-    mixed_next_states = torch.cat([ppo_next_states, imitation_next_states], dim=0)
+def compute_minibatch_losses(agent, obs, actions, logprobs, advantages, returns, values,
+                             obs_imitate, actions_imitate, next_obs_imitate):
+    """
+    PPO and UPN losses of one minibatch, plus the statistics the trainer logs. Pure tensor code
+    without host syncs, multiseed.py runs it per replica under vmap.
+    """
+    # Encode the minibatch once for every consumer. PPO gets a detached latent: its gradients
+    # into the UPN were always discarded by upn_optimizer.zero_grad() before the UPN step
+    if args.mix_coord:
+        with torch.no_grad():
+            z = agent.encode(obs)
+        z_imitate = agent.encode(obs_imitate)
+    else:
+        z_imitate = agent.encode(obs)
+        z = z_imitate.detach()
+
+    _, newlogprob, entropy, newvalue = agent.get_action_and_value(obs, actions, z=z)
+    logratio = newlogprob - logprobs
+    ratio = logratio.exp()
+
+    with torch.no_grad():
+        # calculate approx_kl http://joschu.net/blog/kl-approx.html
+        old_approx_kl = (-logratio).mean()
+        approx_kl = ((ratio - 1) - logratio).mean()
+        clipfrac = ((ratio - 1.0).abs() > args.clip_coef).float().mean()
+
+    if args.norm_adv:
+        advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+
+    pg_loss1 = -advantages * ratio
+    pg_loss2 = -advantages * torch.clamp(ratio, 1 - args.clip_coef, 1 + args.clip_coef)
+    pg_loss = torch.max(pg_loss1, pg_loss2).mean()
+
+    newvalue = newvalue.view(-1)
+    if args.clip_vloss:
+        v_loss_unclipped = (newvalue - returns) ** 2
+        v_clipped = values + torch.clamp(
+            newvalue - values,
+            -args.clip_coef,
+            args.clip_coef,
+        )
+        v_loss_clipped = (v_clipped - returns) ** 2
+        v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
+        v_loss = 0.5 * v_loss_max.mean()
+    else:
+        v_loss = 0.5 * ((newvalue - returns) ** 2).mean()
 
-    # Shuffle the combined data
-    shuffle_indices = torch.randperm(mixed_states.shape[0])
-    mixed_states = mixed_states[shuffle_indices]
-    mixed_actions = mixed_actions[shuffle_indices]
-    mixed_next_states = mixed_next_states[shuffle_indices]
+    entropy_loss = entropy.mean()
 
-    print(f'Total Mixed Imitation Data of Size: {mixed_states.shape[0]}')
+    # previously pass in obs twice, solidifies state
+    recon_loss, forward_loss, inverse_loss, consistency_loss = compute_upn_loss(agent.upn, obs_imitate, actions_imitate, next_obs_imitate, z=z_imitate) #future_states[mb_inds])
 
-    return mixed_states, mixed_actions, mixed_next_states
+    # with torch.no_grad():
+    upn_loss = recon_loss + forward_loss + inverse_loss + consistency_loss
+    upn_loss = upn_loss * args.upn_coef
 
-def plot_metrics(metrics, show_result=False):
-    plt.figure(figsize=(12, 8))
-    plt.clf()
-    plt.title("Training..." if not show_result else "Result")
-    plt.xlabel("Iteration")
-    plt.ylabel("Metrics")
+    ppo_loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
 
-    for key, values in metrics.items():
-        plt.plot(values, label=key)
+    stats = {
+        "value_losses": v_loss, "policy_losses": pg_loss, "upn_losses": upn_loss,
+        "forward_losses": forward_loss, "inverse_losses": inverse_loss, "recon_losses": recon_loss,
+        "consist_losses": consistency_loss, "entropies": entropy_loss, "approx_kls": approx_kl,
+        "clipfracs": clipfrac,
+    }
+    return ppo_loss, upn_loss, stats
 
-    plt.legend()
-    plt.pause(0.001)
+def ppo_parity_terms(agent, obs, actions, logprobs, *batch):
+    '''The PPO ratio and every loss of one minibatch, what loss_parity compares between fp32 and autocast'''
+    _, newlogprob, _, _ = agent.get_action_and_value(obs, actions)
+    _, _, stats = compute_minibatch_losses(agent, obs, actions, logprobs, *batch)
+    stats.pop("clipfracs")
+    return {"ratio": (newlogprob - logprobs).exp().mean(), **stats}
 
 if __name__ == "__main__":
     args.batch_size = args.num_steps * args.num_envs
@@ -281,10 +341,13 @@ if __name__ == "__main__":
 
     device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
 
-    envs = gym.vector.SyncVectorEnv(
-        [make_env(args.env_id, i, args.capture_video, args.exp_name, args.gamma) for i in range(args.num_envs)]
+    envs = make_vector_env(
+        [make_env(args.env_id, i, args.capture_video, args.exp_name, args.gamma, normalize=False) for i in range(args.num_envs)],
+        backend=args.vector_backend,
     )
+    envs = VectorNormalize(envs, gamma=args.gamma)
     assert isinstance(envs.single_action_space, gym.spaces.Box), "only continuous action space is supported"
+    assert args.precision in ("fp32", "bf16"), "the PPO update supports fp32 and bf16, fp16 would need loss scaling"
 
     agent = Agent(envs).to(device)
 
@@ -315,10 +378,20 @@ if __name__ == "__main__":
     ppo_optimizer = optim.Adam([
     {'params': agent.actor_mean.parameters()},
     {'params': agent.actor_logstd},
-    {'params': agent.critic.parameters()}], lr=args.ppo_learning_rate, eps=1e-5)
+    {'params': agent.critic.parameters()}], lr=args.ppo_learning_rate, eps=1e-5, **adam_kwargs(device, args.fused_update))
 
     # Optimizer for UPN
-    upn_optimizer = optim.Adam(agent.upn.parameters(), lr=args.upn_learning_rate, eps=1e-5)
+    upn_optimizer = optim.Adam(agent.upn.parameters(), lr=args.upn_learning_rate, eps=1e-5, **adam_kwargs(device, args.fused_update))
+
+    # PPO and UPN losses touch disjoint parameters, so one backward of their sum feeds both
+    fused_step = FusedStep([ppo_optimizer, upn_optimizer], [args.max_grad_norm, args.max_grad_norm], compile=args.compile_update)
+    minibatch_losses = torch.compile(compute_minibatch_losses) if args.fused_update and args.compile_update else compute_minibatch_losses
+
+    # Imitation data is read from disk once and sampled from every iteration
+    imitation_data = None
+    if args.mix_coord:
+        data_path = os.path.join(os.getcwd(), 'sfm', 'data', args.imitation_data_path)
+        imitation_data = ImitationData(data_path, device, on_device=args.imitation_on_device)
 
     # ALGO Logic: Storage setup
     obs = torch.zeros((args.num_steps, args.num_envs) + envs.single_observation_space.shape).to(device)
@@ -330,25 +403,17 @@ if __name__ == "__main__":
     # this is only for upn
     next_obs_all = torch.zeros((args.num_steps, args.num_envs) + envs.single_observation_space.shape).to(device)
 
+    # rollout policy, compiled into one graph with compile_act=True
+    act = compile_act(agent, args.compile_act)
+
     # Logging setup
     global_step = 0
     start_time = time.time()
-    metrics = {
-        "episodic_returns": [],
-        "episodic_lengths": [],
-        "learning_rates": [],
-        "value_losses": [],
-        "policy_losses": [],
-        "entropies": [],
-        "approx_kls": [],
-        "clipfracs": [],
-        "explained_variances": [],
-        "upn_losses": [],
-        "recon_losses":[],
-        "forward_losses":[],
-        "inverse_losses":[],
-        "consist_losses":[]
-    }
+    # per-iteration values stay on device and are synced once in metrics.flush(),
+    # then streamed to the run log, plot it offline with report.py
+    run_dir = make_run_dir(os.path.join(os.getcwd(), 'sfm', args.log_dir), args.exp_name, args.seed)
+    logger = RunLogger(run_dir, config=args)
+    metrics = MetricsTracker(logger)
 
     next_obs, _ = envs.reset(seed=args.seed)
     next_obs = torch.Tensor(next_obs).to(device)
@@ -360,7 +425,7 @@ if __name__ == "__main__":
             lrnow = frac * args.ppo_learning_rate
             ppo_optimizer.param_groups[0]["lr"] = lrnow
 
-        metrics["learning_rates"].append(ppo_optimizer.param_groups[0]["lr"])
+        metrics.set("learning_rates", ppo_optimizer.param_groups[0]["lr"])
 
         for step in range(0, args.num_steps):
             global_step += args.num_envs
@@ -368,8 +433,8 @@ if __name__ == "__main__":
             dones[step] = next_done
 
             with torch.no_grad():
-                action, logprob, _, value = agent.get_action_and_value(next_obs)
-                values[step] = value.flatten()
+                action, logprob, value = act(next_obs)
+                values[step] = value
             actions[step] = action
             logprobs[step] = logprob
 
@@ -383,27 +448,15 @@ if __name__ == "__main__":
                 for info in infos["final_info"]:
                     if info and "episode" in info:
                         print(f"global_step={global_step}, episodic_return={info['episode']['r']}")
-                        metrics["episodic_returns"].append(info["episode"]["r"])
-                        metrics["episodic_lengths"].append(info["episode"]["l"])
+                        metrics.log_episode(global_step, info["episode"]["r"], info["episode"]["l"])
 
         with torch.no_grad():
             next_value = agent.get_value(next_obs).reshape(1, -1)
-            advantages = torch.zeros_like(rewards).to(device)
-            lastgaelam = 0
-            for t in reversed(range(args.num_steps)):
-                if t == args.num_steps - 1:
-                    nextnonterminal = 1.0 - next_done
-                    nextvalues = next_value
-                else:
-                    nextnonterminal = 1.0 - dones[t + 1]
-                    nextvalues = values[t + 1]
-                delta = rewards[t] + args.gamma * nextvalues * nextnonterminal - values[t]
-                advantages[t] = lastgaelam = delta + args.gamma * args.gae_lambda * nextnonterminal * lastgaelam
-            returns = advantages + values
+            advantages, returns = compute_gae(rewards, values, dones, next_value, next_done, args.gamma, args.gae_lambda)
         
         if args.mix_coord:
             # mixing screw things up, isolate the problem bit by bit
-            obs_imitate, actions_imitate, next_obs_imitate = mixed_batch(obs, actions, next_obs_all)
+            obs_imitate, actions_imitate, next_obs_imitate = imitation_data.mixed_batch(obs, actions, next_obs_all, args.imitation_ratio)
         else:
             obs_imitate, actions_imitate, next_obs_imitate = obs, actions, next_obs_all
 
@@ -420,86 +473,62 @@ if __name__ == "__main__":
         b_actions_imitate = actions_imitate.reshape((-1,) + envs.single_action_space.shape)
         b_next_obs_imitate = next_obs_imitate.reshape((-1,) + envs.single_observation_space.shape) # previous error of passing the same obs help may be due to having 2 obs in action selection
         
+        if args.precision != "fp32" and iteration == 1:
+            # once per run: the UPN losses of the first batch in fp32 and under autocast
+            loss_parity(lambda: compute_upn_loss(agent.upn, b_obs_imitate, b_actions_imitate, b_next_obs_imitate),
+                        device, args.precision, names=["recon", "forward", "inverse", "consistency"])
+
+        if args.precision != "fp32" and iteration == 1:
+            # and the PPO ratio and losses of the first minibatch, computed in fp32 from the autocast networks
+            mb_inds = np.arange(args.minibatch_size)
+            loss_parity(lambda: ppo_parity_terms(
+                agent, b_obs[mb_inds], b_actions[mb_inds], b_logprobs[mb_inds], b_advantages[mb_inds],
+                b_returns[mb_inds], b_values[mb_inds],
+                b_obs_imitate[mb_inds], b_actions_imitate[mb_inds], b_next_obs_imitate[mb_inds]),
+                device, args.precision, atol=1e-3)
+
         b_inds = np.arange(args.batch_size)
-        clipfracs_batch = []
         for epoch in range(args.update_epochs):
             np.random.shuffle(b_inds)
             for start in range(0, args.batch_size, args.minibatch_size):
                 end = start + args.minibatch_size
                 mb_inds = b_inds[start:end]
 
-                _, newlogprob, entropy, newvalue = agent.get_action_and_value(b_obs[mb_inds], b_actions[mb_inds])
-                logratio = newlogprob - b_logprobs[mb_inds]
-                ratio = logratio.exp()
+                with autocast(device, args.precision):
+                    ppo_loss, upn_loss, stats = minibatch_losses(
+                        agent, b_obs[mb_inds], b_actions[mb_inds], b_logprobs[mb_inds], b_advantages[mb_inds],
+                        b_returns[mb_inds], b_values[mb_inds],
+                        b_obs_imitate[mb_inds], b_actions_imitate[mb_inds], b_next_obs_imitate[mb_inds])
+                metrics.add("clipfracs", stats.pop("clipfracs"))
 
-                with torch.no_grad():
-                    # calculate approx_kl http://joschu.net/blog/kl-approx.html
-                    old_approx_kl = (-logratio).mean()
-                    approx_kl = ((ratio - 1) - logratio).mean()
-                    clipfracs_batch += [((ratio - 1.0).abs() > args.clip_coef).float().mean().item()]
-                
-                # if args.target_kl is not None and approx_kl > args.target_kl:
+                # if args.target_kl is not None and stats["approx_kls"] > args.target_kl:
                 #     print(f"Early stopping at iteration {iteration} due to reaching target KL.")
                 #     break
 
-                mb_advantages = b_advantages[mb_inds]
-                if args.norm_adv:
-                    mb_advantages = (mb_advantages - mb_advantages.mean()) / (mb_advantages.std() + 1e-8)
-
-                pg_loss1 = -mb_advantages * ratio
-                pg_loss2 = -mb_advantages * torch.clamp(ratio, 1 - args.clip_coef, 1 + args.clip_coef)
-                pg_loss = torch.max(pg_loss1, pg_loss2).mean()
-
-                newvalue = newvalue.view(-1)
-                if args.clip_vloss:
-                    v_loss_unclipped = (newvalue - b_returns[mb_inds]) ** 2
-                    v_clipped = b_values[mb_inds] + torch.clamp(
-                        newvalue - b_values[mb_inds],
-                        -args.clip_coef,
-                        args.clip_coef,
-                    )
-                    v_loss_clipped = (v_clipped - b_returns[mb_inds]) ** 2
-                    v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
-                    v_loss = 0.5 * v_loss_max.mean()
+                if args.fused_update:
+                    fused_step(ppo_loss + upn_loss)
                 else:
-                    v_loss = 0.5 * ((newvalue - b_returns[mb_inds]) ** 2).mean()
-
-                entropy_loss = entropy.mean()
-
-                # previously pass in obs twice, solidifies state
-                recon_loss, forward_loss, inverse_loss, consistency_loss = compute_upn_loss(agent.upn, b_obs_imitate[mb_inds], b_actions_imitate[mb_inds], b_next_obs_imitate[mb_inds]) #future_states[mb_inds])
+                    # PPO backward pass and optimization
+                    ppo_optimizer.zero_grad()
+                    ppo_loss.backward()
+                    nn.utils.clip_grad_norm_(
+                        list(agent.actor_mean.parameters()) + 
+                        [agent.actor_logstd] + 
+                        list(agent.critic.parameters()), 
+                        args.max_grad_norm
+                    )
+                    ppo_optimizer.step()
 
-                # with torch.no_grad():
-                upn_loss = recon_loss + forward_loss + inverse_loss + consistency_loss
-                upn_loss = upn_loss * args.upn_coef
-                
-                loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef + upn_loss * args.upn_coef + args.kl_coef * approx_kl
-
-                ppo_loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
-                
-                # PPO backward pass and optimization
-                ppo_optimizer.zero_grad()
-                ppo_loss.backward()
-                nn.utils.clip_grad_norm_(
-                    list(agent.actor_mean.parameters()) + 
-                    [agent.actor_logstd] + 
-                    list(agent.critic.parameters()), 
-                    args.max_grad_norm
-                )
-                ppo_optimizer.step()
-
-                # UPN backward pass and optimization
-                upn_optimizer.zero_grad()
-                upn_loss.backward()
-                nn.utils.clip_grad_norm_(agent.upn.parameters(), args.max_grad_norm)
-                upn_optimizer.step()
+                    # UPN backward pass and optimization
+                    upn_optimizer.zero_grad()
+                    upn_loss.backward()
+                    nn.utils.clip_grad_norm_(agent.upn.parameters(), args.max_grad_norm)
+                    upn_optimizer.step()
 
                 # optimizer.zero_grad()
                 # loss.backward()
 
-                for name, param in agent.named_parameters():
-                    if param.grad is not None and (torch.isnan(param.grad).any() or torch.isinf(param.grad).any()):
-                        print(f"NaN or Inf detected in gradients of {name}")
+                metrics.check_grads(agent.named_parameters())
                 
                 # grad_norms = []
                 # for name, param in agent.named_parameters():
@@ -511,92 +540,21 @@ if __name__ == "__main__":
                 # # optimizer.step()
 
         # Logging
-        y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
-        var_y = np.var(y_true)
-        explained_var = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
-
-        metrics["value_losses"].append(v_loss.item())
-        metrics["policy_losses"].append(pg_loss.item())
-        metrics['upn_losses'].append(upn_loss.item())
-        metrics['forward_losses'].append(forward_loss.item())
-        metrics['inverse_losses'].append(inverse_loss.item())
-        metrics["recon_losses"].append(recon_loss.item())
-        metrics["consist_losses"].append(consistency_loss.item())
-        metrics["entropies"].append(entropy_loss.item())
-        metrics["approx_kls"].append(approx_kl.item())
-        metrics["clipfracs"].append(np.mean(clipfracs_batch))
-        metrics["explained_variances"].append(explained_var)
+        var_y = b_returns.var(unbiased=False)
+        explained_var = torch.where(var_y == 0, torch.full_like(var_y, float("nan")),
+                                    1 - (b_returns - b_values).var(unbiased=False) / var_y)
+
+        for key, value in stats.items():
+            metrics.set(key, value)
+        metrics.set("explained_variances", explained_var)
+        metrics.flush(global_step=global_step, iteration=iteration)
 
         sps = int(global_step / (time.time() - start_time))
-        print(f"SPS: {sps}")
+        print(f"SPS ({args.vector_backend}, {args.num_envs} envs): {sps}")
 
     envs.close()
-
-    # Plotting results
-    plt.figure(figsize=(20, 10))
-
-    plt.subplot(2, 3, 1)
-    plt.plot(metrics["episodic_returns"])
-
-    avg_interval = 50
-    # Ensure that metrics["episodic_returns"] is a 1D list or array
-    episodic_returns = np.array(metrics["episodic_returns"]).flatten()
-
-    # Now apply np.convolve to calculate the rolling average
-    if len(episodic_returns) >= avg_interval:
-        avg_returns = np.convolve(episodic_returns, np.ones(avg_interval) / avg_interval, mode='valid')
-        plt.plot(range(avg_interval - 1, len(episodic_returns)), avg_returns, label=f"{avg_interval}-Episode Average", color="orange")
-
-    plt.title('Episodic Returns')
-    plt.xlabel('Episode')
-    plt.ylabel('Return')
-
-    # plt.subplot(2, 3, 2)
-    # plt.plot(metrics["episodic_lengths"])
-    # plt.title('Episodic Lengths')
-    # plt.xlabel('Episode')
-    # plt.ylabel('Length')
-
-    plt.subplot(2, 3, 2)
-    plt.plot(metrics["approx_kls"])
-    plt.title('Approx KLs')
-    plt.xlabel('Episode')
-    plt.ylabel('Approx KLs')
-
-    plt.subplot(2, 3, 3)
-    plt.plot(metrics["learning_rates"])
-    plt.title('Learning Rate')
-    plt.xlabel('Iteration')
-    plt.ylabel('LR')
-
-    plt.subplot(2, 3, 4)
-    plt.plot(metrics["value_losses"], label='Value Loss')
-    plt.plot(metrics["policy_losses"], label='Policy Loss')
-    plt.plot(metrics["upn_losses"], label='UPN Loss')
-    plt.plot(metrics["forward_losses"], label='Forward Loss')
-    plt.plot(metrics["inverse_losses"], label='Inverse Loss')
-    plt.plot(metrics["recon_losses"], label='Reconstruction Loss')
-    plt.plot(metrics["consist_losses"], label='Consistency Loss')
-    plt.title('Losses')
-    plt.xlabel('Iteration')
-    plt.ylabel('Loss')
-    plt.legend()
-
-    plt.subplot(2, 3, 5)
-    plt.plot(metrics["entropies"])
-    plt.title('Entropy')
-    plt.xlabel('Iteration')
-    plt.ylabel('Entropy')
-
-    plt.subplot(2, 3, 6)
-    plt.plot(metrics["explained_variances"])
-    plt.title('Explained Variance')
-    plt.xlabel('Iteration')
-    plt.ylabel('Variance')
-
-    plt.tight_layout()
-    plt.savefig('sfmppo_results.png')
-    plt.show()
+    logger.close()
+    print(f"Run log written to {logger.path}, plot it with report.py")
 
     # Save the model
     save_dir = os.path.join(os.getcwd(), 'sfm', 'params')
@@ -607,6 +565,7 @@ if __name__ == "__main__":
 
     print('Saved at: ', data1_path)
     torch.save(agent.state_dict(), data1_path)
+    envs.save(normalizer_path(data1_path))
 
     print('Saved at: ', data2_path)
     torch.save(agent.upn.state_dict(), data2_path)
\ No newline at end of file
@@ -14,11 +14,18 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torch.utils.data import DataLoader, TensorDataset
 from torch.distributions import Normal
-import matplotlib.pyplot as plt
+from torch.func import functional_call, grad, vmap
+from torch.nn.utils import parameters_to_vector
 from gymnasium.experimental.wrappers.rendering import RecordVideoV0 as RecordVideo
 from env_wrappers import (JumpRewardWrapper, TargetVelocityWrapper, DelayedRewardWrapper, MultiTimescaleWrapper, 
                           NoisyObservationWrapper, MultiStepTaskWrapper, PartialObservabilityWrapper, ActionMaskingWrapper,
                           NonLinearDynamicsWrapper, DelayedHalfCheetahEnv)
+from vec_env import make_vector_env
+from gae import compute_gae
+from demonstrations import ImitationData
+from overrides import apply_overrides
+from metrics import MetricsTracker
+from run_logger import RunLogger, make_run_dir
 
 @dataclass
 class Args:
@@ -35,6 +42,7 @@ class Args:
     upn_hidden_layer: int = 64
     ppo_hidden_layer: int = 256
     num_envs: int = 1
+    vector_backend: str = "sync" # "sync" or "async" (subprocess per env, shared memory obs)
     num_steps: int = 2048
     anneal_lr: bool = True
     gamma: float = 0.99
@@ -51,6 +59,8 @@ class Args:
     kl_coef: float = 0.3
     target_kl: float = 0.01
     mix_coord: bool = True
+    imitation_ratio: float = None # share of each UPN batch from imitation data, None mixes by dataset size
+    imitation_on_device: bool = True # False keeps a pinned host copy instead
     
     load_upn: str = "supervised_upn_new.pth"
     load_sfmppo: str = None #"sfmppo/sfmppo_delay_sensory.pth"
@@ -59,16 +69,22 @@ class Args:
     save_sfmppo: str = "sfmppo/sfmppo_ewc.pth"
     
     ewc_lambda: float = 5000.0
+    ewc_online: bool = True # one decayed running Fisher and anchor across all tasks
+    ewc_decay: float = 0.9 # weight of the previous tasks' Fisher at each consolidation
+    ewc_storage_dtype: str = "bfloat16" # flat Fisher storage, "bfloat16", "float16" (saturates at 65504) or "float32", the anchor stays float32
     fisher_sample_size: int = 1000
+    fisher_empirical: bool = True # Fisher from stored actions, False resamples actions from the policy
+    fisher_chunk_size: int = 256 # per-sample gradients are computed this many samples at a time
     consolidation_step: int = 1000
     importance_threshold: float = 0.1
     ewc_task_sequence_dir: str = "ewc_task_data"
+    log_dir: str = "runs" # metrics stream to sfm/<log_dir>/<exp_name>__<seed>__<time>/metrics.jsonl, plot with report.py
     
     batch_size: int = 0 
     minibatch_size: int = 0
     iterations: int = 0
 
-args = Args()
+args = apply_overrides(Args())
 
 def make_env(env_id, idx, capture_video, run_name, gamma):
     def thunk():
@@ -120,8 +136,9 @@ class UPN(nn.Module):
             nn.Linear(args.upn_hidden_layer, action_dim)
         )
 
-    def forward(self, state, action, next_state):
-        z = self.encoder(state)
+    def forward(self, state, action, next_state, z=None):
+        if z is None:
+            z = self.encoder(state)
         z_next = self.encoder(next_state)
         z_pred = self.dynamics(torch.cat([z, action], dim=-1))
         action_pred = self.inverse_dynamics(torch.cat([z, z_next], dim=-1))
@@ -130,6 +147,23 @@ class UPN(nn.Module):
         next_state_recon = self.decoder(z_next)
         return z, z_next, z_pred, action_pred, state_recon, next_state_recon, next_state_pred
 
+def to_ewc_storage(vector):
+    '''Flat fp32 Fisher vector in args.ewc_storage_dtype, returns (stored, number of clamped entries).
+    Only the Fisher is compressed: it is a weight, so a rounding error scales the penalty slightly,
+    while the anchor is subtracted from the live parameters and has to stay fp32. Fisher entries grow
+    like 1/std^4 as actor_logstd falls and the online sum keeps growing, entries past the dtype's max
+    (65504 for float16, bfloat16 has fp32's range) saturate at the max: a single inf would turn
+    ewc_loss into inf/NaN.'''
+    storage_dtype = getattr(torch, args.ewc_storage_dtype)
+    limit = torch.finfo(storage_dtype).max
+    vector = vector.float()
+    saturated = int((vector.abs() > limit).sum())
+    if saturated:
+        print(f"EWC: {saturated} Fisher entries exceed the {args.ewc_storage_dtype} range, clamped to {limit:.4g}")
+    stored = vector.clamp(-limit, limit).to(storage_dtype)
+    assert torch.isfinite(stored).all(), "non-finite EWC state, the Fisher estimate itself is inf/NaN"
+    return stored, saturated
+
 class Agent(nn.Module):
     def __init__(self, envs):
         super().__init__()
@@ -155,13 +189,19 @@ class Agent(nn.Module):
         self.actor_logstd = nn.Parameter(torch.zeros(1, action_dim))
         self.fisher_info = None
         self.parameter_means = None
+        self.fisher_clamped = 0 # Fisher entries saturated by to_ewc_storage at the last consolidation
+
+    def encode(self, x):
+        '''UPN latent of x, computed once per minibatch and shared by the PPO and UPN losses'''
+        return self.upn.encoder(x)
 
     def get_value(self, x):
         z = self.upn.encoder(x)
         return self.critic(z)
 
-    def get_action_and_value(self, x, action=None):
-        z = self.upn.encoder(x)
+    def get_action_and_value(self, x, action=None, z=None):
+        if z is None:
+            z = self.upn.encoder(x)
         action_mean = self.actor_mean(z)
         action_logstd = self.actor_logstd.expand_as(action_mean)
         action_std = torch.exp(action_logstd)
@@ -171,41 +211,66 @@ class Agent(nn.Module):
         return action, probs.log_prob(action).sum(1), probs.entropy().sum(1), self.critic(z)
 
     def consolidate_weights(self, data_loader, num_samples):
-        '''Weight consolidation only happens for UPN, not full PPO'''
-        self.fisher_info = self.compute_fisher_matrix(data_loader, num_samples)
-        self.parameter_means = {name: param.data.clone() for name, param in self.upn.named_parameters()}
+        '''Weight consolidation only happens for UPN, not full PPO.
+
+        Fisher and anchor are kept as single flat vectors, the Fisher in args.ewc_storage_dtype and the
+        anchor in fp32. In online mode the Fisher is a running sum decayed by args.ewc_decay at every
+        consolidation, so one Fisher and one anchor cover every task seen so far, otherwise the last
+        task replaces them. The decayed sum is accumulated in fp32 and only then cast, see to_ewc_storage.'''
+        fisher = parameters_to_vector(self.compute_fisher_matrix(data_loader, num_samples).values()).float()
+        if args.ewc_online and self.fisher_info is not None:
+            fisher = args.ewc_decay * self.fisher_info.float() + fisher
+        self.fisher_info, self.fisher_clamped = to_ewc_storage(fisher)
+        self.parameter_means = parameters_to_vector(self.upn.parameters()).detach().float()
+
+    def compute_fisher_matrix(self, data_loader, num_samples, empirical=None, chunk_size=None):
+        '''Diagonal Fisher of the UPN parameters from true per-sample squared gradients of the policy
+        log-likelihood, computed with torch.func (vmap over grad) chunk_size samples at a time.
+        empirical=True uses the stored actions, False resamples actions from the current policy.
+        Only the encoder feeds the policy, the remaining UPN parameters get a zero Fisher.'''
+        empirical = args.fisher_empirical if empirical is None else empirical
+        chunk_size = args.fisher_chunk_size if chunk_size is None else chunk_size
+        was_training = self.training
+        self.eval()
+
+        encoder_params = {name: param.detach() for name, param in self.upn.encoder.named_parameters()}
+        action_std = self.actor_logstd.detach().exp()
+
+        def sample_log_prob(params, state, action):
+            z = functional_call(self.upn.encoder, params, (state.unsqueeze(0),))
+            # validate_args does data-dependent checks that vmap cannot trace
+            probs = Normal(self.actor_mean(z), action_std, validate_args=False)
+            return probs.log_prob(action.unsqueeze(0)).sum()
+
+        per_sample_grads = vmap(grad(sample_log_prob), in_dims=(None, 0, 0), chunk_size=chunk_size)
 
-    def compute_fisher_matrix(self, data_loader, num_samples):
-        '''Compute fisher matrix based on number of samples'''
         fisher_diagonals = {name: torch.zeros_like(param) for name, param in self.upn.named_parameters()}
-        self.eval()
         samples_processed = 0
         for states, actions, _, _, _, _ in data_loader:
             if samples_processed >= num_samples:
                 break
-            self.zero_grad()
-            _, log_probs, _, _ = self.get_action_and_value(states, actions)
-            log_prob_mean = log_probs.mean()
-            log_prob_mean.backward()
-            for name, param in self.upn.named_parameters():
-                if param.grad is not None:
-                    fisher_diagonals[name] += param.grad.data.pow(2)
+            states = states[:num_samples - samples_processed]
+            if empirical:
+                actions = actions[:states.size(0)]
+            else:
+                with torch.no_grad():
+                    actions, _, _, _ = self.get_action_and_value(states)
+            grads = per_sample_grads(encoder_params, states, actions.detach())
+            for name, sample_grads in grads.items():
+                fisher_diagonals[f"encoder.{name}"] += sample_grads.pow(2).sum(0)
             samples_processed += states.size(0)
         for name in fisher_diagonals:
-            fisher_diagonals[name] /= samples_processed
+            fisher_diagonals[name] /= max(samples_processed, 1)
+
+        self.train(was_training)
         return fisher_diagonals
 
     def ewc_loss(self):
-        # Ensure the tensor is created on the correct device
-        device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
-        ewc_loss = torch.tensor(0., device=device)
-        if self.fisher_info and self.parameter_means:
-            for name, param in self.upn.named_parameters():
-                mean = self.parameter_means.get(name, None)
-                fisher = self.fisher_info.get(name, None)
-                if mean is not None and fisher is not None:
-                    ewc_loss += (fisher * (param - mean).pow(2)).sum()
-        return ewc_loss
+        '''Quadratic penalty to the anchor as one flat-vector expression over all UPN parameters'''
+        if self.fisher_info is None or self.parameter_means is None:
+            return self.actor_logstd.new_zeros(())
+        params = parameters_to_vector(self.upn.parameters())
+        return (self.fisher_info * (params - self.parameter_means).square()).sum()
 
     def load_upn(self, file_path):
         if os.path.exists(file_path):
@@ -214,8 +279,8 @@ class Agent(nn.Module):
         else:
             print(f"No existing UPN model found at {file_path}, starting with new parameters.")
 
-def compute_upn_loss(upn, state, action, next_state):
-    z, z_next, z_pred, action_pred, state_recon, next_state_recon, next_state_pred = upn(state, action, next_state)
+def compute_upn_loss(upn, state, action, next_state, z=None):
+    z, z_next, z_pred, action_pred, state_recon, next_state_recon, next_state_pred = upn(state, action, next_state, z=z)
     recon_loss = F.mse_loss(state_recon, state) + F.mse_loss(next_state_recon, next_state)
     consistency_loss = F.mse_loss(next_state_pred, next_state)
     forward_loss = F.mse_loss(z_pred, z_next.detach())
@@ -223,41 +288,6 @@ def compute_upn_loss(upn, state, action, next_state):
     upn_loss = recon_loss + forward_loss + inverse_loss + consistency_loss
     return recon_loss, forward_loss, inverse_loss, consistency_loss
 
-def mixed_batch(ppo_states, ppo_actions, ppo_next_states):
-    '''3D: sample_size, env_dim, Dof_dim, no sample, concatination direclty'''
-
-    # Load imitation data
-    save_dir = os.path.join(os.getcwd(), 'sfm', 'data')
-    os.makedirs(save_dir, exist_ok=True)
-    data_path = os.path.join(save_dir, args.imitation_data_path)
-    imitation_data = np.load(data_path)
-    imitation_states = torch.FloatTensor(imitation_data['states']).to(device)
-    imitation_actions = torch.FloatTensor(imitation_data['actions']).to(device)
-    imitation_next_states = torch.FloatTensor(imitation_data['next_states']).to(device)
-
-    print(f'Mixing Imitation Data of Size: {imitation_states.shape[0]}')
-
-    # Ensure imitation data has the same 3D shape as PPO data
-    if imitation_states.dim() == 2:
-        imitation_states = imitation_states.unsqueeze(1)
-        imitation_actions = imitation_actions.unsqueeze(1)
-        imitation_next_states = imitation_next_states.unsqueeze(1)
-
-    # Combine PPO and imitation data
-    mixed_states = torch.cat([ppo_states, imitation_states], dim=0)
-    mixed_actions = torch.cat([ppo_actions, imitation_actions], dim=0)
-    mixed_next_states = torch.cat([ppo_next_states, imitation_next_states], dim=0)
-
-    # Shuffle the combined data
-    shuffle_indices = torch.randperm(mixed_states.shape[0])
-    mixed_states = mixed_states[shuffle_indices]
-    mixed_actions = mixed_actions[shuffle_indices]
-    mixed_next_states = mixed_next_states[shuffle_indices]
-
-    print(f'Total Mixed Imitation Data of Size: {mixed_states.shape[0]}')
-
-    return mixed_states, mixed_actions, mixed_next_states
-
 def save_checkpoint(agent, args, task_id, episode=None, final=False):
     checkpoint = {
         'model_state_dict': agent.state_dict(),
@@ -269,12 +299,23 @@ def save_checkpoint(agent, args, task_id, episode=None, final=False):
     path = os.path.join(args.ewc_task_sequence_dir, filename)
     torch.save(checkpoint, path)
 
+def flatten_ewc_state(agent, state, compress=True):
+    '''Older checkpoints store per-parameter dicts, convert them to the flat layout. compress=True
+    casts to the Fisher storage dtype, False (the anchor) upcasts to fp32, also undoing the float16
+    anchors older checkpoints were saved with'''
+    if isinstance(state, dict):
+        state = parameters_to_vector([state[name] for name, _ in agent.upn.named_parameters()])
+    if state is not None:
+        state = to_ewc_storage(state)[0] if compress else state.float()
+        state = state.to(agent.actor_logstd.device)
+    return state
+
 def load_checkpoint(agent, checkpoint_path):
     if os.path.exists(checkpoint_path):
         checkpoint = torch.load(checkpoint_path)
         agent.load_state_dict(checkpoint['model_state_dict'])
-        agent.fisher_info = checkpoint.get('fisher_info')
-        agent.parameter_means = checkpoint.get('parameter_means')
+        agent.fisher_info = flatten_ewc_state(agent, checkpoint.get('fisher_info'))
+        agent.parameter_means = flatten_ewc_state(agent, checkpoint.get('parameter_means'), compress=False)
         print(f"Loaded model and EWC data from {checkpoint_path}")
 
 # Start the full training
@@ -290,8 +331,9 @@ if __name__ == "__main__":
 
     device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
 
-    envs = gym.vector.SyncVectorEnv(
-        [make_env(args.env_id, i, args.capture_video, args.exp_name, args.gamma) for i in range(args.num_envs)]
+    envs = make_vector_env(
+        [make_env(args.env_id, i, args.capture_video, args.exp_name, args.gamma) for i in range(args.num_envs)],
+        backend=args.vector_backend,
     )
 
     agent = Agent(envs).to(device)
@@ -325,6 +367,12 @@ if __name__ == "__main__":
     # Optimizer for UPN
     upn_optimizer = optim.Adam(agent.upn.parameters(), lr=args.upn_learning_rate, eps=1e-5)
 
+    # Imitation data is read from disk once and sampled from every iteration
+    imitation_data = None
+    if args.mix_coord:
+        data_path = os.path.join(os.getcwd(), 'sfm', 'data', args.imitation_data_path)
+        imitation_data = ImitationData(data_path, device, on_device=args.imitation_on_device)
+
     # ALGO Logic: Storage setup
     obs = torch.zeros((args.num_steps, args.num_envs) + envs.single_observation_space.shape).to(device)
     actions = torch.zeros((args.num_steps, args.num_envs) + envs.single_action_space.shape).to(device)
@@ -338,23 +386,11 @@ if __name__ == "__main__":
     # Logging setup
     global_step = 0
     start_time = time.time()
-    metrics = {
-        "episodic_returns": [],
-        "episodic_lengths": [],
-        "learning_rates": [],
-        "value_losses": [],
-        "policy_losses": [],
-        "entropies": [],
-        "approx_kls": [],
-        "clipfracs": [],
-        "explained_variances": [],
-        "upn_losses": [],
-        "recon_losses":[],
-        "forward_losses":[],
-        "inverse_losses":[],
-        "consist_losses":[],
-        "ewc_losses":[]
-    }
+    # per-iteration values stay on device and are synced once in metrics.flush(),
+    # then streamed to the run log, plot it offline with report.py
+    run_dir = make_run_dir(os.path.join(os.getcwd(), 'sfm', args.log_dir), args.exp_name, args.seed)
+    logger = RunLogger(run_dir, config=args)
+    metrics = MetricsTracker(logger)
 
     next_obs, _ = envs.reset(seed=args.seed)
     next_obs = torch.Tensor(next_obs).to(device)
@@ -366,7 +402,7 @@ if __name__ == "__main__":
             lrnow = frac * args.ppo_learning_rate
             ppo_optimizer.param_groups[0]["lr"] = lrnow
 
-        metrics["learning_rates"].append(ppo_optimizer.param_groups[0]["lr"])
+        metrics.set("learning_rates", ppo_optimizer.param_groups[0]["lr"])
 
         for step in range(0, args.num_steps):
             global_step += args.num_envs
@@ -389,27 +425,15 @@ if __name__ == "__main__":
                 for info in infos["final_info"]:
                     if info and "episode" in info:
                         print(f"global_step={global_step}, episodic_return={info['episode']['r']}")
-                        metrics["episodic_returns"].append(info["episode"]["r"])
-                        metrics["episodic_lengths"].append(info["episode"]["l"])
+                        metrics.log_episode(global_step, info["episode"]["r"], info["episode"]["l"])
 
         with torch.no_grad():
             next_value = agent.get_value(next_obs).reshape(1, -1)
-            advantages = torch.zeros_like(rewards).to(device)
-            lastgaelam = 0
-            for t in reversed(range(args.num_steps)):
-                if t == args.num_steps - 1:
-                    nextnonterminal = 1.0 - next_done
-                    nextvalues = next_value
-                else:
-                    nextnonterminal = 1.0 - dones[t + 1]
-                    nextvalues = values[t + 1]
-                delta = rewards[t] + args.gamma * nextvalues * nextnonterminal - values[t]
-                advantages[t] = lastgaelam = delta + args.gamma * args.gae_lambda * nextnonterminal * lastgaelam
-            returns = advantages + values
+            advantages, returns = compute_gae(rewards, values, dones, next_value, next_done, args.gamma, args.gae_lambda)
         
         if args.mix_coord:
             # mixing screw things up, isolate the problem bit by bit
-            obs_imitate, actions_imitate, next_obs_imitate = mixed_batch(obs, actions, next_obs_all)
+            obs_imitate, actions_imitate, next_obs_imitate = imitation_data.mixed_batch(obs, actions, next_obs_all, args.imitation_ratio)
         else:
             obs_imitate, actions_imitate, next_obs_imitate = obs, actions, next_obs_all
 
@@ -427,14 +451,23 @@ if __name__ == "__main__":
         b_next_obs_imitate = next_obs_imitate.reshape((-1,) + envs.single_observation_space.shape) # previous error of passing the same obs help may be due to having 2 obs in action selection
         
         b_inds = np.arange(args.batch_size)
-        clipfracs_batch = []
         for epoch in range(args.update_epochs):
             np.random.shuffle(b_inds)
             for start in range(0, args.batch_size, args.minibatch_size):
                 end = start + args.minibatch_size
                 mb_inds = b_inds[start:end]
 
-                _, newlogprob, entropy, newvalue = agent.get_action_and_value(b_obs[mb_inds], b_actions[mb_inds])
+                # Encode the minibatch once for every consumer. PPO gets a detached latent: its gradients
+                # into the UPN were always discarded by upn_optimizer.zero_grad() before the UPN step
+                if args.mix_coord:
+                    with torch.no_grad():
+                        z = agent.encode(b_obs[mb_inds])
+                    z_imitate = agent.encode(b_obs_imitate[mb_inds])
+                else:
+                    z_imitate = agent.encode(b_obs[mb_inds])
+                    z = z_imitate.detach()
+
+                _, newlogprob, entropy, newvalue = agent.get_action_and_value(b_obs[mb_inds], b_actions[mb_inds], z=z)
                 logratio = newlogprob - b_logprobs[mb_inds]
                 ratio = logratio.exp()
 
@@ -442,7 +475,7 @@ if __name__ == "__main__":
                     # calculate approx_kl http://joschu.net/blog/kl-approx.html
                     old_approx_kl = (-logratio).mean()
                     approx_kl = ((ratio - 1) - logratio).mean()
-                    clipfracs_batch += [((ratio - 1.0).abs() > args.clip_coef).float().mean().item()]
+                    metrics.add("clipfracs", ((ratio - 1.0).abs() > args.clip_coef).float().mean())
                 
                 # if args.target_kl is not None and approx_kl > args.target_kl:
                 #     print(f"Early stopping at iteration {iteration} due to reaching target KL.")
@@ -473,7 +506,7 @@ if __name__ == "__main__":
                 entropy_loss = entropy.mean()
 
                 # previously pass in obs twice, solidifies state
-                recon_loss, forward_loss, inverse_loss, consistency_loss = compute_upn_loss(agent.upn, b_obs_imitate[mb_inds], b_actions_imitate[mb_inds], b_next_obs_imitate[mb_inds]) #future_states[mb_inds])
+                recon_loss, forward_loss, inverse_loss, consistency_loss = compute_upn_loss(agent.upn, b_obs_imitate[mb_inds], b_actions_imitate[mb_inds], b_next_obs_imitate[mb_inds], z=z_imitate) #future_states[mb_inds])
 
                 # with torch.no_grad():
                 upn_loss = recon_loss + forward_loss + inverse_loss + consistency_loss
@@ -525,94 +558,31 @@ if __name__ == "__main__":
                 # # optimizer.step()
 
         # Logging
-        y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
-        var_y = np.var(y_true)
-        explained_var = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
-
-        metrics["value_losses"].append(v_loss.item())
-        metrics["policy_losses"].append(pg_loss.item())
-        metrics['upn_losses'].append(upn_loss.item())
-        metrics['forward_losses'].append(forward_loss.item())
-        metrics['inverse_losses'].append(inverse_loss.item())
-        metrics["recon_losses"].append(recon_loss.item())
-        metrics["consist_losses"].append(consistency_loss.item())
-        metrics["entropies"].append(entropy_loss.item())
-        metrics["approx_kls"].append(approx_kl.item())
-        metrics["clipfracs"].append(np.mean(clipfracs_batch))
-        metrics["explained_variances"].append(explained_var)
-        metrics["ewc_losses"].append(ewc_loss.item())
+        var_y = b_returns.var(unbiased=False)
+        explained_var = torch.where(var_y == 0, torch.full_like(var_y, float("nan")),
+                                    1 - (b_returns - b_values).var(unbiased=False) / var_y)
+
+        metrics.set("value_losses", v_loss)
+        metrics.set("policy_losses", pg_loss)
+        metrics.set("upn_losses", upn_loss)
+        metrics.set("forward_losses", forward_loss)
+        metrics.set("inverse_losses", inverse_loss)
+        metrics.set("recon_losses", recon_loss)
+        metrics.set("consist_losses", consistency_loss)
+        metrics.set("entropies", entropy_loss)
+        metrics.set("approx_kls", approx_kl)
+        metrics.set("explained_variances", explained_var)
+        metrics.set("ewc_losses", ewc_loss)
+        if agent.fisher_info is not None:
+            metrics.set("ewc_fisher_clamped", agent.fisher_clamped)
+        metrics.flush(global_step=global_step, iteration=iteration)
 
         sps = int(global_step / (time.time() - start_time))
-        print(f"SPS: {sps}")
+        print(f"SPS ({args.vector_backend}, {args.num_envs} envs): {sps}")
 
     envs.close()
-
-    # Plotting results
-    plt.figure(figsize=(20, 10))
-
-    plt.subplot(2, 3, 1)
-    plt.plot(metrics["episodic_returns"])
-
-    avg_interval = 50
-    # Ensure that metrics["episodic_returns"] is a 1D list or array
-    episodic_returns = np.array(metrics["episodic_returns"]).flatten()
-
-    # Now apply np.convolve to calculate the rolling average
-    if len(episodic_returns) >= avg_interval:
-        avg_returns = np.convolve(episodic_returns, np.ones(avg_interval) / avg_interval, mode='valid')
-        plt.plot(range(avg_interval - 1, len(episodic_returns)), avg_returns, label=f"{avg_interval}-Episode Average", color="orange")
-
-    plt.title('Episodic Returns')
-    plt.xlabel('Episode')
-    plt.ylabel('Return')
-
-    # plt.subplot(2, 3, 2)
-    # plt.plot(metrics["episodic_lengths"])
-    # plt.title('Episodic Lengths')
-    # plt.xlabel('Episode')
-    # plt.ylabel('Length')
-
-    plt.subplot(2, 3, 2)
-    plt.plot(metrics["approx_kls"])
-    plt.title('Approx KLs')
-    plt.xlabel('Episode')
-    plt.ylabel('Approx KLs')
-
-    plt.subplot(2, 3, 3)
-    plt.plot(metrics["learning_rates"])
-    plt.title('Learning Rate')
-    plt.xlabel('Iteration')
-    plt.ylabel('LR')
-
-    plt.subplot(2, 3, 4)
-    plt.plot(metrics["value_losses"], label='Value Loss')
-    plt.plot(metrics["policy_losses"], label='Policy Loss')
-    plt.plot(metrics["upn_losses"], label='UPN Loss')
-    plt.plot(metrics["forward_losses"], label='Forward Loss')
-    plt.plot(metrics["inverse_losses"], label='Inverse Loss')
-    plt.plot(metrics["recon_losses"], label='Reconstruction Loss')
-    plt.plot(metrics["consist_losses"], label='Consistency Loss')
-    plt.plot(metrics["ewc_losses"], label='EWC Loss')
-    plt.title('Losses')
-    plt.xlabel('Iteration')
-    plt.ylabel('Loss')
-    plt.legend()
-
-    plt.subplot(2, 3, 5)
-    plt.plot(metrics["entropies"])
-    plt.title('Entropy')
-    plt.xlabel('Iteration')
-    plt.ylabel('Entropy')
-
-    plt.subplot(2, 3, 6)
-    plt.plot(metrics["explained_variances"])
-    plt.title('Explained Variance')
-    plt.xlabel('Iteration')
-    plt.ylabel('Variance')
-
-    plt.tight_layout()
-    plt.savefig('ewc_sfmppo_results.png')
-    plt.show()
+    logger.close()
+    print(f"Run log written to {logger.path}, plot it with report.py")
 
     # Save the model
     save_dir = os.path.join(os.getcwd(), 'sfm', 'params')
@@ -1,4 +1,5 @@
 import os
+import math
 import time
 import random
 import re
@@ -14,12 +15,18 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torch.distributions import Normal
 
-from scipy.optimize import minimize
-import matplotlib.pyplot as plt
 from gymnasium.experimental.wrappers.rendering import RecordVideoV0 as RecordVideo
 from env_wrappers import (JumpRewardWrapper, TargetVelocityWrapper, DelayedRewardWrapper, MultiTimescaleWrapper, 
                           NoisyObservationWrapper, MultiStepTaskWrapper, PartialObservabilityWrapper, ActionMaskingWrapper,
                           NonLinearDynamicsWrapper, DelayedHalfCheetahEnv)
+from vec_env import make_vector_env
+from normalization import VectorNormalize, normalizer_path
+from gae import compute_gae
+from demonstrations import ImitationData
+from overrides import apply_overrides
+from fused_update import FusedStep, adam_kwargs
+from metrics import MetricsTracker
+from run_logger import RunLogger, make_run_dir
 
 @dataclass
 class Args:
@@ -36,6 +43,9 @@ class Args:
     upn_hidden_layer: int = 64
     ppo_hidden_layer: int = 256
     num_envs: int = 1
+    vector_backend: str = "sync" # "sync" or "async" (subprocess per env, shared memory obs)
+    fused_update: bool = False # one backward for all losses, per optimizer clipping in one foreach pass, fused/foreach Adam
+    compile_update: bool = False # with fused_update, torch.compile the gradient clipping
     num_steps: int = 2048
     anneal_lr: bool = True
     gamma: float = 0.99
@@ -55,12 +65,15 @@ class Args:
     # what's good for suboptimal
     epsilon_k: float = 0.01
     eta_k: float = 1.0
+    optimize_eta_k: bool = False # solve the eta_k dual every minibatch instead of using the fixed eta_k
 
     # when constrain_weights = 0, no constrain on MOMPO constrain
     constrain_weights: float = 0.8
 
     # this helps greatly
     mix_coord: bool = False
+    imitation_ratio: float = None # share of each UPN batch from imitation data, None mixes by dataset size
+    imitation_on_device: bool = True # False keeps a pinned host copy instead
     
     # Data need to match up, this data may be problematic
     load_upn: str = "supp/supervised_vae_jump.pth"
@@ -69,15 +82,17 @@ class Args:
     imitation_data_path: str= None #"imitation_data_ppo_new.npz"
     save_sfm: str = "sfm/sfm_try.pth"
     save_sfmppo: str = "sfmppo/sfmppo_try.pth"
+    log_dir: str = "runs" # metrics stream to sfm/<log_dir>/<exp_name>__<seed>__<time>/metrics.jsonl, plot with report.py
 
     # to be set at runtime
     batch_size: int = 0 
     minibatch_size: int = 0
     iterations: int = 0
 
-args = Args()
+args = apply_overrides(Args())
 
-def make_env(env_id, idx, capture_video, run_name, gamma):
+def make_env(env_id, idx, capture_video, run_name, gamma, normalize=True):
+    '''normalize=False leaves observation/reward normalization to a VectorNormalize around the vector env'''
     def thunk():
         if capture_video and idx==0:
             env = gym.make(env_id, render_mode="rgb_array")
@@ -97,10 +112,11 @@ def make_env(env_id, idx, capture_video, run_name, gamma):
         env = gym.wrappers.FlattenObservation(env)  # deal with dm_control's Dict observation space
         env = gym.wrappers.RecordEpisodeStatistics(env)
         env = gym.wrappers.ClipAction(env)
-        env = gym.wrappers.NormalizeObservation(env)
-        env = gym.wrappers.TransformObservation(env, lambda obs: np.clip(obs, -10, 10))
-        env = gym.wrappers.NormalizeReward(env, gamma=gamma)
-        env = gym.wrappers.TransformReward(env, lambda reward: np.clip(reward, -10, 10))
+        if normalize:
+            env = gym.wrappers.NormalizeObservation(env)
+            env = gym.wrappers.TransformObservation(env, lambda obs: np.clip(obs, -10, 10))
+            env = gym.wrappers.NormalizeReward(env, gamma=gamma)
+            env = gym.wrappers.TransformReward(env, lambda reward: np.clip(reward, -10, 10))
         return env
     return thunk
 
@@ -178,10 +194,13 @@ class UPN(nn.Module):
         h = self.encoder(x)
         return self.enc_mean(h), self.enc_logvar(h)
 
-    def forward(self, state, action, next_state):
-        # Encode current state
-        mu, logvar = self.encode(state)
-        z = self.reparameterize(mu, logvar)
+    def forward(self, state, action, next_state, encoded=None):
+        # Encode current state, unless the caller already did (mu, logvar, z)
+        if encoded is None:
+            mu, logvar = self.encode(state)
+            z = self.reparameterize(mu, logvar)
+        else:
+            mu, logvar, z = encoded
         
         # Encode next state
         mu_next, logvar_next = self.encode(next_state)
@@ -242,9 +261,16 @@ class Agent(nn.Module):
         z = self.upn.reparameterize(mu, logvar)
         return self.critic(z)
 
-    def get_action_and_value(self, x, action=None):
+    def encode(self, x):
+        '''mu, logvar and a reparameterized z of x, computed once per minibatch and shared by
+        the PPO loss, the UPN loss and the KL constraint terms'''
         mu, logvar = self.upn.encode(x)
-        z = self.upn.reparameterize(mu, logvar)
+        return mu, logvar, self.upn.reparameterize(mu, logvar)
+
+    def get_action_and_value(self, x, action=None, z=None):
+        if z is None:
+            mu, logvar = self.upn.encode(x)
+            z = self.upn.reparameterize(mu, logvar)
         action_mean = self.actor_mean(z)
         action_logstd = self.actor_logstd.expand_as(action_mean)
         action_std = torch.exp(action_logstd)
@@ -287,20 +313,19 @@ class Agent(nn.Module):
         else:
             print(f"No existing PPO model found at {file_path}, starting with new parameters.")
 
-def compute_intention_action_distribution(agent, state, advantage, epsilon_k):
+def compute_intention_action_distribution(agent, state, advantage, epsilon_k, z=None):
     """
     Compute the softened intention policy distribution (optimal action distribution) based on the current base policy and advantage values.
     This approximates the EM algorithm's expectation step, adjusting the policy softly towards higher-advantage actions.
     """
     with torch.no_grad():
-        mu, logvar = agent.upn.encode(state)
-        z = agent.upn.reparameterize(mu, logvar)
+        if z is None:
+            mu, logvar = agent.upn.encode(state)
+            z = agent.upn.reparameterize(mu, logvar)
         action_mean, action_std = agent.actor_mean(z), agent.actor_logstd.exp()
         base_dist = Normal(action_mean, action_std)
-        # eta_k = optimize_eta_k(state, advantage, base_dist, epsilon_k)
-        # print(eta_k)
-
-        eta_k = args.eta_k
+        # Solve the temperature dual for this minibatch, or keep it fixed
+        eta_k = optimize_eta_k(advantage, epsilon_k) if args.optimize_eta_k else args.eta_k
 
         # Softened intention distribution using advantage weights
         weights = (advantage.view(-1, 1) / eta_k).exp()
@@ -311,13 +336,14 @@ def compute_intention_action_distribution(agent, state, advantage, epsilon_k):
     return intention_dist, eta_k
 
 
-def compute_lagrangian_kl_constraint(agent, state, eta_k, epsilon_k, intention_dist):
+def compute_lagrangian_kl_constraint(agent, state, eta_k, epsilon_k, intention_dist, z=None):
     """Compute KL divergence between optimal "soften" intention disytribution and current base control policy distribution"""
     with torch.no_grad():
         # is this still needed?
         # action_latent_mean, action_latent_var = agent.get_transformed_action_distribution(z)
-        mu, logvar = agent.upn.encode(state)
-        z = agent.upn.reparameterize(mu, logvar)
+        if z is None:
+            mu, logvar = agent.upn.encode(state)
+            z = agent.upn.reparameterize(mu, logvar)
         action_mean, action_std = agent.actor_mean(z), agent.actor_logstd.exp()
         ppo_dist = Normal(action_mean, torch.exp(action_std))
         kl_div = torch.distributions.kl_divergence(intention_dist, ppo_dist).mean()
@@ -326,10 +352,10 @@ def compute_lagrangian_kl_constraint(agent, state, eta_k, epsilon_k, intention_d
     return eta_k * constraint_violation
 
 
-def compute_upn_loss(upn, state, action, next_state):
+def compute_upn_loss(upn, state, action, next_state, encoded=None):
     '''Compute sololy UPN losses'''
     z, z_next, z_pred, action_pred, state_recon, next_state_recon, next_state_pred, \
-        mu, logvar, mu_next, logvar_next = upn(state, action, next_state)
+        mu, logvar, mu_next, logvar_next = upn(state, action, next_state, encoded=encoded)
     
     recon_loss = F.mse_loss(state_recon, state) + F.mse_loss(next_state_recon, next_state)
     consistency_loss = F.mse_loss(next_state_pred, next_state)
@@ -338,87 +364,41 @@ def compute_upn_loss(upn, state, action, next_state):
 
     return recon_loss, forward_loss, inverse_loss, consistency_loss
 
-def eta_k_objective(eta, states, advantages, old_policy, epsilon_k):
+def eta_k_dual(eta, advantages, epsilon_k):
     """
-    Objective function for optimizing eta_k.
+    Dual of the KL-constrained E-step, g(eta) = eta * epsilon_k + eta * log mean_i exp(A_i / eta),
+    evaluated for all states in one log-sum-exp. Differentiable in eta through autograd.
     """
-    eta = eta[0]  # extract scalar from array input by scipy
-    log_expectation_sum = 0
+    advantages = advantages.reshape(-1)
+    log_mean_exp = torch.logsumexp(advantages / eta, dim=0) - math.log(advantages.numel())
+    return eta * epsilon_k + eta * log_mean_exp
 
-    with torch.no_grad():
-        for i, state in enumerate(states):
-            # Sample actions from the old policy distribution
-            action_mean, action_std = old_policy.mean[i], old_policy.stddev[i]
-            action_dist = Normal(action_mean, action_std)
-            sampled_actions = action_dist.sample((10,))  # Sample 10 actions per state
-
-            # Compute the exponentiated advantage divided by eta
-            exp_adv_scaled = (advantages[i] / eta).exp()
-            weighted_adv = exp_adv_scaled * action_dist.log_prob(sampled_actions).exp()
-            log_expectation = torch.log(weighted_adv.mean())
-            log_expectation_sum += log_expectation.item()
-        
-    # Compute the full objective
-    objective_value = eta * epsilon_k + eta * (log_expectation_sum / len(states))
-    return objective_value
 
-def optimize_eta_k(states, advantages, old_policy, epsilon_k):
+def eta_k_dual_grad(eta, advantages, epsilon_k):
     """
-    Optimize eta_k using scipy's minimize function.
+    Closed form dg/deta = epsilon_k + log mean exp(A / eta) - E_w[A] / eta, with w = softmax(A / eta).
     """
-    # Initial guess for eta
-    eta_initial = 1.0
-    result = minimize(eta_k_objective, [eta_initial], args=(states, advantages, old_policy, epsilon_k),
-                      bounds=[(1e-3, None)], method="L-BFGS-B")  # Ensure eta is positive
-    return result.x[0]  # Optimized eta_k
-
-def mixed_batch(ppo_states, ppo_actions, ppo_next_states):
-    '''3D: sample_size, env_dim, Dof_dim, no sample, concatination direclty'''
-
-    # Load imitation data
-    save_dir = os.path.join(os.getcwd(), 'sfm', 'data')
-    os.makedirs(save_dir, exist_ok=True)
-    data_path = os.path.join(save_dir, args.imitation_data_path)
-    imitation_data = np.load(data_path)
-    imitation_states = torch.FloatTensor(imitation_data['states']).to(device)
-    imitation_actions = torch.FloatTensor(imitation_data['actions']).to(device)
-    imitation_next_states = torch.FloatTensor(imitation_data['next_states']).to(device)
-
-    print(f'Mixing Imitation Data of Size: {imitation_states.shape[0]}')
-
-    # Ensure imitation data has the same 3D shape as PPO data
-    if imitation_states.dim() == 2:
-        imitation_states = imitation_states.unsqueeze(1)
-        imitation_actions = imitation_actions.unsqueeze(1)
-        imitation_next_states = imitation_next_states.unsqueeze(1)
-
-    # Combine PPO and imitation data
-    mixed_states = torch.cat([ppo_states, imitation_states], dim=0)
-    mixed_actions = torch.cat([ppo_actions, imitation_actions], dim=0)
-    mixed_next_states = torch.cat([ppo_next_states, imitation_next_states], dim=0)
-
-    # Shuffle the combined data
-    shuffle_indices = torch.randperm(mixed_states.shape[0])
-    mixed_states = mixed_states[shuffle_indices]
-    mixed_actions = mixed_actions[shuffle_indices]
-    mixed_next_states = mixed_next_states[shuffle_indices]
+    advantages = advantages.reshape(-1)
+    scaled = advantages / eta
+    log_mean_exp = torch.logsumexp(scaled, dim=0) - math.log(advantages.numel())
+    weighted_adv = (torch.softmax(scaled, dim=0) * advantages).sum()
+    return epsilon_k + log_mean_exp - weighted_adv / eta
 
-    print(f'Total Mixed Imitation Data of Size: {mixed_states.shape[0]}')
 
-    return mixed_states, mixed_actions, mixed_next_states
-
-def plot_metrics(metrics, show_result=False):
-    plt.figure(figsize=(12, 8))
-    plt.clf()
-    plt.title("Training..." if not show_result else "Result")
-    plt.xlabel("Iteration")
-    plt.ylabel("Metrics")
-
-    for key, values in metrics.items():
-        plt.plot(values, label=key)
-
-    plt.legend()
-    plt.pause(0.001)
+def optimize_eta_k(advantages, epsilon_k, eta_min=1e-3, eta_max=1e3, num_iters=40):
+    """
+    Minimize the eta_k dual on device. g(eta) is convex, so its derivative is monotone and a
+    bisection in log(eta) finds the root without any host sync. Returns a 0-dim tensor.
+    """
+    advantages = advantages.detach().reshape(-1)
+    lo = torch.tensor(math.log(eta_min), device=advantages.device, dtype=advantages.dtype)
+    hi = torch.tensor(math.log(eta_max), device=advantages.device, dtype=advantages.dtype)
+    for _ in range(num_iters):
+        mid = 0.5 * (lo + hi)
+        increasing = eta_k_dual_grad(mid.exp(), advantages, epsilon_k) > 0
+        hi = torch.where(increasing, mid, hi)
+        lo = torch.where(increasing, lo, mid)
+    return (0.5 * (lo + hi)).exp()
 
 if __name__ == "__main__":
     args.batch_size = args.num_steps * args.num_envs
@@ -432,9 +412,11 @@ if __name__ == "__main__":
 
     device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
 
-    envs = gym.vector.SyncVectorEnv(
-        [make_env(args.env_id, i, args.capture_video, args.exp_name, args.gamma) for i in range(args.num_envs)]
+    envs = make_vector_env(
+        [make_env(args.env_id, i, args.capture_video, args.exp_name, args.gamma, normalize=False) for i in range(args.num_envs)],
+        backend=args.vector_backend,
     )
+    envs = VectorNormalize(envs, gamma=args.gamma)
     assert isinstance(envs.single_action_space, gym.spaces.Box), "only continuous action space is supported"
 
     agent = Agent(envs).to(device)
@@ -466,10 +448,19 @@ if __name__ == "__main__":
     ppo_optimizer = optim.Adam([
     {'params': agent.actor_mean.parameters()},
     {'params': agent.actor_logstd},
-    {'params': agent.critic.parameters()}], lr=args.ppo_learning_rate, eps=1e-5)
+    {'params': agent.critic.parameters()}], lr=args.ppo_learning_rate, eps=1e-5, **adam_kwargs(device, args.fused_update))
 
     # Optimizer for UPN
-    upn_optimizer = optim.Adam(agent.upn.parameters(), lr=args.upn_learning_rate, eps=1e-5)
+    upn_optimizer = optim.Adam(agent.upn.parameters(), lr=args.upn_learning_rate, eps=1e-5, **adam_kwargs(device, args.fused_update))
+
+    # PPO and UPN losses touch disjoint parameters, so one backward of their sum feeds both
+    fused_step = FusedStep([ppo_optimizer, upn_optimizer], [args.max_grad_norm, args.max_grad_norm], compile=args.fused_update and args.compile_update)
+
+    # Imitation data is read from disk once and sampled from every iteration
+    imitation_data = None
+    if args.mix_coord:
+        data_path = os.path.join(os.getcwd(), 'sfm', 'data', args.imitation_data_path)
+        imitation_data = ImitationData(data_path, device, on_device=args.imitation_on_device)
 
     # ALGO Logic: Storage setup
     obs = torch.zeros((args.num_steps, args.num_envs) + envs.single_observation_space.shape).to(device)
@@ -484,22 +475,11 @@ if __name__ == "__main__":
     # Logging setup
     global_step = 0
     start_time = time.time()
-    metrics = {
-        "episodic_returns": [],
-        "episodic_lengths": [],
-        "learning_rates": [],
-        "value_losses": [],
-        "policy_losses": [],
-        "entropies": [],
-        "approx_kls": [],
-        "clipfracs": [],
-        "explained_variances": [],
-        "upn_losses": [],
-        "recon_losses":[],
-        "forward_losses":[],
-        "inverse_losses":[],
-        "consist_losses":[]
-    }
+    # per-iteration values stay on device and are synced once in metrics.flush(),
+    # then streamed to the run log, plot it offline with report.py
+    run_dir = make_run_dir(os.path.join(os.getcwd(), 'sfm', args.log_dir), args.exp_name, args.seed)
+    logger = RunLogger(run_dir, config=args)
+    metrics = MetricsTracker(logger)
 
     next_obs, _ = envs.reset(seed=args.seed)
     next_obs = torch.Tensor(next_obs).to(device)
@@ -511,7 +491,7 @@ if __name__ == "__main__":
             lrnow = frac * args.ppo_learning_rate
             ppo_optimizer.param_groups[0]["lr"] = lrnow
 
-        metrics["learning_rates"].append(ppo_optimizer.param_groups[0]["lr"])
+        metrics.set("learning_rates", ppo_optimizer.param_groups[0]["lr"])
 
         for step in range(0, args.num_steps):
             global_step += args.num_envs
@@ -534,27 +514,15 @@ if __name__ == "__main__":
                 for info in infos["final_info"]:
                     if info and "episode" in info:
                         print(f"global_step={global_step}, episodic_return={info['episode']['r']}")
-                        metrics["episodic_returns"].append(info["episode"]["r"])
-                        metrics["episodic_lengths"].append(info["episode"]["l"])
+                        metrics.log_episode(global_step, info["episode"]["r"], info["episode"]["l"])
 
         with torch.no_grad():
             next_value = agent.get_value(next_obs).reshape(1, -1)
-            advantages = torch.zeros_like(rewards).to(device)
-            lastgaelam = 0
-            for t in reversed(range(args.num_steps)):
-                if t == args.num_steps - 1:
-                    nextnonterminal = 1.0 - next_done
-                    nextvalues = next_value
-                else:
-                    nextnonterminal = 1.0 - dones[t + 1]
-                    nextvalues = values[t + 1]
-                delta = rewards[t] + args.gamma * nextvalues * nextnonterminal - values[t]
-                advantages[t] = lastgaelam = delta + args.gamma * args.gae_lambda * nextnonterminal * lastgaelam
-            returns = advantages + values
+            advantages, returns = compute_gae(rewards, values, dones, next_value, next_done, args.gamma, args.gae_lambda)
         
         if args.mix_coord:
             # mixing screw things up, isolate the problem bit by bit
-            obs_imitate, actions_imitate, next_obs_imitate = mixed_batch(obs, actions, next_obs_all)
+            obs_imitate, actions_imitate, next_obs_imitate = imitation_data.mixed_batch(obs, actions, next_obs_all, args.imitation_ratio)
         else:
             obs_imitate, actions_imitate, next_obs_imitate = obs, actions, next_obs_all
 
@@ -572,14 +540,23 @@ if __name__ == "__main__":
         b_next_obs_imitate = next_obs_imitate.reshape((-1,) + envs.single_observation_space.shape) # previous error of passing the same obs help may be due to having 2 obs in action selection
         
         b_inds = np.arange(args.batch_size)
-        clipfracs_batch = []
         for epoch in range(args.update_epochs):
             np.random.shuffle(b_inds)
             for start in range(0, args.batch_size, args.minibatch_size):
                 end = start + args.minibatch_size
                 mb_inds = b_inds[start:end]
 
-                _, newlogprob, entropy, newvalue = agent.get_action_and_value(b_obs[mb_inds], b_actions[mb_inds])
+                # Encode the minibatch once for every consumer. PPO gets a detached latent: its gradients
+                # into the UPN were always discarded by upn_optimizer.zero_grad() before the UPN step
+                if args.mix_coord:
+                    with torch.no_grad():
+                        _, _, z = agent.encode(b_obs[mb_inds])
+                    encoded_imitate = agent.encode(b_obs_imitate[mb_inds])
+                else:
+                    encoded_imitate = agent.encode(b_obs[mb_inds])
+                    z = encoded_imitate[2].detach()
+
+                _, newlogprob, entropy, newvalue = agent.get_action_and_value(b_obs[mb_inds], b_actions[mb_inds], z=z)
                 logratio = newlogprob - b_logprobs[mb_inds]
                 ratio = logratio.exp()
 
@@ -587,7 +564,7 @@ if __name__ == "__main__":
                     # calculate approx_kl http://joschu.net/blog/kl-approx.html
                     old_approx_kl = (-logratio).mean()
                     approx_kl = ((ratio - 1) - logratio).mean()
-                    clipfracs_batch += [((ratio - 1.0).abs() > args.clip_coef).float().mean().item()]
+                    metrics.add("clipfracs", ((ratio - 1.0).abs() > args.clip_coef).float().mean())
                 
                 # if args.target_kl is not None and approx_kl > args.target_kl:
                 #     print(f"Early stopping at iteration {iteration} due to reaching target KL.")
@@ -623,18 +600,21 @@ if __name__ == "__main__":
                 intention_dist, eta_k = compute_intention_action_distribution(agent,
                                                                               b_obs_imitate[mb_inds],
                                                                               b_advantages[mb_inds],
-                                                                              args.epsilon_k
+                                                                              args.epsilon_k,
+                                                                              z=encoded_imitate[2].detach()
                                                                               )
                 kl_constraint_penalty = compute_lagrangian_kl_constraint(agent,
                                                                          b_obs_imitate[mb_inds],
                                                                          eta_k,
                                                                          args.epsilon_k,
-                                                                         intention_dist
+                                                                         intention_dist,
+                                                                         z=encoded_imitate[2].detach()
                                                                          )
                 recon_loss, forward_loss, inverse_loss, consistency_loss = compute_upn_loss(agent.upn,
                                                                                             b_obs_imitate[mb_inds],
                                                                                             b_actions_imitate[mb_inds],
-                                                                                            b_next_obs_imitate[mb_inds]
+                                                                                            b_next_obs_imitate[mb_inds],
+                                                                                            encoded=encoded_imitate
                                                                                             )
                 ppo_loss = (pg_loss -
                             args.ent_coef * entropy_loss +
@@ -649,22 +629,25 @@ if __name__ == "__main__":
                                             consistency_loss
                                             )
                 
-                # PPO backward pass and optimization
-                ppo_optimizer.zero_grad()
-                ppo_loss.backward()
-                nn.utils.clip_grad_norm_(
-                    list(agent.actor_mean.parameters()) + 
-                    [agent.actor_logstd] + 
-                    list(agent.critic.parameters()), 
-                    args.max_grad_norm
-                )
-                ppo_optimizer.step()
-
-                # UPN backward pass and optimization
-                upn_optimizer.zero_grad()
-                upn_loss.backward()
-                nn.utils.clip_grad_norm_(agent.upn.parameters(), args.max_grad_norm)
-                upn_optimizer.step()
+                if args.fused_update:
+                    fused_step(ppo_loss + upn_loss)
+                else:
+                    # PPO backward pass and optimization
+                    ppo_optimizer.zero_grad()
+                    ppo_loss.backward()
+                    nn.utils.clip_grad_norm_(
+                        list(agent.actor_mean.parameters()) + 
+                        [agent.actor_logstd] + 
+                        list(agent.critic.parameters()), 
+                        args.max_grad_norm
+                    )
+                    ppo_optimizer.step()
+
+                    # UPN backward pass and optimization
+                    upn_optimizer.zero_grad()
+                    upn_loss.backward()
+                    nn.utils.clip_grad_norm_(agent.upn.parameters(), args.max_grad_norm)
+                    upn_optimizer.step()
 
                 for name, param in agent.named_parameters():
                     if param.grad is not None and (torch.isnan(param.grad).any() or torch.isinf(param.grad).any()):
@@ -680,92 +663,28 @@ if __name__ == "__main__":
                 # # optimizer.step()
 
         # Logging
-        y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
-        var_y = np.var(y_true)
-        explained_var = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
-
-        metrics["value_losses"].append(v_loss.item())
-        metrics["policy_losses"].append(pg_loss.item())
-        metrics['upn_losses'].append(upn_loss.item())
-        metrics['forward_losses'].append(forward_loss.item())
-        metrics['inverse_losses'].append(inverse_loss.item())
-        metrics["recon_losses"].append(recon_loss.item())
-        metrics["consist_losses"].append(consistency_loss.item())
-        metrics["entropies"].append(entropy_loss.item())
-        metrics["approx_kls"].append(approx_kl.item())
-        metrics["clipfracs"].append(np.mean(clipfracs_batch))
-        metrics["explained_variances"].append(explained_var)
+        var_y = b_returns.var(unbiased=False)
+        explained_var = torch.where(var_y == 0, torch.full_like(var_y, float("nan")),
+                                    1 - (b_returns - b_values).var(unbiased=False) / var_y)
+
+        metrics.set("value_losses", v_loss)
+        metrics.set("policy_losses", pg_loss)
+        metrics.set("upn_losses", upn_loss)
+        metrics.set("forward_losses", forward_loss)
+        metrics.set("inverse_losses", inverse_loss)
+        metrics.set("recon_losses", recon_loss)
+        metrics.set("consist_losses", consistency_loss)
+        metrics.set("entropies", entropy_loss)
+        metrics.set("approx_kls", approx_kl)
+        metrics.set("explained_variances", explained_var)
+        metrics.flush(global_step=global_step, iteration=iteration)
 
         sps = int(global_step / (time.time() - start_time))
-        print(f"SPS: {sps}")
+        print(f"SPS ({args.vector_backend}, {args.num_envs} envs): {sps}")
 
     envs.close()
-
-    # Plotting results
-    plt.figure(figsize=(20, 10))
-
-    plt.subplot(2, 3, 1)
-    plt.plot(metrics["episodic_returns"])
-
-    avg_interval = 50
-    # Ensure that metrics["episodic_returns"] is a 1D list or array
-    episodic_returns = np.array(metrics["episodic_returns"]).flatten()
-
-    # Now apply np.convolve to calculate the rolling average
-    if len(episodic_returns) >= avg_interval:
-        avg_returns = np.convolve(episodic_returns, np.ones(avg_interval) / avg_interval, mode='valid')
-        plt.plot(range(avg_interval - 1, len(episodic_returns)), avg_returns, label=f"{avg_interval}-Episode Average", color="orange")
-
-    plt.title('Episodic Returns')
-    plt.xlabel('Episode')
-    plt.ylabel('Return')
-
-    # plt.subplot(2, 3, 2)
-    # plt.plot(metrics["episodic_lengths"])
-    # plt.title('Episodic Lengths')
-    # plt.xlabel('Episode')
-    # plt.ylabel('Length')
-
-    plt.subplot(2, 3, 2)
-    plt.plot(metrics["approx_kls"])
-    plt.title('Approx KLs')
-    plt.xlabel('Episode')
-    plt.ylabel('Approx KLs')
-
-    plt.subplot(2, 3, 3)
-    plt.plot(metrics["learning_rates"])
-    plt.title('Learning Rate')
-    plt.xlabel('Iteration')
-    plt.ylabel('LR')
-
-    plt.subplot(2, 3, 4)
-    plt.plot(metrics["value_losses"], label='Value Loss')
-    plt.plot(metrics["policy_losses"], label='Policy Loss')
-    plt.plot(metrics["upn_losses"], label='UPN Loss')
-    plt.plot(metrics["forward_losses"], label='Forward Loss')
-    plt.plot(metrics["inverse_losses"], label='Inverse Loss')
-    plt.plot(metrics["recon_losses"], label='Reconstruction Loss')
-    plt.plot(metrics["consist_losses"], label='Consistency Loss')
-    plt.title('Losses')
-    plt.xlabel('Iteration')
-    plt.ylabel('Loss')
-    plt.legend()
-
-    plt.subplot(2, 3, 5)
-    plt.plot(metrics["entropies"])
-    plt.title('Entropy')
-    plt.xlabel('Iteration')
-    plt.ylabel('Entropy')
-
-    plt.subplot(2, 3, 6)
-    plt.plot(metrics["explained_variances"])
-    plt.title('Explained Variance')
-    plt.xlabel('Iteration')
-    plt.ylabel('Variance')
-
-    plt.tight_layout()
-    plt.savefig('sofppo_vae_constrained.png')
-    plt.show()
+    logger.close()
+    print(f"Run log written to {logger.path}, plot it with report.py")
 
     # Save the model
     save_dir = os.path.join(os.getcwd(), 'sfm', 'params')
@@ -776,6 +695,7 @@ if __name__ == "__main__":
 
     print('Saved at: ', data1_path)
     torch.save(agent.state_dict(), data1_path)
+    envs.save(normalizer_path(data1_path))
 
     print('Saved at: ', data2_path)
     torch.save(agent.upn.state_dict(), data2_path)
\ No newline at end of file
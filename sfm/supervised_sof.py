@@ -1,22 +1,42 @@
 import os
+import random
+from dataclasses import dataclass
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader, TensorDataset
 import matplotlib.pyplot as plt
 
+from demonstrations import sharded_dataloaders
+from overrides import apply_overrides
+from precision import grad_scaler
+from run_logger import RunLogger, make_run_dir
+from supervised_trainer import DeviceBatches, EarlyStopping, fit, make_scheduler, run_epoch, scaled_learning_rate
+
 # ensure data is correct, is all in the data, must use consistent non stop data
+@dataclass
 class Args:
+    seed: int = 1 # model init and minibatch shuffling
     total_timesteps: int = 1000000
     learning_rate: float = 3e-4
     batch_size: int = 64
+    base_batch_size: int = 64 # batch size learning_rate was tuned at
+    lr_scaling: str = None # "linear" or "sqrt" scales learning_rate by batch_size / base_batch_size
     upn_hidden_layer: int = 64
     latent_size: int = 100
     num_epochs: int = 100
     cuda: bool = True
-
-args = Args()
+    data_path: str = 'sfm/data/imitation_data_ppo_no_flip_jump_intention.npz' # .npz file or sharded dataset directory
+    precision: str = "fp32" # "bf16" (CPU or CUDA) or "fp16" (CUDA, loss scaled) autocast, see precision.py
+    patience: int = None # early stopping after this many epochs without a validation improvement, None trains all num_epochs
+    min_delta: float = 0.0 # smallest validation loss decrease that counts as an improvement
+    lr_schedule: str = None # "plateau" (ReduceLROnPlateau on the validation loss) or "cosine" annealing over num_epochs
+    lr_patience: int = 5 # plateau schedule: epochs without improvement before the lr is halved
+    resume: bool = False # continue from the training state saved next to the model every epoch, the config must match
+    exp_name: str = "supervised_vae_upn"
+    log_dir: str = "runs" # epoch losses stream to sfm/<log_dir>/<exp_name>__<seed>__<time>/metrics.jsonl
+
+args = apply_overrides(Args())
 
 device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
 
@@ -89,7 +109,7 @@ class UPN(nn.Module):
         
         return z, z_next, z_pred, action_pred, state_recon, next_state_recon, next_state_pred
 
-def load_data(file_path='sfm/data/imitation_data_ppo_no_flip_jump_intention.npz'):
+def load_data(file_path=args.data_path):
     '''Need to normalize the input'''
     data = np.load(file_path)
     states = torch.FloatTensor(data['states']).to(device)
@@ -117,45 +137,11 @@ def compute_upn_loss(upn, state, action, next_state):
 
     return total_loss, recon_loss, forward_loss, inverse_loss, consistency_loss
 
-def train_model(model, dataloader, optimizer):
-    model.train()
-    total_loss = 0
-    total_recon_loss = 0
-    total_forward_loss = 0
-    total_inverse_loss = 0
-    total_consistency_loss = 0
-    for states, actions, next_states in dataloader:
-        optimizer.zero_grad()
-        loss, recon_loss, forward_loss, inverse_loss, consistency_loss = compute_upn_loss(model, states, actions, next_states)
-        loss.backward()
-        optimizer.step()
-        total_loss += loss.item()
-        total_recon_loss += recon_loss.item()
-        total_forward_loss += forward_loss.item()
-        total_inverse_loss += inverse_loss.item()
-        total_consistency_loss += consistency_loss.item()
-    return (total_loss / len(dataloader), total_recon_loss / len(dataloader),
-            total_forward_loss / len(dataloader), total_inverse_loss / len(dataloader),
-            total_consistency_loss / len(dataloader))
-
-def validate_model(model, dataloader):
-    model.eval()
-    total_loss = 0
-    total_recon_loss = 0
-    total_forward_loss = 0
-    total_inverse_loss = 0
-    total_consistency_loss = 0
-    with torch.no_grad():
-        for states, actions, next_states in dataloader:
-            loss, recon_loss, forward_loss, inverse_loss, consistency_loss = compute_upn_loss(model, states, actions, next_states)
-            total_loss += loss.item()
-            total_recon_loss += recon_loss.item()
-            total_forward_loss += forward_loss.item()
-            total_inverse_loss += inverse_loss.item()
-            total_consistency_loss += consistency_loss.item()
-    return (total_loss / len(dataloader), total_recon_loss / len(dataloader),
-            total_forward_loss / len(dataloader), total_inverse_loss / len(dataloader),
-            total_consistency_loss / len(dataloader))
+def train_model(model, batches, optimizer, scaler, device):
+    return run_epoch(model, batches, compute_upn_loss, device, optimizer, scaler, args.precision)
+
+def validate_model(model, batches, device):
+    return run_epoch(model, batches, compute_upn_loss, device, precision=args.precision)
 
 def plot_losses(train_losses, val_losses):
     plt.figure(figsize=(15, 10))
@@ -173,54 +159,56 @@ def plot_losses(train_losses, val_losses):
     plt.show()
 
 def main():
-    states, actions, next_states = load_data()
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    if os.path.isdir(args.data_path):
+        # sharded datasets are streamed from disk batch by batch
+        train_batches, val_batches, state_dim, action_dim = sharded_dataloaders(args.data_path, args.batch_size, device)
+    else:
+        states, actions, next_states = load_data()
     
-    print(f"States shape: {states.shape}")
-    print(f"Actions shape: {actions.shape}")
-    print(f"Next states shape: {next_states.shape}")
+        print(f"States shape: {states.shape}")
+        print(f"Actions shape: {actions.shape}")
+        print(f"Next states shape: {next_states.shape}")
     
-    split = int(0.8 * len(states))
-    train_states, train_actions, train_next_states = states[:split], actions[:split], next_states[:split]
-    val_states, val_actions, val_next_states = states[split:], actions[split:], next_states[split:]
+        split = int(0.8 * len(states))
+        train_states, train_actions, train_next_states = states[:split], actions[:split], next_states[:split]
+        val_states, val_actions, val_next_states = states[split:], actions[split:], next_states[split:]
 
-    train_dataset = TensorDataset(train_states, train_actions, train_next_states)
-    val_dataset = TensorDataset(val_states, val_actions, val_next_states)
+        # the data already lives on the device, minibatches are slices of it
+        train_batches = DeviceBatches(train_states, train_actions, train_next_states, batch_size=args.batch_size, shuffle=True)
+        val_batches = DeviceBatches(val_states, val_actions, val_next_states, batch_size=args.batch_size)
 
-    train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
-    val_dataloader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False)
-
-    state_dim = states.shape[-1]
-    action_dim = actions.shape[-1]
+        state_dim = states.shape[-1]
+        action_dim = actions.shape[-1]
 
     print(f"State dimension: {state_dim}")
     print(f"Action dimension: {action_dim}")
 
     model = UPN(state_dim, action_dim, args.latent_size).to(device)
 
-    optimizer = optim.Adam(model.parameters(), lr=args.learning_rate, weight_decay=1e-5)
+    optimizer = optim.Adam(model.parameters(), lr=scaled_learning_rate(args.learning_rate, args.batch_size, args.base_batch_size, args.lr_scaling), weight_decay=1e-5)
 
-    train_losses = []
-    val_losses = []
-
-    for epoch in range(args.num_epochs):
-        train_loss = train_model(model, train_dataloader, optimizer)
-        val_loss = validate_model(model, val_dataloader)
-        
-        train_losses.append(train_loss)
-        val_losses.append(val_loss)
-        
-        print(f"Epoch {epoch+1}/{args.num_epochs}")
-        print(f"Train - Total: {train_loss[0]:.4f}, Recon: {train_loss[1]:.4f}, Forward: {train_loss[2]:.4f}, Inverse: {train_loss[3]:.4f}, Consistency: {train_loss[4]:.4f}")
-        print(f"Val   - Total: {val_loss[0]:.4f}, Recon: {val_loss[1]:.4f}, Forward: {val_loss[2]:.4f}, Inverse: {val_loss[3]:.4f}, Consistency: {val_loss[4]:.4f}")
-
-    plot_losses(train_losses, val_losses)
+    scaler = grad_scaler(args.precision)
 
+    scheduler = make_scheduler(optimizer, args.lr_schedule, args.num_epochs, args.lr_patience)
+    stopper = EarlyStopping(args.patience, args.min_delta)
     save_dir = os.path.join(os.getcwd(), 'sfm', 'params')
-    os.makedirs(save_dir, exist_ok=True)
     model_filename = "supp/supervised_vae_jump.pth"
     model_path = os.path.join(save_dir, model_filename)
-    torch.save(model.state_dict(), model_path)
-    print(f"Model saved at: {model_path}")
+    logger = RunLogger(make_run_dir(os.path.join(os.getcwd(), 'sfm', args.log_dir), args.exp_name, args.seed), config=args)
+    # keeps the best model at model_path, the model ends up with its best weights
+    train_losses, val_losses = fit(model, optimizer,
+                                   lambda: train_model(model, train_batches, optimizer, scaler, device),
+                                   lambda: validate_model(model, val_batches, device),
+                                   args.num_epochs, model_path, scheduler=scheduler, scaler=scaler,
+                                   stopper=stopper, resume=args.resume, names=["total", "recon", "forward", "inverse", "consistency"],
+                                   logger=logger, config=args)
+    logger.close()
+
+    plot_losses(train_losses, val_losses)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,235 @@
+import os
+import math
+import numpy as np
+import torch
+
+from precision import autocast
+
+## Device-resident minibatching and epoch loop for the supervised UPN pretraining scripts
+
+LR_SCALING = (None, "linear", "sqrt")
+LR_SCHEDULES = (None, "plateau", "cosine")
+# settings a resumed run may change: where it runs, how long it trains and where it logs
+RESUME_FREE_KEYS = ("resume", "num_epochs", "cuda", "device", "log_dir")
+
+class DeviceBatches:
+    '''Minibatches of tensors that already live on the device, a DataLoader replacement.
+
+    Shuffling draws one randperm on the device per epoch and gathers every tensor once, the
+    minibatches are then contiguous slices (views), so there is no per-sample collate.'''
+    def __init__(self, *tensors, batch_size, shuffle=False):
+        assert all(len(t) == len(tensors[0]) for t in tensors), "tensors must have the same length"
+        self.tensors = tensors
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return math.ceil(len(self.tensors[0]) / self.batch_size)
+
+    def __iter__(self):
+        tensors = self.tensors
+        if self.shuffle:
+            perm = torch.randperm(len(tensors[0]), device=tensors[0].device)
+            tensors = [t[perm] for t in tensors]
+        for start in range(0, len(tensors[0]), self.batch_size):
+            yield tuple(t[start:start + self.batch_size] for t in tensors)
+
+def scaled_learning_rate(learning_rate, batch_size, base_batch_size, rule=None):
+    '''Learning rate for batch_size when learning_rate was tuned at base_batch_size: linear
+    scaling (Goyal et al.) or square root scaling, the safer choice for Adam'''
+    if rule is None:
+        return learning_rate
+    ratio = batch_size / base_batch_size
+    if rule == "linear":
+        return learning_rate * ratio
+    if rule == "sqrt":
+        return learning_rate * math.sqrt(ratio)
+    raise ValueError(f"Unknown lr scaling '{rule}', expected one of {LR_SCALING}")
+
+def run_epoch(model, batches, loss_fn, device, optimizer=None, scaler=None, precision="fp32"):
+    '''One pass of loss_fn(model, *batch) over batches, a training pass when an optimizer is given.
+
+    loss_fn returns a tuple of scalar losses, the first one is optimized. The terms are summed on
+    the device weighted by batch size and copied to the host once, at the end of the epoch.
+    Returns the per-sample mean of every term.'''
+    training = optimizer is not None
+    model.train(training)
+    totals, count = None, 0
+    with torch.set_grad_enabled(training):
+        for batch in batches:
+            with autocast(device, precision):
+                losses = loss_fn(model, *batch)
+            if training:
+                optimizer.zero_grad(set_to_none=True)
+                scaler.scale(losses[0]).backward()
+                scaler.step(optimizer)
+                scaler.update()
+            size = len(batch[0])
+            terms = torch.stack([loss.detach().float() for loss in losses]) * size
+            totals = terms if totals is None else totals + terms
+            count += size
+    return tuple((totals / count).tolist())
+
+def make_scheduler(optimizer, schedule, num_epochs, patience=5, factor=0.5):
+    '''Per-epoch learning rate schedule: "plateau" multiplies the lr by factor after patience epochs
+    without a validation improvement, "cosine" anneals it to zero over num_epochs'''
+    if schedule is None:
+        return None
+    if schedule == "plateau":
+        return torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode="min", factor=factor, patience=patience)
+    if schedule == "cosine":
+        return torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=num_epochs)
+    raise ValueError(f"Unknown lr schedule '{schedule}', expected one of {LR_SCHEDULES}")
+
+class EarlyStopping:
+    '''Tracks the best validation loss, an epoch improves on it when it is lower by more than
+    min_delta. should_stop once patience epochs in a row did not improve, never when patience is None.'''
+    def __init__(self, patience=None, min_delta=0.0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = math.inf
+        self.best_epoch = -1
+        self.bad_epochs = 0
+
+    def step(self, loss, epoch):
+        if loss < self.best - self.min_delta:
+            self.best = loss
+            self.best_epoch = epoch
+            self.bad_epochs = 0
+            return True
+        self.bad_epochs += 1
+        return False
+
+    @property
+    def should_stop(self):
+        return self.patience is not None and self.bad_epochs >= self.patience
+
+    def state_dict(self):
+        return {"best": self.best, "best_epoch": self.best_epoch, "bad_epochs": self.bad_epochs}
+
+    def load_state_dict(self, state):
+        self.best = state["best"]
+        self.best_epoch = state["best_epoch"]
+        self.bad_epochs = state["bad_epochs"]
+
+def training_state_path(model_path):
+    '''Where the resumable training state of a model lives, next to the .pth'''
+    return os.path.splitext(model_path)[0] + "_state.pth"
+
+def _plain_config(config):
+    # primitives only, so the state file still loads with torch.load(weights_only=True)
+    return {k: v if isinstance(v, (bool, int, float, str, type(None))) else str(v) for k, v in vars(config).items()}
+
+def _numpy_rng_state():
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {"name": name, "keys": keys.tolist(), "pos": pos, "has_gauss": has_gauss, "cached_gaussian": cached_gaussian}
+
+def _set_numpy_rng_state(state):
+    np.random.set_state((state["name"], np.asarray(state["keys"], dtype=np.uint32), state["pos"],
+                         state["has_gauss"], state["cached_gaussian"]))
+
+def _atomic_save(obj, path):
+    # a crash mid-write leaves the previous file intact
+    torch.save(obj, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def fit(model, optimizer, train_epoch, val_epoch, num_epochs, model_path, scheduler=None, scaler=None,
+        stopper=None, resume=False, names=None, logger=None, config=None):
+    '''Epoch loop around train_epoch() and val_epoch(), which return tuples of losses, the first one
+    (the total) drives the schedule, early stopping and checkpointing.
+
+    The best model so far is written to model_path whenever the validation total improves. After
+    every epoch the model, optimizer, scheduler, scaler, early stopping counters, loss histories,
+    torch and numpy RNG state and config (the script's Args) go to training_state_path(model_path),
+    with resume a rerun continues from there. Resuming with a config that differs in anything but
+    RESUME_FREE_KEYS raises. The state file is removed once training finishes and the model is left
+    with its best weights.
+    With a RunLogger every epoch is streamed as an "epoch" record with train_<name>/val_<name> keys.
+    Returns the train and validation loss histories.'''
+    stopper = stopper or EarlyStopping()
+    state_path = training_state_path(model_path)
+    os.makedirs(os.path.dirname(model_path) or ".", exist_ok=True)
+    train_losses, val_losses = [], []
+    start_epoch = 0
+
+    if resume and os.path.exists(state_path):
+        state = torch.load(state_path, map_location="cpu")
+        saved_config = state.get("config")
+        if config is not None and saved_config is not None:
+            current = _plain_config(config)
+            changed = {k: (saved_config.get(k), current.get(k)) for k in set(saved_config) | set(current)
+                       if k not in RESUME_FREE_KEYS and saved_config.get(k) != current.get(k)}
+            if changed:
+                details = ", ".join(f"{k}: {old!r} -> {new!r}" for k, (old, new) in sorted(changed.items()))
+                raise ValueError(f"{state_path} was saved with a different config ({details}), "
+                                 "train from scratch with resume=False or restore the settings")
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        if scheduler is not None and state["scheduler"] is not None:
+            scheduler.load_state_dict(state["scheduler"])
+        if scaler is not None and state["scaler"] is not None:
+            scaler.load_state_dict(state["scaler"])
+        stopper.load_state_dict(state["stopper"])
+        train_losses, val_losses = state["train_losses"], state["val_losses"]
+        torch.set_rng_state(state["rng"])
+        if state["cuda_rng"] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["cuda_rng"])
+        if state.get("np_rng") is not None:
+            # DemoBatches shuffles its blocks with the global numpy generator
+            _set_numpy_rng_state(state["np_rng"])
+        start_epoch = state["epoch"] + 1
+        print(f"Resuming from {state_path} at epoch {start_epoch + 1}, best val {stopper.best:.4f} (epoch {stopper.best_epoch + 1})")
+
+    def describe(losses):
+        if names is None:
+            return ", ".join(f"{loss:.4f}" for loss in losses)
+        return ", ".join(f"{name.capitalize()}: {loss:.4f}" for name, loss in zip(names, losses))
+
+    for epoch in range(start_epoch, num_epochs):
+        train_loss = train_epoch()
+        val_loss = val_epoch()
+        train_losses.append(train_loss)
+        val_losses.append(val_loss)
+
+        if isinstance(scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+            scheduler.step(val_loss[0])
+        elif scheduler is not None:
+            scheduler.step()
+        improved = stopper.step(val_loss[0], epoch)
+        if improved:
+            _atomic_save(model.state_dict(), model_path)
+
+        print(f"Epoch {epoch+1}/{num_epochs}, lr {optimizer.param_groups[0]['lr']:.2e}{' (best)' if improved else ''}")
+        print(f"Train - {describe(train_loss)}")
+        print(f"Val   - {describe(val_loss)}")
+        if logger is not None:
+            keys = names or [f"loss_{i}" for i in range(len(val_loss))]
+            logger.log("epoch", epoch=epoch, lr=optimizer.param_groups[0]["lr"],
+                       **{f"train_{key}": loss for key, loss in zip(keys, train_loss)},
+                       **{f"val_{key}": loss for key, loss in zip(keys, val_loss)})
+
+        _atomic_save({
+            "epoch": epoch,
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "scheduler": scheduler.state_dict() if scheduler is not None else None,
+            "scaler": scaler.state_dict() if scaler is not None else None,
+            "stopper": stopper.state_dict(),
+            "train_losses": train_losses,
+            "val_losses": val_losses,
+            "rng": torch.get_rng_state(),
+            "cuda_rng": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            "np_rng": _numpy_rng_state(),
+            "config": _plain_config(config) if config is not None else None,
+        }, state_path)
+
+        if stopper.should_stop:
+            print(f"Early stopping: no validation improvement in {stopper.patience} epochs")
+            break
+
+    if stopper.best_epoch >= 0:
+        model.load_state_dict(torch.load(model_path, map_location="cpu"))
+        print(f"Best model (epoch {stopper.best_epoch + 1}, val {stopper.best:.4f}) saved at: {model_path}")
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return train_losses, val_losses
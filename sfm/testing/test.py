@@ -4,40 +4,29 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 import torch
-import gymnasium as gym
 import numpy as np
 import matplotlib.pyplot as plt
-from torch.distributions import Normal
-import torch.nn as nn
+from dataclasses import dataclass
 from sofppo_constrain import Args, Agent as SFMPPOAgent, make_env
 from ppo import Agent as PPOAgent
+from vec_env import make_vector_env
+from normalization import VectorNormalize, normalizer_path
+from evaluation import evaluate_policy, format_result
 import random
 
-def evaluate_model(agent, envs, device, num_episodes=100):
-    '''Evaluate models, models all imported from taring files, customize wrappers,
-    perfectly consistent with both ppo and fmppo, previous environment is inconsistent, very delicate.'''
-    returns = []
-    for episode in range(num_episodes):
-        next_obs, _ = envs.reset()
-        next_obs = torch.Tensor(next_obs).to(device)
-        next_done = torch.zeros(envs.num_envs).to(device)
-        episode_returns = torch.zeros(envs.num_envs).to(device)
-
-        while not next_done.all():
-            with torch.no_grad():
-                action, _, _, _ = agent.get_action_and_value(next_obs)
-                next_obs, reward, terminations, truncations, _ = envs.step(action.cpu().numpy())
-                next_obs = torch.Tensor(next_obs).to(device)
-                next_done = torch.logical_or(torch.Tensor(terminations), torch.Tensor(truncations)).to(device)
-                episode_returns += torch.Tensor(reward).to(device) * (~next_done)
-                print(f'Episode: {episode}/{num_episodes} With Rewards: {episode_returns}')
-
-        returns.extend(episode_returns.cpu().numpy())
-
-    return returns
+@dataclass
+class EvalArgs:
+    sfmppo_path: str = "sfmppo/sfmppo_try.pth"
+    ppo_path: str = "ppo/ppo_hc_kl.pth"
+    num_episodes: int = 200
+    num_envs: int = 10 # episodes run concurrently, one per sub-env
+    vector_backend: str = "sync" # "async" steps every sub-env in its own process
+    deterministic: bool = False # act with the policy mean instead of sampling
+    seed: int = None # episode seeds, None leaves them random
 
 if __name__ == "__main__":
     args = Args()
+    eval_args = EvalArgs()
     # random.seed(args.seed)
     # np.random.seed(args.seed)
     # torch.manual_seed(args.seed)
@@ -45,30 +34,40 @@ if __name__ == "__main__":
 
     device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
 
-    envs = gym.vector.SyncVectorEnv(
-        [make_env(args.env_id, i, args.capture_video, args.exp_name, args.gamma) for i in range(args.num_envs)]
+    envs = make_vector_env(
+        [make_env(args.env_id, i, args.capture_video, args.exp_name, args.gamma, normalize=False) for i in range(eval_args.num_envs)],
+        backend=eval_args.vector_backend,
     )
+    envs = VectorNormalize(envs, gamma=args.gamma)
 
     # Load the SOF-PPO model
     sfmppo_agent = SFMPPOAgent(envs).to(device)
-    sfmppo_path = os.path.join(os.getcwd(), "sfm", "params", "sfmppo/sfmppo_try.pth")
+    sfmppo_path = os.path.join(os.getcwd(), "sfm", "params", eval_args.sfmppo_path)
     sfmppo_agent.load_state_dict(torch.load(sfmppo_path, map_location=device))
 
     # Load the PPO model
     ppo_agent = PPOAgent(envs).to(device)
-    ppo_path = os.path.join(os.getcwd(), "sfm", "params", "ppo/ppo_hc_kl.pth")
+    ppo_path = os.path.join(os.getcwd(), "sfm", "params", eval_args.ppo_path)
     ppo_agent.load_state_dict(torch.load(ppo_path, map_location=device))
 
-    episode_num = 200
-    sfmppo_returns = evaluate_model(sfmppo_agent, envs, device, num_episodes=episode_num)
-    ppo_returns = evaluate_model(ppo_agent, envs, device, num_episodes=episode_num)
+    # each model is normalized with its own training statistics
+    envs.load(normalizer_path(sfmppo_path))
+    sfmppo_result = evaluate_policy(sfmppo_agent, envs, device, num_episodes=eval_args.num_episodes,
+                                    deterministic=eval_args.deterministic, seed=eval_args.seed)
+    envs.load(normalizer_path(ppo_path))
+    ppo_result = evaluate_policy(ppo_agent, envs, device, num_episodes=eval_args.num_episodes,
+                                 deterministic=eval_args.deterministic, seed=eval_args.seed)
+    envs.close()
+
+    print(format_result("SOF-PPO", sfmppo_result))
+    print(format_result("PPO", ppo_result))
 
     plt.figure(figsize=(10, 6))
-    plt.plot(range(1, len(sfmppo_returns)+1), sfmppo_returns, label="SOF-PPO", marker='o')
-    plt.plot(range(1, len(ppo_returns)+1), ppo_returns, label="PPO", marker='o')
+    plt.plot(range(1, len(sfmppo_result["returns"])+1), sfmppo_result["returns"], label="SOF-PPO", marker='o')
+    plt.plot(range(1, len(ppo_result["returns"])+1), ppo_result["returns"], label="PPO", marker='o')
     plt.title("Episode Returns for Intention Constrain Models Evaluated in Intention Environment")
     plt.xlabel("Episode")
     plt.ylabel("Return")
     plt.legend()
     plt.grid(True)
-    plt.show()
\ No newline at end of file
+    plt.show()
@@ -0,0 +1,18 @@
+import gymnasium as gym
+
+## Vector env construction shared by all trainers
+
+VECTOR_BACKENDS = ("sync", "async")
+
+def make_vector_env(env_fns, backend="sync", context=None):
+    '''Build a vector env from a list of make_env thunks.
+
+    sync: all sub-envs step one after another in this process.
+    async: every sub-env runs in its own worker process and writes its observation
+    straight into a shared memory block, so MuJoCo stepping spreads over all cores.'''
+    if backend == "sync":
+        return gym.vector.SyncVectorEnv(env_fns)
+    if backend == "async":
+        # thunks are cloudpickled, so the lambdas inside make_env survive the trip
+        return gym.vector.AsyncVectorEnv(env_fns, shared_memory=True, context=context)
+    raise ValueError(f"Unknown vector backend '{backend}', expected one of {VECTOR_BACKENDS}")
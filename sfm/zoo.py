@@ -0,0 +1,152 @@
+import os
+import sys
+import time
+import importlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import torch
+import gymnasium as gym
+
+import env_wrappers
+from evaluation import evaluate_policy
+from normalization import VectorNormalize, normalizer_path
+
+## Checkpoint zoo x env wrapper matrix, every cell evaluated in its own worker process
+
+@dataclass
+class ZooArgs:
+    env_id: str = "HalfCheetah-v4"
+    target_velocity: float = 2.0
+    jump_target_height: float = 2.0
+    gamma: float = 0.99
+    num_episodes: int = 50 # per cell
+    num_envs: int = 10 # concurrent episodes inside a cell
+    deterministic: bool = False
+    seed: int = 123 # every checkpoint sees the same episode seeds in a given env
+    num_workers: int = 4
+    table_name: str = "robustness" # results go to sfm/zoo/<table_name>.csv
+
+zoo_args = ZooArgs()
+
+# name, module:Agent class, path under sfm/params
+CHECKPOINTS = [
+    ("PPO", "ppo:Agent", "ppo/ppo_hc_kl.pth"),
+    ("SFM-PPO", "sfmppo:Agent", "sfmppo/sfmppo_stable.pth"),
+    ("SoF-PPO", "sofppo_constrain:Agent", "sfmppo/sfmppo_try.pth"),
+]
+
+# name -> perturbation wrappers from env_wrappers, applied in order on top of the task wrappers,
+# where the commented out lines sit in the trainers' make_env. *VectorWrapper classes wrap the
+# whole vector env instead (one seeded generator, one call per step), under the normalization
+WRAPPER_CONFIGS = {"clean": []}
+WRAPPER_CONFIGS.update({f"delay_{p}_{f}": [("DelayedHalfCheetahEnv", {"proprio_delay": p, "force_delay": f})]
+                        for p, f in [(1, 3), (2, 5), (4, 10)]})
+WRAPPER_CONFIGS.update({f"noise_{s}": [("NoisyObservationVectorWrapper", {"noise_scale": s})]
+                        for s in (0.05, 0.1, 0.2)})
+WRAPPER_CONFIGS.update({
+    "partial_0.5": [("PartialObservabilityVectorWrapper", {"observable_ratio": 0.5})],
+    "action_mask_0.2": [("ActionMaskingVectorWrapper", {"mask_prob": 0.2})],
+    "nonlinear_50": [("NonLinearDynamicsWrapper", {"dynamic_change_threshold": 50})],
+})
+
+def is_vector_wrapper(name):
+    return issubclass(getattr(env_wrappers, name), gym.vector.VectorEnvWrapper)
+
+def make_env(env_id, wrappers, target_velocity, jump_target_height, gamma):
+    '''The trainers' env stack with the perturbation wrappers switched on by config instead of
+    by uncommenting lines. Normalization happens at the vector level, see evaluate_cell'''
+    def thunk():
+        env = gym.make(env_id)
+        env = env_wrappers.TargetVelocityWrapper(env, target_velocity=target_velocity)
+        env = env_wrappers.JumpRewardWrapper(env, jump_target_height=jump_target_height)
+        for name, kwargs in wrappers:
+            if not is_vector_wrapper(name):
+                env = getattr(env_wrappers, name)(env, **kwargs)
+        env = gym.wrappers.FlattenObservation(env)
+        env = gym.wrappers.RecordEpisodeStatistics(env)
+        env = gym.wrappers.ClipAction(env)
+        return env
+    return thunk
+
+def load_agent(agent_spec, path, envs, device):
+    module_name, class_name = agent_spec.split(":")
+    agent_class = getattr(importlib.import_module(module_name), class_name)
+    agent = agent_class(envs).to(device)
+    agent.load_state_dict(torch.load(path, map_location=device))
+    return agent
+
+def evaluate_cell(checkpoint, env_name, wrappers, zoo_args):
+    '''Worker: one checkpoint in one env config, single threaded on CPU'''
+    torch.set_num_threads(1)
+    torch.manual_seed(zoo_args.seed)
+    np.random.seed(zoo_args.seed)
+    name, agent_spec, path = checkpoint
+    envs = gym.vector.SyncVectorEnv(
+        [make_env(zoo_args.env_id, wrappers, zoo_args.target_velocity, zoo_args.jump_target_height, zoo_args.gamma)
+         for _ in range(zoo_args.num_envs)]
+    )
+    for wrapper_name, kwargs in wrappers:
+        if is_vector_wrapper(wrapper_name):
+            # reseeded by evaluate_policy's seeded reset
+            envs = getattr(env_wrappers, wrapper_name)(envs, **kwargs)
+    envs = VectorNormalize(envs, gamma=zoo_args.gamma)
+    checkpoint_path = os.path.join(os.getcwd(), 'sfm', 'params', path)
+    # frozen training statistics, so every env config is normalized the way the checkpoint was trained
+    envs.load(normalizer_path(checkpoint_path))
+    agent = load_agent(agent_spec, checkpoint_path, envs, torch.device("cpu"))
+    result = evaluate_policy(agent, envs, torch.device("cpu"), num_episodes=zoo_args.num_episodes,
+                             deterministic=zoo_args.deterministic, seed=zoo_args.seed)
+    envs.close()
+    stats = result["return"]
+    return {"checkpoint": name, "env": env_name, **stats,
+            "length": result["length"]["mean"], "episodes": len(result["returns"]), "seconds": result["seconds"]}
+
+def run_matrix(checkpoints, wrapper_configs, zoo_args):
+    '''Evaluate every (checkpoint, env config) pair, returns one row per cell. A failed cell
+    gets an "error" row and is listed again once all cells finished'''
+    rows = []
+    # spawn, forking a process that already holds torch/MuJoCo state is not safe
+    with ProcessPoolExecutor(max_workers=zoo_args.num_workers, mp_context=mp.get_context("spawn")) as pool:
+        futures = {pool.submit(evaluate_cell, checkpoint, env_name, wrappers, zoo_args): (checkpoint[0], env_name)
+                   for checkpoint in checkpoints for env_name, wrappers in wrapper_configs.items()}
+        for future in as_completed(futures):
+            name, env_name = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:
+                print(f"{name} in {env_name} failed: {e}")
+                row = {"checkpoint": name, "env": env_name, "error": str(e)}
+            else:
+                print(f"{name} in {env_name}: {row['mean']:.2f} [{row['ci_low']:.2f}, {row['ci_high']:.2f}]")
+            rows.append(row)
+    failed = [row for row in rows if "error" in row]
+    if failed:
+        print(f"\n{len(failed)} of {len(rows)} cells failed:")
+        for row in failed:
+            print(f"  {row['checkpoint']} in {row['env']}: {row['error']}")
+    return rows
+
+if __name__ == "__main__":
+    start_time = time.time()
+    rows = run_matrix(CHECKPOINTS, WRAPPER_CONFIGS, zoo_args)
+    print(f"{len(rows)} cells in {time.time() - start_time:.1f}s")
+
+    results = pd.DataFrame(rows)
+    save_dir = os.path.join(os.getcwd(), 'sfm', 'zoo')
+    os.makedirs(save_dir, exist_ok=True)
+    table_path = os.path.join(save_dir, f"{zoo_args.table_name}.csv")
+    results.to_csv(table_path, index=False)
+    print(f"Saved results to {table_path}")
+
+    if "mean" in results:
+        # checkpoints x env configs, columns in config order
+        matrix = results.pivot(index="checkpoint", columns="env", values="mean")
+        print(matrix.reindex(columns=[env for env in WRAPPER_CONFIGS if env in matrix.columns]).round(2).to_string())
+
+    if any("error" in row for row in rows):
+        # the table is still written, but a run with missing cells must not look like a success
+        sys.exit(1)
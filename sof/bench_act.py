@@ -0,0 +1,35 @@
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+
+from config import args_sof
+from environments import make_env
+from vec_env import make_vector_env
+from inference import benchmark_act
+from models import Agent_ppo, Agent_sof
+
+## Micro-benchmark of the rollout policy call, get_action_and_value against act()
+
+@dataclass
+class BenchArgs:
+    num_envs: int = 1 # batch size of one rollout step
+    num_steps: int = 2000
+    compile: bool = True
+    cuda: bool = False # rollouts at num_envs=1 usually run faster on CPU
+    seed: int = 1
+
+bench_args = BenchArgs()
+
+if __name__ == "__main__":
+    torch.manual_seed(bench_args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() and bench_args.cuda else "cpu")
+    envs = make_vector_env([make_env(args_sof.env_id, 0, False, "bench", args_sof.gamma, normalize=False)])
+    obs, _ = envs.reset(seed=bench_args.seed)
+    obs = torch.as_tensor(np.repeat(obs, bench_args.num_envs, axis=0), dtype=torch.float32, device=device)
+
+    for name, agent_class in [("Agent_sof", Agent_sof), ("Agent_ppo", Agent_ppo)]:
+        agent = agent_class(envs).to(device)
+        print(f"{name}, batch {bench_args.num_envs} on {device}:")
+        benchmark_act(agent, obs, bench_args.num_steps, compile=bench_args.compile)
+    envs.close()
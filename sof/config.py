@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from overrides import apply_overrides
 
 @dataclass
 class Args_sof:
@@ -17,6 +18,11 @@ class Args_sof:
     upn_hidden_layer: int = 64
     ppo_hidden_layer: int = 256
     num_envs: int = 1
+    vector_backend: str = "sync" # "sync" or "async" (subprocess per env, shared memory obs)
+    compile_act: bool = False # torch.compile the rollout act() path, see inference.py
+    fused_update: bool = False # one backward for all losses, per optimizer clipping in one foreach pass, fused/foreach Adam
+    compile_update: bool = False # with fused_update, torch.compile the gradient clipping
+    precision: str = "fp32" # "bf16" autocasts the update phase (forward passes and losses), see precision.py
     num_steps: int = 2048
     anneal_lr: bool = True
     gamma: float = 0.99
@@ -35,6 +41,7 @@ class Args_sof:
 
     # exactly how far we want distribution to be
     epsilon_k: float = 0.01
+    optimize_eta_k: bool = False # solve the eta_k dual on device each minibatch instead of a gradient step on it
 
     # when constrain_weights is zero, no EM constrain
     constrain_weights: float = 0.8
@@ -42,6 +49,8 @@ class Args_sof:
     # this helps greatly for sfmppo
     imitation_data_path: str = None
     mix_coord: bool = False
+    imitation_ratio: float = None # share of each UPN batch from imitation data, None mixes by dataset size
+    imitation_on_device: bool = True # False keeps a pinned host copy instead
     
     # data need to match up, this data may be problematic
     load_upn: str = "supervised_vae_jump.pth"
@@ -52,6 +61,7 @@ class Args_sof:
     # save path
     save_sfm: str = "sof_try.pth"
     save_sfmppo: str = "sofppo_try.pth"
+    log_dir: str = "runs" # metrics stream to sof/<log_dir>/<exp_name>__<seed>__<time>/metrics.jsonl, plot with report.py
 
     # to be set at runtime
     batch_size: int = 0 
@@ -71,6 +81,8 @@ class Args_ppo:
     learning_rate: float = 1e-5
     ppo_hidden_layer: int = 256
     num_envs: int = 1
+    vector_backend: str = "sync" # "sync" or "async" (subprocess per env, shared memory obs)
+    compile_act: bool = False # torch.compile the rollout act() path, see inference.py
     num_steps: int = 2048
     anneal_lr: bool = True
     gamma: float = 0.99
@@ -89,6 +101,7 @@ class Args_ppo:
     action_reg_coef: float = 0.0
     load_model: str = None
     save_path: str = "ppo_jump_intention.pth"
+    log_dir: str = "runs" # metrics stream to sof/<log_dir>/<exp_name>__<seed>__<time>/metrics.jsonl, plot with report.py
 
     # to be filled in runtime
     batch_size: int = 0
@@ -97,15 +110,26 @@ class Args_ppo:
 
 @dataclass
 class Args_supp:
+    seed: int = 1 # model init and minibatch shuffling
     total_timesteps: int = 1000000
     learning_rate: float = 3e-4
     batch_size: int = 64
+    base_batch_size: int = 64 # batch size learning_rate was tuned at
+    lr_scaling: str = None # "linear" or "sqrt" scales learning_rate by batch_size / base_batch_size
     upn_hidden_layer: int = 64
     latent_size: int = 100
     num_epochs: int = 100
     cuda: bool = True
-    imitate_data_path: str = 'imitate_ppo_hard_jump_intention.npz'
+    imitate_data_path: str = 'imitate_ppo_hard_jump_intention.npz' # .npz file or sharded dataset directory
+    precision: str = "fp32" # "bf16" (CPU or CUDA) or "fp16" (CUDA, loss scaled) autocast, see precision.py
     save_supp_path: str = "supervised_vae_jump.pth"
+    patience: int = None # early stopping after this many epochs without a validation improvement, None trains all num_epochs
+    min_delta: float = 0.0 # smallest validation loss decrease that counts as an improvement
+    lr_schedule: str = None # "plateau" (ReduceLROnPlateau on the validation loss) or "cosine" annealing over num_epochs
+    lr_patience: int = 5 # plateau schedule: epochs without improvement before the lr is halved
+    resume: bool = False # continue from the training state saved next to the model every epoch, the config must match
+    exp_name: str = "supervised_upn"
+    log_dir: str = "runs" # epoch losses stream to sof/<log_dir>/<exp_name>__<seed>__<time>/metrics.jsonl
 
 @dataclass
 class Args_test:
@@ -116,13 +140,15 @@ class Args_test:
     torch_deterministic: bool = True
     cuda: bool = True
     gamma: float = 0.99
-    num_envs: int = 1
+    num_envs: int = 10 # episodes run concurrently, one per sub-env
+    vector_backend: str = "sync" # "async" steps every sub-env in its own process
     test_episode_num: int = 100
+    deterministic: bool = False # act with the policy mean instead of sampling
     ppo_path: str = "ppo_hc_kl.pth"
     sof_path: str = "sofppo_try.pth"
 
 # initiate
-args_sof = Args_sof()
-args_ppo = Args_ppo()
-args_supp = Args_supp()
-args_test = Args_test()
+args_sof = apply_overrides(Args_sof(), "args_sof")
+args_ppo = apply_overrides(Args_ppo(), "args_ppo")
+args_supp = apply_overrides(Args_supp(), "args_supp")
+args_test = apply_overrides(Args_test(), "args_test")
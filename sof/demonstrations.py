@@ -0,0 +1,288 @@
+import os
+import json
+import math
+import numpy as np
+import torch
+
+## Demonstration (imitation) data handling
+
+DEMO_FIELDS = ("states", "actions", "next_states")
+INDEX_FILE = "index.json"
+
+def load_demonstrations(path):
+    '''Either a single .npz file or a sharded dataset directory, read fully into host memory'''
+    if os.path.isdir(path):
+        reader = ShardedDemoReader(path)
+        return reader.read(0, len(reader))
+    data = np.load(path)
+    return {key: data[key] for key in DEMO_FIELDS}
+
+class ShardedDemoWriter:
+    '''Append-only sharded dataset, one fixed-dtype .npy file per field and shard plus a JSON index.
+
+    Rows are buffered in a preallocated shard-sized array and written out whenever it fills,
+    so collection memory stays bounded by one shard regardless of the dataset size. The index
+    is rewritten (atomically) after each shard, opening an existing directory appends to it.'''
+    def __init__(self, root, shard_size=1_000_000, dtype=np.float32):
+        self.root = root
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+        os.makedirs(root, exist_ok=True)
+        index_path = os.path.join(root, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+            self.dtype = np.dtype(self.index["dtype"])
+        else:
+            self.index = {"dtype": self.dtype.name, "fields": {}, "shards": [], "length": 0}
+        self._buffers = None
+        self._fill = 0
+
+    def __len__(self):
+        return self.index["length"] + self._fill
+
+    def append(self, **fields):
+        '''Add a batch of transitions, leading dims (e.g. num_envs) are flattened into rows'''
+        rows = {key: np.asarray(value, dtype=self.dtype).reshape(-1, np.shape(value)[-1]) for key, value in fields.items()}
+        if self._buffers is None:
+            self._open_buffers(rows)
+        num_rows = next(iter(rows.values())).shape[0]
+        start = 0
+        while start < num_rows:
+            take = min(num_rows - start, self.shard_size - self._fill)
+            for key, buffer in self._buffers.items():
+                buffer[self._fill:self._fill + take] = rows[key][start:start + take]
+            self._fill += take
+            start += take
+            if self._fill == self.shard_size:
+                self.flush()
+
+    def _open_buffers(self, rows):
+        if self.index["fields"]:
+            assert set(rows) == set(self.index["fields"]), f"Fields {sorted(rows)} do not match dataset fields {sorted(self.index['fields'])}"
+        else:
+            self.index["fields"] = {key: value.shape[-1] for key, value in rows.items()}
+        self._buffers = {key: np.empty((self.shard_size, dim), dtype=self.dtype) for key, dim in self.index["fields"].items()}
+
+    def flush(self):
+        '''Write the buffered rows out as a new shard and update the index'''
+        if self._fill == 0:
+            return
+        shard_id = len(self.index["shards"])
+        for key, buffer in self._buffers.items():
+            np.save(os.path.join(self.root, f"{key}_{shard_id:05d}.npy"), buffer[:self._fill])
+        self.index["shards"].append({"id": shard_id, "length": self._fill})
+        self.index["length"] += self._fill
+        self._fill = 0
+        self._write_index()
+
+    def _write_index(self):
+        tmp_path = os.path.join(self.root, INDEX_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.root, INDEX_FILE))
+
+    def absorb(self, part_root):
+        '''Move every shard of another dataset (e.g. one written by a collection worker) into
+        this one. Shard files are renamed, not copied, and part_root is removed afterwards.'''
+        self.flush()
+        with open(os.path.join(part_root, INDEX_FILE)) as f:
+            part_index = json.load(f)
+        if not part_index["shards"]:
+            os.remove(os.path.join(part_root, INDEX_FILE))
+            os.rmdir(part_root)
+            return
+        if self.index["fields"]:
+            assert part_index["fields"] == self.index["fields"] and part_index["dtype"] == self.index["dtype"], \
+                f"{part_root} does not match the fields/dtype of {self.root}"
+        else:
+            self.index["fields"], self.index["dtype"] = part_index["fields"], part_index["dtype"]
+            self.dtype = np.dtype(part_index["dtype"])
+        for shard in part_index["shards"]:
+            shard_id = len(self.index["shards"])
+            for key in part_index["fields"]:
+                os.replace(os.path.join(part_root, f"{key}_{shard['id']:05d}.npy"),
+                           os.path.join(self.root, f"{key}_{shard_id:05d}.npy"))
+            self.index["shards"].append({"id": shard_id, "length": shard["length"]})
+            self.index["length"] += shard["length"]
+        self._write_index()
+        os.remove(os.path.join(part_root, INDEX_FILE))
+        os.rmdir(part_root)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ShardedDemoReader:
+    '''Read side of a sharded dataset, every shard is opened with np.memmap so nothing is
+    loaded until rows are actually requested.'''
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.fields = self.index["fields"]
+        self.shards = [
+            {key: np.load(os.path.join(root, f"{key}_{shard['id']:05d}.npy"), mmap_mode="r") for key in self.fields}
+            for shard in self.index["shards"]
+        ]
+        lengths = [shard["length"] for shard in self.index["shards"]]
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def dim(self, key):
+        return self.fields[key]
+
+    def read(self, start, stop):
+        '''Contiguous rows [start, stop) as host arrays, only the touched shards are paged in'''
+        out = {key: np.empty((stop - start, dim), dtype=self.index["dtype"]) for key, dim in self.fields.items()}
+        first = np.searchsorted(self.offsets, start, side="right") - 1
+        pos = start
+        for shard_idx in range(first, len(self.shards)):
+            if pos >= stop:
+                break
+            lo = pos - self.offsets[shard_idx]
+            hi = min(stop, self.offsets[shard_idx + 1]) - self.offsets[shard_idx]
+            for key in self.fields:
+                out[key][pos - start:pos - start + hi - lo] = self.shards[shard_idx][key][lo:hi]
+            pos += hi - lo
+        return out
+
+    def scalar_stats(self, key, chunk_rows=1 << 20):
+        '''Mean and (unbiased) std over every element of a field, streamed chunk by chunk'''
+        total, total_sq, count = 0.0, 0.0, 0
+        for shard in self.shards:
+            values = shard[key]
+            for lo in range(0, values.shape[0], chunk_rows):
+                chunk = np.asarray(values[lo:lo + chunk_rows], dtype=np.float64)
+                total += chunk.sum()
+                total_sq += np.square(chunk).sum()
+                count += chunk.size
+        mean = total / count
+        std = math.sqrt(max(total_sq - count * mean ** 2, 0.0) / max(count - 1, 1))
+        return mean, std
+
+    def batches(self, batch_size, start=0, stop=None, shuffle=False, device="cpu", normalize=None, block_batches=64):
+        '''Lazy minibatch iterator over rows [start, stop), see DemoBatches'''
+        stop = len(self) if stop is None else stop
+        return DemoBatches(self, batch_size, start, stop, shuffle, device, normalize, block_batches)
+
+class DemoBatches:
+    '''Minibatches of (states, actions, next_states) tensors read straight from the memmaps.
+
+    Shuffling is done per block: the order of blocks of block_batches * batch_size rows is
+    permuted and rows are permuted inside each block, so reads stay sequential on disk while
+    batches still mix transitions from all over the block. normalize maps a field to the
+    (mean, std) it is standardized with. Has a len() like a DataLoader.'''
+    def __init__(self, reader, batch_size, start, stop, shuffle, device, normalize, block_batches):
+        self.reader = reader
+        self.batch_size = batch_size
+        self.start, self.stop = start, stop
+        self.shuffle = shuffle
+        self.device = torch.device(device)
+        self.normalize = normalize or {}
+        self.block_size = batch_size * block_batches
+
+    def __len__(self):
+        return math.ceil((self.stop - self.start) / self.batch_size)
+
+    def __iter__(self):
+        block_starts = np.arange(self.start, self.stop, self.block_size)
+        if self.shuffle:
+            block_starts = np.random.permutation(block_starts)
+        for block_start in block_starts:
+            block = self.reader.read(block_start, min(block_start + self.block_size, self.stop))
+            tensors = []
+            for key in DEMO_FIELDS:
+                tensor = torch.from_numpy(block[key]).to(self.device, non_blocking=True)
+                if key in self.normalize:
+                    mean, std = self.normalize[key]
+                    tensor = (tensor - mean) / (std + 1e-8)
+                tensors.append(tensor)
+            num_rows = tensors[0].shape[0]
+            order = torch.randperm(num_rows, device=self.device) if self.shuffle else torch.arange(num_rows, device=self.device)
+            for lo in range(0, num_rows, self.batch_size):
+                rows = order[lo:lo + self.batch_size]
+                yield tuple(tensor[rows] for tensor in tensors)
+
+class ImitationData:
+    '''Imitation transitions loaded from disk once and kept in memory for the whole run.
+
+    on_device=True keeps a copy on the training device, otherwise a (pinned, when training
+    on cuda) host copy is kept and only the sampled rows are transferred.'''
+    def __init__(self, file_path, device, on_device=True):
+        data = load_demonstrations(file_path)
+        self.device = torch.device(device)
+        storage_device = self.device if on_device else torch.device("cpu")
+        tensors = []
+        for key in DEMO_FIELDS:
+            tensor = torch.as_tensor(data[key], dtype=torch.float32)
+            # collected from a vector env, so rows may carry an extra env dimension
+            tensor = tensor.reshape(-1, tensor.shape[-1]).to(storage_device)
+            if not on_device and self.device.type == "cuda":
+                tensor = tensor.pin_memory()
+            tensors.append(tensor)
+        self.states, self.actions, self.next_states = tensors
+        print(f'Loaded Imitation Data of Size: {len(self)}')
+
+    def __len__(self):
+        return self.states.shape[0]
+
+    def gather(self, indices):
+        '''Rows at indices, moved to the training device'''
+        indices = indices.to(self.states.device)
+        return tuple(t[indices].to(self.device, non_blocking=True) for t in (self.states, self.actions, self.next_states))
+
+    def sample(self, batch_size):
+        '''Uniformly sample batch_size transitions without replacement'''
+        indices = torch.randperm(len(self), device=self.states.device)[:batch_size]
+        return self.gather(indices)
+
+    def mixed_batch(self, ppo_states, ppo_actions, ppo_next_states, imitation_ratio=None):
+        '''Swap part of a rollout for imitation transitions, output keeps the rollout shape.
+
+        With imitation_ratio=None the number of imitation rows follows the same hypergeometric
+        draw as shuffling the concatenation of rollout and imitation data and keeping the first
+        rollout-sized chunk, which is what the trainers did before. A float fixes the fraction
+        of imitation rows instead. Only the selected rows are copied.'''
+        obs_dim, action_dim = ppo_states.shape[-1], ppo_actions.shape[-1]
+        flat_states = ppo_states.reshape(-1, obs_dim)
+        flat_actions = ppo_actions.reshape(-1, action_dim)
+        flat_next_states = ppo_next_states.reshape(-1, obs_dim)
+        batch_size = flat_states.shape[0]
+
+        if imitation_ratio is None:
+            num_imitation = int(np.random.hypergeometric(len(self), batch_size, batch_size))
+        else:
+            num_imitation = int(round(imitation_ratio * batch_size))
+        num_imitation = min(num_imitation, len(self), batch_size)
+
+        keep = torch.randperm(batch_size, device=flat_states.device)[:batch_size - num_imitation]
+        imitation_states, imitation_actions, imitation_next_states = self.sample(num_imitation)
+
+        mixed_states = torch.cat([flat_states[keep], imitation_states], dim=0)
+        mixed_actions = torch.cat([flat_actions[keep], imitation_actions], dim=0)
+        mixed_next_states = torch.cat([flat_next_states[keep], imitation_next_states], dim=0)
+
+        return (mixed_states.reshape(ppo_states.shape),
+                mixed_actions.reshape(ppo_actions.shape),
+                mixed_next_states.reshape(ppo_next_states.shape))
+
+def sharded_dataloaders(root, batch_size, device, split=0.8):
+    '''Train/validation batch iterators over a sharded dataset for the supervised UPN trainers.
+
+    States and actions are standardized with their global scalar mean/std like load_data does,
+    the stats are streamed from the memmaps instead of computed on a fully loaded copy.'''
+    reader = ShardedDemoReader(root)
+    normalize = {key: reader.scalar_stats(key) for key in ("states", "actions")}
+    split_idx = int(split * len(reader))
+    train_batches = reader.batches(batch_size, 0, split_idx, shuffle=True, device=device, normalize=normalize)
+    val_batches = reader.batches(batch_size, split_idx, len(reader), shuffle=False, device=device, normalize=normalize)
+    print(f"Sharded dataset {root}: {len(reader)} transitions in {len(reader.shards)} shards")
+    return train_batches, val_batches, reader.dim("states"), reader.dim("actions")
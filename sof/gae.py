@@ -0,0 +1,48 @@
+import torch
+
+## Generalized Advantage Estimation shared by all PPO trainers
+
+def compute_gae_loop(rewards, values, dones, next_value, next_done, gamma, gae_lambda):
+    '''Reference per-timestep loop, exactly what the trainers used to run inline'''
+    num_steps = rewards.shape[0]
+    next_value = next_value.reshape(1, -1)
+    advantages = torch.zeros_like(rewards)
+    lastgaelam = 0
+    for t in reversed(range(num_steps)):
+        if t == num_steps - 1:
+            nextnonterminal = 1.0 - next_done
+            nextvalues = next_value
+        else:
+            nextnonterminal = 1.0 - dones[t + 1]
+            nextvalues = values[t + 1]
+        delta = rewards[t] + gamma * nextvalues * nextnonterminal - values[t]
+        advantages[t] = lastgaelam = delta + gamma * gae_lambda * nextnonterminal * lastgaelam
+    returns = advantages + values
+    return advantages, returns
+
+@torch.jit.script
+def _discounted_reverse_scan(deltas: torch.Tensor, discounts: torch.Tensor) -> torch.Tensor:
+    '''x[t] = deltas[t] + discounts[t] * x[t + 1], scanned from the back over dim 0'''
+    num_steps = deltas.shape[0]
+    out = torch.empty_like(deltas)
+    carry = torch.zeros_like(deltas[0])
+    for i in range(num_steps):
+        t = num_steps - 1 - i
+        carry = deltas[t] + discounts[t] * carry
+        out[t] = carry
+    return out
+
+def compute_gae(rewards, values, dones, next_value, next_done, gamma, gae_lambda):
+    '''Batched GAE over a (num_steps, num_envs) rollout.
+
+    All TD errors and per-step discounts are built in a handful of tensor ops, only the
+    reverse recurrence is left and that runs inside a TorchScript kernel instead of the
+    Python interpreter. dones[t] marks that obs[t] started a new episode, so the bootstrap
+    at step t is masked by dones[t + 1] (next_done for the last step), same as the loop.'''
+    next_value = next_value.reshape(1, -1)
+    nextnonterminal = 1.0 - torch.cat([dones[1:], next_done.reshape(1, -1)], dim=0)
+    nextvalues = torch.cat([values[1:], next_value], dim=0)
+    deltas = rewards + gamma * nextvalues * nextnonterminal - values
+    advantages = _discounted_reverse_scan(deltas, gamma * gae_lambda * nextnonterminal)
+    returns = advantages + values
+    return advantages, returns
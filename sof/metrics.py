@@ -0,0 +1,97 @@
+from collections import defaultdict
+
+import torch
+
+## Training metrics with one host sync per iteration
+
+class MetricsTracker:
+    '''Drop-in for the trainers' dict of metric lists.
+
+    Tensors passed to add() (averaged over the iteration) and set() (last value wins) stay on
+    the device until flush(), which stacks everything pending, moves it to the host in a single
+    transfer and emits one value per key. With a RunLogger attached those values and the
+    episodes from log_episode() are streamed to disk and nothing is kept in memory. Without
+    one they are appended to the history, and metrics[key] returns that plain list.'''
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.history = defaultdict(list)
+        self._sums = {}
+        self._counts = {}
+        self._last = {}
+        self._host = {}
+        self._grad_names = None
+        self._grad_nonfinite = None
+
+    def __getitem__(self, key):
+        return self.history[key]
+
+    def items(self):
+        return self.history.items()
+
+    def add(self, key, value):
+        '''Accumulate a per-minibatch value, flushed as the mean over the iteration'''
+        value = value.detach() if torch.is_tensor(value) else torch.tensor(float(value))
+        self._sums[key] = self._sums[key] + value if key in self._sums else value
+        self._counts[key] = self._counts.get(key, 0) + 1
+
+    def set(self, key, value):
+        '''Record a value once per iteration, only the last one before flush() is kept'''
+        if torch.is_tensor(value):
+            self._last[key] = value.detach()
+        else:
+            self._host[key] = float(value)
+
+    def log_episode(self, global_step, episodic_return, episodic_length):
+        '''Host-side episode statistics, written straight through'''
+        # RecordEpisodeStatistics hands out 1-element arrays
+        episodic_return = float(episodic_return.item() if hasattr(episodic_return, "item") else episodic_return)
+        episodic_length = int(episodic_length.item() if hasattr(episodic_length, "item") else episodic_length)
+        if self.logger is not None:
+            self.logger.log("episode", global_step=global_step, episodic_return=episodic_return,
+                            episodic_length=episodic_length)
+        else:
+            self.history["episodic_returns"].append(episodic_return)
+            self.history["episodic_lengths"].append(episodic_length)
+
+    def check_grads(self, named_parameters):
+        '''Non-finite gradient check fused into one foreach norm over all gradients. The flags stay
+        on the device and are OR-ed across minibatches, offending names are printed by flush()'''
+        names, grads = [], []
+        for name, param in named_parameters:
+            if param.grad is not None:
+                names.append(name)
+                grads.append(param.grad)
+        if not grads:
+            return
+        nonfinite = ~torch.isfinite(torch.stack(torch._foreach_norm(grads)))
+        if self._grad_names != names:
+            # the set of parameters holding gradients changed, start a fresh flag vector
+            self._flush_grad_flags()
+            self._grad_names, self._grad_nonfinite = names, nonfinite
+        else:
+            self._grad_nonfinite |= nonfinite
+
+    def _flush_grad_flags(self):
+        if self._grad_nonfinite is not None:
+            for name, flag in zip(self._grad_names, self._grad_nonfinite.tolist()):
+                if flag:
+                    print(f"NaN or Inf detected in gradients of {name}")
+        self._grad_names, self._grad_nonfinite = None, None
+
+    def flush(self, **step):
+        '''Single device-to-host transfer for everything recorded since the last flush.
+        Keyword arguments (global_step, iteration) are written along with the values.'''
+        keys = list(self._sums) + list(self._last)
+        pending = [self._sums[key] / self._counts[key] for key in self._sums] + [self._last[key] for key in self._last]
+        record = dict(self._host)
+        if pending:
+            device = pending[0].device
+            values = torch.stack([value.to(device, torch.float32).reshape(()) for value in pending]).tolist()
+            record.update(zip(keys, values))
+        if self.logger is not None:
+            self.logger.log("iteration", **step, **record)
+        else:
+            for key, value in record.items():
+                self.history[key].append(value)
+        self._sums, self._counts, self._last, self._host = {}, {}, {}, {}
+        self._flush_grad_flags()
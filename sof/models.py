@@ -4,6 +4,7 @@ from config import args_sof, args_ppo
 import torch
 import torch.nn as nn
 from torch.distributions import Normal
+from inference import sample_gaussian
 
 from optimization_utils import *
 
@@ -54,10 +55,13 @@ class UPN(nn.Module):
         h = self.encoder(x)
         return self.enc_mean(h), self.enc_logvar(h)
 
-    def forward(self, state, action, next_state):
-        # Encode current state
-        mu, logvar = self.encode(state)
-        z = self.reparameterize(mu, logvar)
+    def forward(self, state, action, next_state, encoded=None):
+        # Encode current state, unless the caller already did (mu, logvar, z)
+        if encoded is None:
+            mu, logvar = self.encode(state)
+            z = self.reparameterize(mu, logvar)
+        else:
+            mu, logvar, z = encoded
         
         # Encode next state
         mu_next, logvar_next = self.encode(next_state)
@@ -121,10 +125,19 @@ class Agent_sof(nn.Module):
         z = self.upn.reparameterize(mu, logvar)
         return self.critic(z)
 
-    def get_action_and_value(self, x, action=None):
+    def encode(self, x):
+        '''mu, logvar and a reparameterized z of x, computed once per minibatch and shared by
+        the PPO loss, the UPN loss and the KL constraint terms'''
         mu, logvar = self.upn.encode(x)
-        z = self.upn.reparameterize(mu, logvar)
-        action_mean = self.actor_mean(z)
+        return mu, logvar, self.upn.reparameterize(mu, logvar)
+
+    def get_action_and_value(self, x, action=None, z=None):
+        if z is None:
+            mu, logvar = self.upn.encode(x)
+            z = self.upn.reparameterize(mu, logvar)
+        # the networks may run under autocast, the distribution, the log probs and the value
+        # are kept in fp32 so the PPO ratio and losses are not computed from bf16 values
+        action_mean = self.actor_mean(z).float()
         action_logstd = self.actor_logstd.expand_as(action_mean)
         action_std = torch.exp(action_logstd)
         probs = Normal(action_mean, action_std)
@@ -132,7 +145,15 @@ class Agent_sof(nn.Module):
         if action is None:
             action = probs.sample()
 
-        return action, probs.log_prob(action).sum(1), probs.entropy().sum(1), self.critic(z)
+        return action, probs.log_prob(action).sum(1), probs.entropy().sum(1), self.critic(z).float()
+
+    def act(self, x):
+        '''Rollout fast path of get_action_and_value: sampled action, its log prob and the value,
+        without the Normal object or the unused entropy, so it can go through torch.compile'''
+        mu, logvar = self.upn.encode(x)
+        z = self.upn.reparameterize(mu, logvar)
+        action, logprob = sample_gaussian(self.actor_mean(z), self.actor_logstd)
+        return action, logprob, self.critic(z).flatten()
     
     def get_transformed_action_distribution(self, z):
         """ Map action space to latent space dimension, both action mean and action logstd"""
@@ -140,7 +161,7 @@ class Agent_sof(nn.Module):
         action_logstd = self.actor_logstd.expand_as(action_mean)
         action_latent_mean = self.action_mean_to_latent(action_mean)
         action_latent_var = self.action_var_to_latent(action_logstd)
-        return action_latent_mean, action_latent_var
+        return action_latent_mean.float(), action_latent_var.float()
     
     def load_upn(self, file_path):
         '''Load only the UPN model parameters from the specified file path,
@@ -196,4 +217,10 @@ class Agent_ppo(nn.Module):
         probs = Normal(action_mean, action_std)
         if action is None:
             action = probs.sample()
-        return action, probs.log_prob(action).sum(1), probs.entropy().sum(1), self.critic(x)
\ No newline at end of file
+        return action, probs.log_prob(action).sum(1), probs.entropy().sum(1), self.critic(x)
+
+    def act(self, x):
+        '''Rollout fast path of get_action_and_value: sampled action, its log prob and the value,
+        without the Normal object or the unused entropy, so it can go through torch.compile'''
+        action, logprob = sample_gaussian(self.actor_mean(x), self.actor_logstd)
+        return action, logprob, self.critic(x).flatten()
\ No newline at end of file
@@ -0,0 +1,134 @@
+import os
+import numpy as np
+import gymnasium as gym
+
+## Vector-level observation/reward normalization with statistics shared by all sub-envs
+
+def normalizer_path(checkpoint_path):
+    '''Where the normalization statistics of a checkpoint live, next to the .pth'''
+    return os.path.splitext(checkpoint_path)[0] + "_norm.npz"
+
+class RunningMeanStd:
+    '''Running mean/var over a stream of batches, the parallel update gym's wrappers use'''
+    def __init__(self, shape=(), epsilon=1e-4):
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.var = np.ones(shape, dtype=np.float64)
+        self.count = epsilon
+
+    def update(self, x):
+        batch_mean = np.mean(x, axis=0)
+        batch_var = np.var(x, axis=0)
+        batch_count = x.shape[0]
+
+        delta = batch_mean - self.mean
+        total_count = self.count + batch_count
+        self.mean = self.mean + delta * batch_count / total_count
+        m2 = self.var * self.count + batch_var * batch_count + np.square(delta) * self.count * batch_count / total_count
+        self.var = m2 / total_count
+        self.count = total_count
+
+class VectorNormalize(gym.vector.VectorEnvWrapper):
+    '''Replaces the per sub-env NormalizeObservation/TransformObservation/NormalizeReward/TransformReward
+    stack with one stage on the whole batch.
+
+    Observations are normalized with one running mean/var updated from every sub-env, rewards are
+    scaled by the std of the discounted return, both then clipped to +-clip. infos["final_observation"]
+    is normalized with the same statistics (without updating them). freeze() stops the updates, e.g. for
+    evaluation with the statistics a checkpoint was trained with, see save()/load().'''
+    def __init__(self, env, gamma=0.99, clip_obs=10.0, clip_reward=10.0, epsilon=1e-8,
+                 normalize_obs=True, normalize_reward=True):
+        super().__init__(env)
+        self.gamma = gamma
+        self.clip_obs = clip_obs
+        self.clip_reward = clip_reward
+        self.epsilon = epsilon
+        self.normalize_obs = normalize_obs
+        self.normalize_reward = normalize_reward
+        self.obs_rms = RunningMeanStd(shape=self.single_observation_space.shape)
+        self.return_rms = RunningMeanStd(shape=())
+        self.returns = np.zeros(self.num_envs, dtype=np.float64)
+        self.training = True
+
+    def freeze(self):
+        self.training = False
+        return self
+
+    def unfreeze(self):
+        self.training = True
+        return self
+
+    def _normalize_obs(self, obs, update=True):
+        if not self.normalize_obs:
+            return obs
+        if update and self.training:
+            self.obs_rms.update(obs)
+        obs = ((obs - self.obs_rms.mean) / np.sqrt(self.obs_rms.var + self.epsilon)).astype(np.float32)
+        return np.clip(obs, -self.clip_obs, self.clip_obs, out=obs)
+
+    def _normalize_reward(self, rewards, terminations):
+        if not self.normalize_reward:
+            return rewards
+        self.returns = self.returns * self.gamma * (1 - terminations) + rewards
+        if self.training:
+            self.return_rms.update(self.returns)
+        rewards = rewards / np.sqrt(self.return_rms.var + self.epsilon)
+        return np.clip(rewards, -self.clip_reward, self.clip_reward, out=rewards)
+
+    def reset(self, **kwargs):
+        obs, infos = self.env.reset(**kwargs)
+        self.returns[:] = 0.0
+        return self._normalize_obs(obs), infos
+
+    def _normalize_step(self, obs, rewards, terminations, truncations, infos):
+        if self.normalize_obs and "final_observation" in infos:
+            final_obs = infos["final_observation"].copy()
+            # object array with None for the sub-envs that did not finish
+            for i in np.nonzero(infos["_final_observation"])[0]:
+                final_obs[i] = self._normalize_obs(np.asarray(final_obs[i])[None], update=False)[0]
+            infos["final_observation"] = final_obs
+        obs = self._normalize_obs(obs)
+        rewards = self._normalize_reward(np.asarray(rewards, dtype=np.float64), terminations)
+        return obs, rewards, terminations, truncations, infos
+
+    def step(self, actions):
+        return self._normalize_step(*self.env.step(actions))
+
+    # VectorEnvWrapper passes step_async/step_wait straight through to the inner env, callers that
+    # overlap several vector envs (multiseed.py) would get raw observations and rewards without these
+    def step_async(self, actions):
+        self.env.step_async(actions)
+
+    def step_wait(self):
+        return self._normalize_step(*self.env.step_wait())
+
+    def state_dict(self):
+        return {
+            "obs_mean": self.obs_rms.mean, "obs_var": self.obs_rms.var, "obs_count": self.obs_rms.count,
+            "return_mean": self.return_rms.mean, "return_var": self.return_rms.var, "return_count": self.return_rms.count,
+        }
+
+    def load_state_dict(self, state):
+        self.obs_rms.mean = np.asarray(state["obs_mean"], dtype=np.float64)
+        self.obs_rms.var = np.asarray(state["obs_var"], dtype=np.float64)
+        self.obs_rms.count = float(state["obs_count"])
+        self.return_rms.mean = np.asarray(state["return_mean"], dtype=np.float64)
+        self.return_rms.var = np.asarray(state["return_var"], dtype=np.float64)
+        self.return_rms.count = float(state["return_count"])
+
+    def save(self, path):
+        np.savez(path, **self.state_dict())
+
+    def load(self, path, freeze=True):
+        '''Load statistics saved with save(), frozen by default. Checkpoints from before the vector
+        normalization have no statistics file, those keep normalizing from scratch like they used to.'''
+        if not os.path.exists(path):
+            print(f"No normalization statistics at {path}, starting from fresh running statistics")
+            self.obs_rms = RunningMeanStd(shape=self.single_observation_space.shape)
+            self.return_rms = RunningMeanStd(shape=())
+            self.unfreeze()
+            return False
+        with np.load(path) as state:
+            self.load_state_dict(state)
+        if freeze:
+            self.freeze()
+        return True
@@ -1,4 +1,5 @@
 import os
+import math
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -6,7 +7,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributions import Normal
-from scipy.optimize import minimize
 
 from config import args_sof, args_supp
 
@@ -87,18 +87,17 @@ def unfreeze_base_controller(agent):
         param.requires_grad = True
     agent.actor_logstd.requires_grad = True
 
-def compute_hidden_action_distribution(agent, state, advantage, epsilon_k, eta_k):
+def compute_hidden_action_distribution(agent, state, advantage, epsilon_k, eta_k, z=None):
     """
     Compute the softened intention policy distribution (optimal action distribution) based on the current base policy and advantage values.
     This approximates the EM algorithm's expectation step, adjusting the policy softly towards higher-advantage actions.
     """
     with torch.no_grad():
-        mu, logvar = agent.upn.encode(state)
-        z = agent.upn.reparameterize(mu, logvar)
-        action_mean, action_std = agent.actor_mean(z), agent.actor_logstd.exp()
+        if z is None:
+            mu, logvar = agent.upn.encode(state)
+            z = agent.upn.reparameterize(mu, logvar)
+        action_mean, action_std = agent.actor_mean(z).float(), agent.actor_logstd.exp()
         base_dist = Normal(action_mean, action_std)
-        # eta_k = optimize_eta_k(state, advantage, base_dist, epsilon_k)
-        # print(eta_k)
 
         # Softened intention distribution using advantage weights
         weights = (advantage.view(-1, 1) / eta_k).exp()
@@ -110,14 +109,15 @@ def compute_hidden_action_distribution(agent, state, advantage, epsilon_k, eta_k
     return hidden_dist
 
 
-def compute_lagrangian_kl_constraint(agent, state, eta_k, epsilon_k, hidden_dist):
+def compute_lagrangian_kl_constraint(agent, state, eta_k, epsilon_k, hidden_dist, z=None):
     """Compute KL divergence between optimal "soften" intention disytribution and current base control policy distribution"""
     with torch.no_grad():
         # is this still needed?
         # action_latent_mean, action_latent_var = agent.get_transformed_action_distribution(z)
-        mu, logvar = agent.upn.encode(state)
-        z = agent.upn.reparameterize(mu, logvar)
-        action_mean, action_std = agent.actor_mean(z), agent.actor_logstd.exp()
+        if z is None:
+            mu, logvar = agent.upn.encode(state)
+            z = agent.upn.reparameterize(mu, logvar)
+        action_mean, action_std = agent.actor_mean(z).float(), agent.actor_logstd.exp()
         ppo_dist = Normal(action_mean, torch.exp(action_std))
         kl_div = torch.distributions.kl_divergence(hidden_dist, ppo_dist).mean()
         constraint_violation = F.relu(kl_div - epsilon_k)
@@ -125,10 +125,37 @@ def compute_lagrangian_kl_constraint(agent, state, eta_k, epsilon_k, hidden_dist
     return eta_k * constraint_violation
 
 
-def compute_upn_loss(upn, state, action, next_state):
+def compute_ppo_loss(agent, obs, actions, logprobs, advantages, returns, values, clip_coef, norm_adv=True,
+                     clip_vloss=True, z=None):
+    '''Clipped PPO policy and value losses of one minibatch. get_action_and_value hands back fp32
+    log probs and values, so under autocast only the networks run in low precision.
+    Returns ratio, logratio, pg_loss, v_loss, entropy_loss'''
+    _, newlogprob, entropy, newvalue = agent.get_action_and_value(obs, actions, z=z)
+    logratio = newlogprob - logprobs
+    ratio = logratio.exp()
+
+    if norm_adv:
+        advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+
+    pg_loss1 = -advantages * ratio
+    pg_loss2 = -advantages * torch.clamp(ratio, 1 - clip_coef, 1 + clip_coef)
+    pg_loss = torch.max(pg_loss1, pg_loss2).mean()
+
+    newvalue = newvalue.view(-1)
+    if clip_vloss:
+        v_loss_unclipped = (newvalue - returns) ** 2
+        v_clipped = values + torch.clamp(newvalue - values, -clip_coef, clip_coef)
+        v_loss_clipped = (v_clipped - returns) ** 2
+        v_loss = 0.5 * torch.max(v_loss_unclipped, v_loss_clipped).mean()
+    else:
+        v_loss = 0.5 * ((newvalue - returns) ** 2).mean()
+
+    return ratio, logratio, pg_loss, v_loss, entropy.mean()
+
+def compute_upn_loss(upn, state, action, next_state, encoded=None):
     '''Compute sololy UPN losses'''
     z, z_next, z_pred, action_pred, state_recon, next_state_recon, next_state_pred, \
-        mu, logvar, mu_next, logvar_next = upn(state, action, next_state)
+        mu, logvar, mu_next, logvar_next = (output.float() for output in upn(state, action, next_state, encoded=encoded))
     
     recon_loss = F.mse_loss(state_recon, state) + F.mse_loss(next_state_recon, next_state)
     consistency_loss = F.mse_loss(next_state_pred, next_state)
@@ -149,86 +176,39 @@ def compute_eta_k_loss(agent, b_advantages, epsilon_k):
     return eta_loss
 
 
-def eta_k_objective(eta, states, advantages, old_policy, epsilon_k):
+def eta_k_dual(eta, advantages, epsilon_k):
     """
-    Objective function for optimizing eta_k.
+    Dual of the KL-constrained E-step, g(eta) = eta * epsilon_k + eta * log mean_i exp(A_i / eta),
+    evaluated for all states in one log-sum-exp. Differentiable in eta through autograd.
     """
-    eta = eta[0]  # extract scalar from array input by scipy
-    log_expectation_sum = 0
+    advantages = advantages.reshape(-1)
+    log_mean_exp = torch.logsumexp(advantages / eta, dim=0) - math.log(advantages.numel())
+    return eta * epsilon_k + eta * log_mean_exp
 
-    with torch.no_grad():
-        for i, state in enumerate(states):
-            # Sample actions from the old policy distribution
-            action_mean, action_std = old_policy.mean[i], old_policy.stddev[i]
-            action_dist = Normal(action_mean, action_std)
-            sampled_actions = action_dist.sample((10,))  # Sample 10 actions per state
-
-            # Compute the exponentiated advantage divided by eta
-            exp_adv_scaled = (advantages[i] / eta).exp()
-            weighted_adv = exp_adv_scaled * action_dist.log_prob(sampled_actions).exp()
-            log_expectation = torch.log(weighted_adv.mean())
-            log_expectation_sum += log_expectation.item()
-        
-    # Compute the full objective
-    objective_value = eta * epsilon_k + eta * (log_expectation_sum / len(states))
-    return objective_value
-
-
-def optimize_eta_k(states, advantages, old_policy, epsilon_k):
+
+def eta_k_dual_grad(eta, advantages, epsilon_k):
+    """
+    Closed form dg/deta = epsilon_k + log mean exp(A / eta) - E_w[A] / eta, with w = softmax(A / eta).
+    """
+    advantages = advantages.reshape(-1)
+    scaled = advantages / eta
+    log_mean_exp = torch.logsumexp(scaled, dim=0) - math.log(advantages.numel())
+    weighted_adv = (torch.softmax(scaled, dim=0) * advantages).sum()
+    return epsilon_k + log_mean_exp - weighted_adv / eta
+
+
+def optimize_eta_k(advantages, epsilon_k, eta_min=1e-3, eta_max=1e3, num_iters=40):
     """
-    Optimize eta_k using scipy's minimize function.
+    Minimize the eta_k dual on device. g(eta) is convex, so its derivative is monotone and a
+    bisection in log(eta) finds the root without any host sync. Returns a 0-dim tensor.
     """
-    # Initial guess for eta
-    eta_initial = 1.0
-    result = minimize(eta_k_objective, [eta_initial], args=(states, advantages, old_policy, epsilon_k),
-                      bounds=[(1e-3, None)], method="L-BFGS-B")  # Ensure eta is positive
-    return result.x[0]  # Optimized eta_k
-
-
-def mixed_batch(ppo_states, ppo_actions, ppo_next_states):
-    '''3D: sample_size, env_dim, Dof_dim, no sample, concatination direclty'''
-
-    # Load imitation data
-    save_dir = os.path.join(os.getcwd(), 'sfm', 'data')
-    os.makedirs(save_dir, exist_ok=True)
-    data_path = os.path.join(save_dir, args_sof.imitation_data_path)
-    imitation_data = np.load(data_path)
-    imitation_states = torch.FloatTensor(imitation_data['states']).to(args_sof.device)
-    imitation_actions = torch.FloatTensor(imitation_data['actions']).to(args_sof.device)
-    imitation_next_states = torch.FloatTensor(imitation_data['next_states']).to(args_sof.device)
-
-    print(f'Mixing Imitation Data of Size: {imitation_states.shape[0]}')
-
-    # Ensure imitation data has the same 3D shape as PPO data
-    if imitation_states.dim() == 2:
-        imitation_states = imitation_states.unsqueeze(1)
-        imitation_actions = imitation_actions.unsqueeze(1)
-        imitation_next_states = imitation_next_states.unsqueeze(1)
-
-    # Combine PPO and imitation data
-    mixed_states = torch.cat([ppo_states, imitation_states], dim=0)
-    mixed_actions = torch.cat([ppo_actions, imitation_actions], dim=0)
-    mixed_next_states = torch.cat([ppo_next_states, imitation_next_states], dim=0)
-
-    # Shuffle the combined data
-    shuffle_indices = torch.randperm(mixed_states.shape[0])
-    mixed_states = mixed_states[shuffle_indices]
-    mixed_actions = mixed_actions[shuffle_indices]
-    mixed_next_states = mixed_next_states[shuffle_indices]
-
-    print(f'Total Mixed Imitation Data of Size: {mixed_states.shape[0]}')
-
-    return mixed_states, mixed_actions, mixed_next_states
-
-def plot_metrics(metrics, show_result=False):
-    plt.figure(figsize=(12, 8))
-    plt.clf()
-    plt.title("Training..." if not show_result else "Result")
-    plt.xlabel("Iteration")
-    plt.ylabel("Metrics")
-
-    for key, values in metrics.items():
-        plt.plot(values, label=key)
-
-    plt.legend()
-    plt.pause(0.001)
\ No newline at end of file
+    advantages = advantages.detach().reshape(-1)
+    lo = torch.tensor(math.log(eta_min), device=advantages.device, dtype=advantages.dtype)
+    hi = torch.tensor(math.log(eta_max), device=advantages.device, dtype=advantages.dtype)
+    for _ in range(num_iters):
+        mid = 0.5 * (lo + hi)
+        increasing = eta_k_dual_grad(mid.exp(), advantages, epsilon_k) > 0
+        hi = torch.where(increasing, mid, hi)
+        lo = torch.where(increasing, lo, mid)
+    return (0.5 * (lo + hi)).exp()
+
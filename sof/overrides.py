@@ -0,0 +1,30 @@
+import os
+import json
+from dataclasses import fields
+
+## Args field overrides handed to a run through the environment
+
+OVERRIDES_ENV = "SFM_OVERRIDES"
+OPTIONAL_KEY = "optional" # overrides for every instance that has the field, ignored by the others
+
+def apply_overrides(args, name="args"):
+    '''Set fields of the Args instance from the JSON object in $SFM_OVERRIDES, keyed by the
+    instance name, e.g. SFM_OVERRIDES='{"args": {"upn_coef": 0.5, "seed": 3}}'. This is how
+    sweep.py configures runs without editing the scripts. Unknown fields are an error, except under
+    the "optional" key, whose fields only go to the instances that have them.'''
+    raw = os.environ.get(OVERRIDES_ENV)
+    if not raw:
+        return args
+    overrides = json.loads(raw)
+    values = overrides.get(name, {})
+    known = {f.name for f in fields(args)}
+    unknown = set(values) - known
+    if unknown:
+        raise ValueError(f"Unknown {type(args).__name__} fields in {OVERRIDES_ENV}: {sorted(unknown)}")
+    optional = {key: value for key, value in overrides.get(OPTIONAL_KEY, {}).items() if key in known}
+    values = {**optional, **values}
+    for key, value in values.items():
+        setattr(args, key, value)
+    if values:
+        print(f"{type(args).__name__} overrides: {values}")
+    return args
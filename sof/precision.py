@@ -0,0 +1,48 @@
+import contextlib
+import torch
+
+## Mixed precision for the update phase: autocast forward/loss, fp32 master weights
+
+PRECISIONS = ("fp32", "bf16", "fp16")
+
+def autocast(device, precision="fp32"):
+    '''Autocast context for the forward pass and the loss, backward and the optimizer step stay
+    outside it. Parameters and optimizer state remain fp32, only the matmuls run in low precision.
+    bf16 works on CPU and CUDA, fp16 only on CUDA.'''
+    device_type = torch.device(device).type
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    if precision == "bf16":
+        return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+    if precision == "fp16":
+        if device_type != "cuda":
+            raise ValueError("fp16 autocast needs CUDA, use bf16 on CPU")
+        return torch.autocast(device_type="cuda", dtype=torch.float16)
+    raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+
+def grad_scaler(precision="fp32"):
+    '''Loss scaler, only enabled for fp16: bf16 has fp32's exponent range, so its gradients do not
+    underflow. A disabled scaler passes scale()/step()/update() straight through.'''
+    return torch.cuda.amp.GradScaler(enabled=precision == "fp16")
+
+def loss_parity(loss_fn, device, precision, names=None, rtol=0.05, atol=0.0):
+    '''Evaluate loss_fn() (a tuple or a dict of scalar losses) in fp32 and under autocast from the
+    same RNG state, so sampled latents match, and print the relative difference of every term.
+    Terms further than atol + rtol * |fp32| apart are flagged, atol covers terms that sit near zero
+    like the clipped PPO objective. Returns {name: relative difference}.'''
+    devices = [torch.device(device)] if torch.device(device).type == "cuda" else []
+    with torch.no_grad():
+        with torch.random.fork_rng(devices=devices):
+            reference = loss_fn()
+        with torch.random.fork_rng(devices=devices), autocast(device, precision):
+            low = loss_fn()
+    if isinstance(reference, dict):
+        names, reference, low = list(reference), list(reference.values()), list(low.values())
+    names = names or [f"loss_{i}" for i in range(len(reference))]
+    diffs = {}
+    for name, ref, value in zip(names, reference, low):
+        ref, value = ref.float().item(), value.float().item()
+        diffs[name] = abs(value - ref) / max(abs(ref), 1e-8)
+        flag = "" if abs(value - ref) <= atol + rtol * abs(ref) else f"  <-- above rtol {rtol} (atol {atol})"
+        print(f"{precision} parity {name}: fp32 {ref:.6f}, {precision} {value:.6f}, rel diff {diffs[name]:.2e}{flag}")
+    return diffs
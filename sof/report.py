@@ -0,0 +1,103 @@
+import os
+import sys
+import glob
+from dataclasses import dataclass
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+from run_logger import LOG_FILE, read_run
+
+## Offline training report, rebuilt from a run's metrics.jsonl
+
+@dataclass
+class ReportArgs:
+    run_path: str = None # run directory or metrics.jsonl, None picks the newest run under runs_root
+    runs_root: str = os.path.join(os.getcwd(), 'sof', 'runs')
+    avg_interval: int = 50
+    output: str = "report.png" # written into the run directory
+    show: bool = True
+
+def latest_run(runs_root):
+    runs = glob.glob(os.path.join(runs_root, "*", LOG_FILE))
+    if not runs:
+        raise FileNotFoundError(f"No run logs found under {runs_root}")
+    return os.path.dirname(max(runs, key=os.path.getmtime))
+
+def plot_report(run, avg_interval=50):
+    '''Same panels the trainers used to draw at the end of training. Runs that log the KL
+    constraint (sofppo constrained) get its penalty panel in place of the learning rate.'''
+    episodes, iterations = run["episode"], run["iteration"]
+    plt.figure(figsize=(20, 10))
+
+    plt.subplot(2, 3, 1)
+    episodic_returns = np.array(episodes["episodic_return"]).flatten()
+    plt.plot(episodic_returns)
+
+    # Now apply np.convolve to calculate the rolling average
+    if len(episodic_returns) >= avg_interval:
+        avg_returns = np.convolve(episodic_returns, np.ones(avg_interval) / avg_interval, mode='valid')
+        plt.plot(range(avg_interval - 1, len(episodic_returns)), avg_returns, label=f"{avg_interval}-Episode Average", color="orange")
+
+    plt.title('Episodic Returns')
+    plt.xlabel('Episode')
+    plt.ylabel('Return')
+
+    plt.subplot(2, 3, 2)
+    plt.plot(iterations["approx_kls"])
+    plt.title('Approx KLs')
+    plt.xlabel('Episode')
+    plt.ylabel('Approx KLs')
+
+    plt.subplot(2, 3, 3)
+    if "kl_constrained_penalty" in iterations:
+        plt.plot(iterations["kl_constrained_penalty"])
+        plt.title('KL Constraint Penalty')
+        plt.xlabel('Iteration')
+        plt.ylabel('KL-CP')
+    else:
+        plt.plot(iterations["learning_rates"])
+        plt.title('Learning Rate')
+        plt.xlabel('Iteration')
+        plt.ylabel('LR')
+
+    plt.subplot(2, 3, 4)
+    losses = [("value_losses", 'Value Loss'), ("policy_losses", 'Policy Loss'), ("upn_losses", 'UPN Loss'),
+              ("forward_losses", 'Forward Loss'), ("inverse_losses", 'Inverse Loss'),
+              ("recon_losses", 'Reconstruction Loss'), ("consist_losses", 'Consistency Loss'),
+              ("eta_k_loss", 'Eta K Loss'), ("ewc_losses", 'EWC Loss')]
+    for key, label in losses:
+        if key in iterations:
+            plt.plot(iterations[key], label=label)
+    plt.title('Losses')
+    plt.xlabel('Iteration')
+    plt.ylabel('Loss')
+    plt.legend()
+
+    plt.subplot(2, 3, 5)
+    plt.plot(iterations["entropies"])
+    plt.title('Entropy')
+    plt.xlabel('Iteration')
+    plt.ylabel('Entropy')
+
+    plt.subplot(2, 3, 6)
+    plt.plot(iterations["explained_variances"])
+    plt.title('Explained Variance')
+    plt.xlabel('Iteration')
+    plt.ylabel('Variance')
+
+    plt.tight_layout()
+
+if __name__ == "__main__":
+    report_args = ReportArgs()
+    if len(sys.argv) > 1:
+        report_args.run_path = sys.argv[1]
+    run_path = report_args.run_path or latest_run(report_args.runs_root)
+    run_dir = run_path if os.path.isdir(run_path) else os.path.dirname(run_path)
+
+    plot_report(read_run(run_path), report_args.avg_interval)
+    output = os.path.join(run_dir, report_args.output)
+    plt.savefig(output)
+    print(f"Saved report to {output}")
+    if report_args.show:
+        plt.show()
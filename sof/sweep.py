@@ -0,0 +1,218 @@
+import os
+import sys
+import csv
+import json
+import time
+import random
+import hashlib
+import itertools
+import shutil
+import subprocess
+from dataclasses import dataclass
+
+import numpy as np
+
+from overrides import OPTIONAL_KEY, OVERRIDES_ENV
+from run_logger import RUN_ROOT_ENV, LOG_FILE, read_run
+
+## Parallel hyperparameter sweeps over the Args dataclasses
+
+@dataclass
+class SweepArgs:
+    script: str = os.path.join('sof', 'train_sof.py') # run from the repo root like any trainer
+    target: str = "args_sof" # config.py instance the overrides go to: "args_sof", "args_ppo" or "args_supp"
+    sweep_name: str = "constrain_sweep" # results go to sof/sweeps/<sweep_name>/
+    mode: str = "grid" # "grid" or "random"
+    num_samples: int = 16 # random search only
+    sweep_seed: int = 0 # random search draws are seeded, so a resumed sweep samples the same configs
+    seeds: tuple = (1,) # every config runs once per seed
+    max_workers: int = 4
+    threads_per_run: int = 1 # torch/OpenMP threads per run, also the number of cores it is pinned to
+    pin_cpus: bool = True
+    return_window: int = 20 # episodes averaged for the final and best return
+    resume: bool = True # skip runs that already finished in results.csv
+
+sweep_args = SweepArgs()
+
+# grid: every combination of the listed values
+# random: lists are sampled uniformly, (low, high) uniformly in between, ("log", low, high) log-uniformly
+SEARCH_SPACE = {
+    "upn_coef": [0.4, 0.8],
+    "kl_coef": [0.1, 0.3],
+    "epsilon_k": [0.005, 0.01, 0.05],
+    "constrain_weights": [0.0, 0.4, 0.8],
+}
+
+# applied to every run whose Args has the field, e.g. args_supp records no video
+FIXED_OVERRIDES = {
+    "capture_video": False,
+}
+
+def sample_value(spec, rng):
+    if isinstance(spec, list):
+        return spec[rng.randrange(len(spec))]
+    if len(spec) == 3 and spec[0] == "log":
+        return float(np.exp(rng.uniform(np.log(spec[1]), np.log(spec[2]))))
+    return rng.uniform(spec[0], spec[1])
+
+def expand_space(space, mode, num_samples, sweep_seed):
+    '''List of override dicts for the search space'''
+    if mode == "grid":
+        keys = list(space)
+        return [dict(zip(keys, values)) for values in itertools.product(*(space[key] for key in keys))]
+    if mode == "random":
+        rng = random.Random(sweep_seed)
+        return [{key: sample_value(spec, rng) for key, spec in space.items()} for _ in range(num_samples)]
+    raise ValueError(f"Unknown sweep mode '{mode}', expected 'grid' or 'random'")
+
+def run_id(config, seed):
+    '''Stable id of a (config, seed) pair, the key used to resume'''
+    digest = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:10]
+    return f"{digest}_s{seed}"
+
+def cpu_slots(max_workers, threads_per_run):
+    '''Disjoint core sets, one per concurrent run, None when there are not enough cores to pin'''
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < max_workers * threads_per_run:
+        print(f"Only {len(cpus)} cores for {max_workers} x {threads_per_run} threads, not pinning")
+        return [None] * max_workers
+    return [set(cpus[i * threads_per_run:(i + 1) * threads_per_run]) for i in range(max_workers)]
+
+def launch(run, script, target, cpus, threads, log_path, run_root):
+    env = dict(os.environ)
+    # the run's metrics.jsonl goes under run_root, cleared so a retried run starts a fresh log
+    shutil.rmtree(run_root, ignore_errors=True)
+    env[RUN_ROOT_ENV] = run_root
+    env[OVERRIDES_ENV] = json.dumps({target: {**run["config"], "seed": run["seed"]}, OPTIONAL_KEY: FIXED_OVERRIDES})
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        env[var] = str(threads)
+    preexec = (lambda: os.sched_setaffinity(0, cpus)) if cpus else None
+    log = open(log_path, "w")
+    process = subprocess.Popen([sys.executable, script], env=env, stdout=log, stderr=subprocess.STDOUT,
+                               cwd=os.getcwd(), preexec_fn=preexec)
+    return process, log
+
+def run_metrics(run_root):
+    '''read_run() of the newest run log under run_root, {} when the run logged nothing'''
+    logs = [os.path.join(root, LOG_FILE) for root, _, files in os.walk(run_root) if LOG_FILE in files]
+    return read_run(max(logs, key=os.path.getmtime)) if logs else {}
+
+def summarize(returns, window):
+    '''Final return: mean of the last window episodes. Best return: best window-episode running mean'''
+    if not returns:
+        return float("nan"), float("nan")
+    returns = np.asarray(returns, dtype=np.float64)
+    window = min(window, len(returns))
+    running = np.convolve(returns, np.ones(window) / window, mode='valid')
+    return float(running[-1]), float(running.max())
+
+def summarize_run(metrics, window):
+    '''Result columns of one run: episodic returns of the RL trainers, validation loss of the
+    supervised scripts (the "total" term fit() logs per epoch), nan for whatever the run did not log'''
+    returns = metrics.get("episode", {}).get("episodic_return", [])
+    val_losses = metrics.get("epoch", {}).get("val_total", [])
+    final_return, best_return = summarize(returns, window)
+    return {"num_episodes": len(returns), "final_return": final_return, "best_return": best_return,
+            "num_epochs": len(val_losses),
+            "final_val_loss": float(val_losses[-1]) if val_losses else float("nan"),
+            "best_val_loss": float(np.nanmin(val_losses)) if val_losses else float("nan")}
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+def write_results(path, rows, columns):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, path)
+
+def run_sweep(sweep_args, space):
+    sweep_dir = os.path.join(os.getcwd(), 'sof', 'sweeps', sweep_args.sweep_name)
+    log_dir = os.path.join(sweep_dir, "logs")
+    runs_dir = os.path.join(sweep_dir, "runs")
+    os.makedirs(log_dir, exist_ok=True)
+    results_path = os.path.join(sweep_dir, "results.csv")
+    with open(os.path.join(sweep_dir, "sweep.json"), "w") as f:
+        json.dump({"args": vars(sweep_args), "space": space, "fixed": FIXED_OVERRIDES}, f, indent=2)
+
+    configs = expand_space(space, sweep_args.mode, sweep_args.num_samples, sweep_args.sweep_seed)
+    runs = [{"run_id": run_id(config, seed), "config": config, "seed": seed} for config in configs for seed in sweep_args.seeds]
+    columns = ["run_id", "seed"] + list(space) + ["status", "returncode", "num_episodes", "final_return", "best_return",
+                                           "num_epochs", "final_val_loss", "best_val_loss", "wall_time"]
+
+    rows = load_results(results_path) if sweep_args.resume else []
+    done = {row["run_id"] for row in rows if row["status"] == "ok"}
+    # failed and no_metrics runs are retried
+    rows = [row for row in rows if row["run_id"] in done]
+    pending = [run for run in runs if run["run_id"] not in done]
+    print(f"Sweep {sweep_args.sweep_name}: {len(runs)} runs, {len(runs) - len(pending)} already done, {len(pending)} to go")
+
+    if sweep_args.pin_cpus:
+        free_slots = cpu_slots(sweep_args.max_workers, sweep_args.threads_per_run)
+    else:
+        free_slots = [None] * sweep_args.max_workers
+    running = {}
+    try:
+        while pending or running:
+            while pending and free_slots:
+                run, cpus = pending.pop(0), free_slots.pop()
+                log_path = os.path.join(log_dir, f"{run['run_id']}.log")
+                process, log = launch(run, sweep_args.script, sweep_args.target, cpus, sweep_args.threads_per_run,
+                                      log_path, os.path.join(runs_dir, run["run_id"]))
+                running[process.pid] = (process, log, run, cpus, log_path, time.time())
+                print(f"Started {run['run_id']} {run['config']} seed={run['seed']}")
+
+            time.sleep(1.0)
+            for pid, (process, log, run, cpus, log_path, start_time) in list(running.items()):
+                if process.poll() is None:
+                    continue
+                log.close()
+                del running[pid]
+                free_slots.append(cpus)
+
+                metrics = run_metrics(os.path.join(runs_dir, run["run_id"]))
+                result = summarize_run(metrics, sweep_args.return_window)
+                if process.returncode != 0:
+                    status = "failed"
+                elif not metrics:
+                    # the script never created a RunLogger, there is nothing to rank it by
+                    status = "no_metrics"
+                else:
+                    status = "ok"
+                rows.append({"run_id": run["run_id"], "seed": run["seed"], **run["config"], "status": status,
+                             "returncode": process.returncode, **result,
+                             "wall_time": round(time.time() - start_time, 1)})
+                # rewritten after every run, an interrupted sweep keeps everything that finished
+                write_results(results_path, rows, columns)
+                print(f"Finished {run['run_id']} ({status}): return final {result['final_return']:.2f}, best {result['best_return']:.2f}, "
+                      f"val loss final {result['final_val_loss']:.4f}, best {result['best_val_loss']:.4f}")
+    except KeyboardInterrupt:
+        print("Interrupted, stopping running jobs. Rerun with resume=True to continue.")
+        for process, log, *_ in running.values():
+            process.terminate()
+            process.wait()
+            log.close()
+        raise
+
+    # runs sorted by final return, or by best validation loss when no run logged episodes, averaged over seeds
+    finished = [row for row in rows if row["status"] == "ok"]
+    if any(int(row["num_episodes"] or 0) for row in finished):
+        metric, sign = ("final_return", "best_return"), -1
+    else:
+        metric, sign = ("best_val_loss", "final_val_loss"), 1
+    by_config = {}
+    for row in finished:
+        key = tuple(str(row[name]) for name in space)
+        by_config.setdefault(key, []).append([float(row.get(name) or "nan") for name in metric])
+    print(f"\nResults ({results_path}):")
+    for key, values in sorted(by_config.items(), key=lambda item: sign * np.nanmean([v[0] for v in item[1]])):
+        first, second = np.nanmean(values, axis=0)
+        print(f"  {dict(zip(space, key))}: {metric[0]} {first:.4f}, {metric[1]} {second:.4f} over {len(values)} seeds")
+
+if __name__ == "__main__":
+    run_sweep(sweep_args, SEARCH_SPACE)
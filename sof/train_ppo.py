@@ -3,7 +3,6 @@ import time
 import random
 import gymnasium as gym
 import numpy as np
-import matplotlib.pyplot as plt
 
 import torch
 import torch.nn as nn
@@ -11,6 +10,12 @@ import torch.optim as optim
 
 from config import args_ppo
 from environments import make_env
+from vec_env import make_vector_env
+from inference import compile_act
+from normalization import VectorNormalize, normalizer_path
+from gae import compute_gae
+from metrics import MetricsTracker
+from run_logger import RunLogger, make_run_dir
 from models import *
 from optimization_utils import *
 
@@ -26,9 +31,11 @@ def train_ppo_agent():
 
     args_ppo.device = torch.device("cuda" if torch.cuda.is_available() and args_ppo.cuda else "cpu")
 
-    envs = gym.vector.SyncVectorEnv(
-        [make_env(args_ppo.env_id, i, args_ppo.capture_video, args_ppo.exp_name, args_ppo.gamma) for i in range(args_ppo.num_envs)]
+    envs = make_vector_env(
+        [make_env(args_ppo.env_id, i, args_ppo.capture_video, args_ppo.exp_name, args_ppo.gamma, normalize=False) for i in range(args_ppo.num_envs)],
+        backend=args_ppo.vector_backend,
     )
+    envs = VectorNormalize(envs, gamma=args_ppo.gamma)
     assert isinstance(envs.single_action_space, gym.spaces.Box), "only continuous action space is supported"
 
     agent = Agent_ppo(envs).to(args_ppo.device)
@@ -52,20 +59,17 @@ def train_ppo_agent():
     dones = torch.zeros((args_ppo.num_steps, args_ppo.num_envs)).to(args_ppo.device)
     values = torch.zeros((args_ppo.num_steps, args_ppo.num_envs)).to(args_ppo.device)
 
+    # rollout policy, compiled into one graph with compile_act=True
+    act = compile_act(agent, args_ppo.compile_act)
+
     # Logging setup
     global_step = 0
     start_time = time.time()
-    episodic_returns = []
-    episodic_lengths = []
-    learning_rates = []
-    value_losses = []
-    policy_losses = []
-    entropies = []
-    old_approx_kls = []
-    approx_kls = []
-    clipfracs = []
-    explained_variances = []
-    sps_history = []
+    # per-iteration values stay on device and are synced once in metrics.flush(),
+    # then streamed to the run log, plot it offline with report.py
+    run_dir = make_run_dir(os.path.join(os.getcwd(), 'sof', args_ppo.log_dir), args_ppo.exp_name, args_ppo.seed)
+    logger = RunLogger(run_dir, config=args_ppo)
+    metrics = MetricsTracker(logger)
 
     next_obs, _ = envs.reset(seed=args_ppo.seed)
     next_obs = torch.Tensor(next_obs).to(args_ppo.device)
@@ -78,7 +82,7 @@ def train_ppo_agent():
             lrnow = frac * args_ppo.learning_rate
             optimizer.param_groups[0]["lr"] = lrnow
         
-        learning_rates.append(optimizer.param_groups[0]["lr"])
+        metrics.set("learning_rates", optimizer.param_groups[0]["lr"])
 
         for step in range(0, args_ppo.num_steps):
             global_step += args_ppo.num_envs
@@ -87,8 +91,8 @@ def train_ppo_agent():
 
             # ALGO LOGIC: action logic
             with torch.no_grad():
-                action, logprob, _, value = agent.get_action_and_value(next_obs)
-                values[step] = value.flatten()
+                action, logprob, value = act(next_obs)
+                values[step] = value
             actions[step] = action
             logprobs[step] = logprob
 
@@ -102,24 +106,12 @@ def train_ppo_agent():
                 for info in infos["final_info"]:
                     if info and "episode" in info:
                         print(f"global_step={global_step}, episodic_return={info['episode']['r']}")
-                        episodic_returns.append(info["episode"]["r"])
-                        episodic_lengths.append(info["episode"]["l"])
+                        metrics.log_episode(global_step, info["episode"]["r"], info["episode"]["l"])
 
         # bootstrap value if not done
         with torch.no_grad():
             next_value = agent.get_value(next_obs).reshape(1, -1)
-            advantages = torch.zeros_like(rewards).to(args_ppo.device)
-            lastgaelam = 0
-            for t in reversed(range(args_ppo.num_steps)):
-                if t == args_ppo.num_steps - 1:
-                    nextnonterminal = 1.0 - next_done
-                    nextvalues = next_value
-                else:
-                    nextnonterminal = 1.0 - dones[t + 1]
-                    nextvalues = values[t + 1]
-                delta = rewards[t] + args_ppo.gamma * nextvalues * nextnonterminal - values[t]
-                advantages[t] = lastgaelam = delta + args_ppo.gamma * args_ppo.gae_lambda * nextnonterminal * lastgaelam
-            returns = advantages + values
+            advantages, returns = compute_gae(rewards, values, dones, next_value, next_done, args_ppo.gamma, args_ppo.gae_lambda)
 
         # flatten the batch
         b_obs = obs.reshape((-1,) + envs.single_observation_space.shape)
@@ -131,7 +123,6 @@ def train_ppo_agent():
 
         # Optimizing the policy and value network
         b_inds = np.arange(args_ppo.batch_size)
-        clipfracs_batch = []
         for epoch in range(args_ppo.update_epochs):
             np.random.shuffle(b_inds)
             for start in range(0, args_ppo.batch_size, args_ppo.minibatch_size):
@@ -146,7 +137,7 @@ def train_ppo_agent():
                     # calculate approx_kl http://joschu.net/blog/kl-approx.html
                     old_approx_kl = (-logratio).mean()
                     approx_kl = ((ratio - 1) - logratio).mean()
-                    clipfracs_batch += [((ratio - 1.0).abs() > args_ppo.clip_coef).float().mean().item()]
+                    metrics.add("clipfracs", ((ratio - 1.0).abs() > args_ppo.clip_coef).float().mean())
                 
                 if args_ppo.target_kl is not None and approx_kl > args_ppo.target_kl:
                     print(f"Early stopping at iteration {iteration} due to reaching target KL.")
@@ -188,90 +179,25 @@ def train_ppo_agent():
                 nn.utils.clip_grad_norm_(agent.parameters(), args_ppo.max_grad_norm)
                 optimizer.step()
 
-        y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
-        var_y = np.var(y_true)
-        explained_var = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
+        var_y = b_returns.var(unbiased=False)
+        explained_var = torch.where(var_y == 0, torch.full_like(var_y, float("nan")),
+                                    1 - (b_returns - b_values).var(unbiased=False) / var_y)
 
         # Logging
-        value_losses.append(v_loss.item())
-        policy_losses.append(pg_loss.item())
-        entropies.append(entropy_loss.item())
-        old_approx_kls.append(old_approx_kl.item())
-        approx_kls.append(approx_kl.item())
-        clipfracs.append(np.mean(clipfracs_batch))
-        explained_variances.append(explained_var)
+        metrics.set("value_losses", v_loss)
+        metrics.set("policy_losses", pg_loss)
+        metrics.set("entropies", entropy_loss)
+        metrics.set("old_approx_kls", old_approx_kl)
+        metrics.set("approx_kls", approx_kl)
+        metrics.set("explained_variances", explained_var)
+        metrics.flush(global_step=global_step, iteration=iteration)
 
         sps = int(global_step / (time.time() - start_time))
-        sps_history.append(sps)
-        print(f"SPS: {sps}")
+        print(f"SPS ({args_ppo.vector_backend}, {args_ppo.num_envs} envs): {sps}")
 
     envs.close()
-
-    # Plotting
-    plt.figure(figsize=(20, 10))
-
-    plt.subplot(2, 3, 1)
-    plt.plot(episodic_returns)
-    avg_interval = 50
-    # Ensure that metrics["episodic_returns"] is a 1D list or array
-    episodic_returns = np.array(episodic_returns).flatten()
-
-    # Now apply np.convolve to calculate the rolling average
-    if len(episodic_returns) >= avg_interval:
-        avg_returns = np.convolve(episodic_returns, np.ones(avg_interval) / avg_interval, mode='valid')
-        plt.plot(range(avg_interval - 1, len(episodic_returns)), avg_returns, label=f"{avg_interval}-Episode Average", color="orange")
-
-    plt.title('Episodic Returns')
-    plt.xlabel('Episode')
-    plt.ylabel('Return')
-
-    # plt.subplot(2, 3, 2)
-    # plt.plot(episodic_lengths)
-    # plt.title('Episodic Lengths')
-    # plt.xlabel('Episode')
-    # plt.ylabel('Length')
-
-    plt.subplot(2, 3, 2)
-    plt.plot(approx_kls)
-    plt.title('Approx KLs')
-    plt.xlabel('Episode')
-    plt.ylabel('Approx KLs')
-
-    plt.subplot(2, 3, 3)
-    plt.plot(learning_rates)
-    plt.title('Learning Rate')
-    plt.xlabel('Iteration')
-    plt.ylabel('LR')
-
-    plt.subplot(2, 3, 4)
-    plt.plot(value_losses, label='Value Loss')
-    plt.plot(policy_losses, label='Policy Loss')
-    plt.title('Losses')
-    plt.xlabel('Iteration')
-    plt.ylabel('Loss')
-    plt.legend()
-
-    plt.subplot(2, 3, 5)
-    plt.plot(entropies)
-    plt.title('Entropy')
-    plt.xlabel('Iteration')
-    plt.ylabel('Entropy')
-
-    # plt.subplot(2, 3, 6)
-    # plt.plot(sps_history)
-    # plt.title('Steps Per Second')
-    # plt.xlabel('Iteration')
-    # plt.ylabel('SPS')
-
-    plt.subplot(2, 3, 6)
-    plt.plot(explained_variances)
-    plt.title('Explained Variance')
-    plt.xlabel('Iteration')
-    plt.ylabel('Variance')
-
-    plt.tight_layout()
-    plt.savefig('ppo_results.png')
-    plt.show()
+    logger.close()
+    print(f"Run log written to {logger.path}, plot it with report.py")
 
     save_dir = os.path.join(os.getcwd(),'sof', 'params', 'ppo')
     os.makedirs(save_dir, exist_ok=True)
@@ -284,6 +210,7 @@ def train_ppo_agent():
     data_path = os.path.join(save_dir, args_ppo.save_path)
     print('Saved at: ', data_path)
     torch.save(agent.state_dict(), data_path)
+    envs.save(normalizer_path(data_path))
 
 if __name__ == "__main__":
     train_ppo_agent()
\ No newline at end of file
@@ -3,7 +3,6 @@ import time
 import random
 import gymnasium as gym
 import numpy as np
-import matplotlib.pyplot as plt
 
 import torch
 import torch.nn as nn
@@ -11,6 +10,15 @@ import torch.optim as optim
 
 from config import args_sof
 from environments import make_env
+from vec_env import make_vector_env
+from inference import compile_act
+from fused_update import FusedStep, adam_kwargs
+from precision import autocast, loss_parity
+from normalization import VectorNormalize, normalizer_path
+from gae import compute_gae
+from demonstrations import ImitationData
+from metrics import MetricsTracker
+from run_logger import RunLogger, make_run_dir
 from models import *
 from optimization_utils import *
 
@@ -26,10 +34,13 @@ def train_sofppo_agent():
 
     args_sof.device = torch.device("cuda" if torch.cuda.is_available() and args_sof.cuda else "cpu")
 
-    envs = gym.vector.SyncVectorEnv(
-        [make_env(args_sof.env_id, i, args_sof.capture_video, args_sof.exp_name, args_sof.gamma) for i in range(args_sof.num_envs)]
+    envs = make_vector_env(
+        [make_env(args_sof.env_id, i, args_sof.capture_video, args_sof.exp_name, args_sof.gamma, normalize=False) for i in range(args_sof.num_envs)],
+        backend=args_sof.vector_backend,
     )
+    envs = VectorNormalize(envs, gamma=args_sof.gamma)
     assert isinstance(envs.single_action_space, gym.spaces.Box), "only continuous action space is supported"
+    assert args_sof.precision in ("fp32", "bf16"), "the PPO update supports fp32 and bf16, fp16 would need loss scaling"
 
     agent = Agent_sof(envs).to(args_sof.device)
 
@@ -60,12 +71,25 @@ def train_sofppo_agent():
     ppo_optimizer = optim.Adam([
     {'params': agent.actor_mean.parameters()},
     {'params': agent.actor_logstd},
-    {'params': agent.critic.parameters()}], lr=args_sof.ppo_learning_rate, eps=1e-5)
+    {'params': agent.critic.parameters()}], lr=args_sof.ppo_learning_rate, eps=1e-5, **adam_kwargs(args_sof.device, args_sof.fused_update))
 
     # Optimizer for UPN
-    upn_optimizer = optim.Adam(agent.upn.parameters(), lr=args_sof.upn_learning_rate, eps=1e-5)
+    upn_optimizer = optim.Adam(agent.upn.parameters(), lr=args_sof.upn_learning_rate, eps=1e-5, **adam_kwargs(args_sof.device, args_sof.fused_update))
 
-    eta_optimizer = optim.Adam([agent.eta_k], lr=args_sof.eta_learning_rate, eps=1e-5)
+    # Imitation data is read from disk once and sampled from every iteration
+    imitation_data = None
+    if args_sof.mix_coord:
+        data_path = os.path.join(os.getcwd(), 'sfm', 'data', args_sof.imitation_data_path)
+        imitation_data = ImitationData(data_path, args_sof.device, on_device=args_sof.imitation_on_device)
+
+    eta_optimizer = optim.Adam([agent.eta_k], lr=args_sof.eta_learning_rate, eps=1e-5, **adam_kwargs(args_sof.device, args_sof.fused_update))
+
+    # PPO, UPN and eta_k losses touch disjoint parameters (the PPO side only sees a detached eta_k),
+    # so one backward of their sum feeds all three. eta_k is not clipped, and the dual solve replaces its step
+    fused_optimizers, fused_norms = [ppo_optimizer, upn_optimizer], [args_sof.max_grad_norm, args_sof.max_grad_norm]
+    if not args_sof.optimize_eta_k:
+        fused_optimizers, fused_norms = fused_optimizers + [eta_optimizer], fused_norms + [None]
+    fused_step = FusedStep(fused_optimizers, fused_norms, compile=args_sof.fused_update and args_sof.compile_update)
 
     # ALGO Logic: Storage setup
     obs = torch.zeros((args_sof.num_steps, args_sof.num_envs) + envs.single_observation_space.shape).to(args_sof.device)
@@ -77,27 +101,17 @@ def train_sofppo_agent():
     # this is only for upn
     next_obs_all = torch.zeros((args_sof.num_steps, args_sof.num_envs) + envs.single_observation_space.shape).to(args_sof.device)
 
+    # rollout policy, compiled into one graph with compile_act=True
+    act = compile_act(agent, args_sof.compile_act)
+
     # Logging setup
     global_step = 0
     start_time = time.time()
-    metrics = {
-        "episodic_returns": [],
-        "episodic_lengths": [],
-        "learning_rates": [],
-        "value_losses": [],
-        "policy_losses": [],
-        "entropies": [],
-        "approx_kls": [],
-        "clipfracs": [],
-        "explained_variances": [],
-        "upn_losses": [],
-        "recon_losses":[],
-        "forward_losses":[],
-        "inverse_losses":[],
-        "consist_losses":[],
-        "kl_constrained_penalty":[],
-        "eta_k_loss":[]
-    }
+    # per-iteration values stay on device and are synced once in metrics.flush(),
+    # then streamed to the run log, plot it offline with report.py
+    run_dir = make_run_dir(os.path.join(os.getcwd(), 'sof', args_sof.log_dir), args_sof.exp_name, args_sof.seed)
+    logger = RunLogger(run_dir, config=args_sof)
+    metrics = MetricsTracker(logger)
 
     next_obs, _ = envs.reset(seed=args_sof.seed)
     next_obs = torch.Tensor(next_obs).to(args_sof.device)
@@ -109,7 +123,7 @@ def train_sofppo_agent():
             lrnow = frac * args_sof.ppo_learning_rate
             ppo_optimizer.param_groups[0]["lr"] = lrnow
 
-        metrics["learning_rates"].append(ppo_optimizer.param_groups[0]["lr"])
+        metrics.set("learning_rates", ppo_optimizer.param_groups[0]["lr"])
 
         for step in range(0, args_sof.num_steps):
             global_step += args_sof.num_envs
@@ -117,8 +131,8 @@ def train_sofppo_agent():
             dones[step] = next_done
 
             with torch.no_grad():
-                action, logprob, _, value = agent.get_action_and_value(next_obs)
-                values[step] = value.flatten()
+                action, logprob, value = act(next_obs)
+                values[step] = value
             actions[step] = action
             logprobs[step] = logprob
 
@@ -132,27 +146,15 @@ def train_sofppo_agent():
                 for info in infos["final_info"]:
                     if info and "episode" in info:
                         print(f"global_step={global_step}, episodic_return={info['episode']['r']}")
-                        metrics["episodic_returns"].append(info["episode"]["r"])
-                        metrics["episodic_lengths"].append(info["episode"]["l"])
+                        metrics.log_episode(global_step, info["episode"]["r"], info["episode"]["l"])
 
         with torch.no_grad():
             next_value = agent.get_value(next_obs).reshape(1, -1)
-            advantages = torch.zeros_like(rewards).to(args_sof.device)
-            lastgaelam = 0
-            for t in reversed(range(args_sof.num_steps)):
-                if t == args_sof.num_steps - 1:
-                    nextnonterminal = 1.0 - next_done
-                    nextvalues = next_value
-                else:
-                    nextnonterminal = 1.0 - dones[t + 1]
-                    nextvalues = values[t + 1]
-                delta = rewards[t] + args_sof.gamma * nextvalues * nextnonterminal - values[t]
-                advantages[t] = lastgaelam = delta + args_sof.gamma * args_sof.gae_lambda * nextnonterminal * lastgaelam
-            returns = advantages + values
+            advantages, returns = compute_gae(rewards, values, dones, next_value, next_done, args_sof.gamma, args_sof.gae_lambda)
         
         if args_sof.mix_coord:
             # mixing screw things up, isolate the problem bit by bit
-            obs_imitate, actions_imitate, next_obs_imitate = mixed_batch(obs, actions, next_obs_all)
+            obs_imitate, actions_imitate, next_obs_imitate = imitation_data.mixed_batch(obs, actions, next_obs_all, args_sof.imitation_ratio)
         else:
             obs_imitate, actions_imitate, next_obs_imitate = obs, actions, next_obs_all
 
@@ -169,115 +171,129 @@ def train_sofppo_agent():
         b_actions_imitate = actions_imitate.reshape((-1,) + envs.single_action_space.shape)
         b_next_obs_imitate = next_obs_imitate.reshape((-1,) + envs.single_observation_space.shape) # previous error of passing the same obs help may be due to having 2 obs in action selection
         
+        if args_sof.precision != "fp32" and iteration == 1:
+            # once per run: the UPN losses of the first batch in fp32 and under autocast
+            loss_parity(lambda: compute_upn_loss(agent.upn, b_obs_imitate, b_actions_imitate, b_next_obs_imitate),
+                        args_sof.device, args_sof.precision, names=["recon", "forward", "inverse", "consistency"])
+
+        if args_sof.precision != "fp32" and iteration == 1:
+            # and the PPO ratio and losses of the first minibatch, computed in fp32 from the autocast networks
+            mb_inds = np.arange(args_sof.minibatch_size)
+            def ppo_parity_terms():
+                ratio, _, pg_loss, v_loss, entropy_loss = compute_ppo_loss(
+                    agent, b_obs[mb_inds], b_actions[mb_inds], b_logprobs[mb_inds], b_advantages[mb_inds],
+                    b_returns[mb_inds], b_values[mb_inds], args_sof.clip_coef, norm_adv=args_sof.norm_adv,
+                    clip_vloss=args_sof.clip_vloss)
+                return {"ratio": ratio.mean(), "policy": pg_loss, "value": v_loss, "entropy": entropy_loss}
+            loss_parity(ppo_parity_terms, args_sof.device, args_sof.precision, atol=1e-3)
+
         b_inds = np.arange(args_sof.batch_size)
-        clipfracs_batch = []
         for epoch in range(args_sof.update_epochs):
             np.random.shuffle(b_inds)
             for start in range(0, args_sof.batch_size, args_sof.minibatch_size):
                 end = start + args_sof.minibatch_size
                 mb_inds = b_inds[start:end]
 
-                _, newlogprob, entropy, newvalue = agent.get_action_and_value(b_obs[mb_inds], b_actions[mb_inds])
-                logratio = newlogprob - b_logprobs[mb_inds]
-                ratio = logratio.exp()
-
-                with torch.no_grad():
-                    # calculate approx_kl http://joschu.net/blog/kl-approx.html
-                    old_approx_kl = (-logratio).mean()
-                    approx_kl = ((ratio - 1) - logratio).mean()
-                    clipfracs_batch += [((ratio - 1.0).abs() > args_sof.clip_coef).float().mean().item()]
+                # forward passes and losses in autocast, backward and optimizer steps in fp32
+                with autocast(args_sof.device, args_sof.precision):
+                    # Encode the minibatch once for every consumer. PPO gets a detached latent: its gradients
+                    # into the UPN were always discarded by upn_optimizer.zero_grad() before the UPN step
+                    if args_sof.mix_coord:
+                        with torch.no_grad():
+                            _, _, z = agent.encode(b_obs[mb_inds])
+                        encoded_imitate = agent.encode(b_obs_imitate[mb_inds])
+                    else:
+                        encoded_imitate = agent.encode(b_obs[mb_inds])
+                        z = encoded_imitate[2].detach()
+
+                    ratio, logratio, pg_loss, v_loss, entropy_loss = compute_ppo_loss(
+                        agent, b_obs[mb_inds], b_actions[mb_inds], b_logprobs[mb_inds], b_advantages[mb_inds],
+                        b_returns[mb_inds], b_values[mb_inds], args_sof.clip_coef, norm_adv=args_sof.norm_adv,
+                        clip_vloss=args_sof.clip_vloss, z=z)
+
+                    with torch.no_grad():
+                        # calculate approx_kl http://joschu.net/blog/kl-approx.html
+                        old_approx_kl = (-logratio).mean()
+                        approx_kl = ((ratio - 1) - logratio).mean()
+                        metrics.add("clipfracs", ((ratio - 1.0).abs() > args_sof.clip_coef).float().mean())
                 
-                # if args_sof.target_kl is not None and approx_kl > args_sof.target_kl:
-                #     print(f"Early stopping at iteration {iteration} due to reaching target KL.")
-                #     break
-
-                mb_advantages = b_advantages[mb_inds]
-                if args_sof.norm_adv:
-                    mb_advantages = (mb_advantages - mb_advantages.mean()) / (mb_advantages.std() + 1e-8)
-
-                pg_loss1 = -mb_advantages * ratio
-                pg_loss2 = -mb_advantages * torch.clamp(ratio, 1 - args_sof.clip_coef, 1 + args_sof.clip_coef)
-                pg_loss = torch.max(pg_loss1, pg_loss2).mean()
-
-                newvalue = newvalue.view(-1)
-                if args_sof.clip_vloss:
-                    v_loss_unclipped = (newvalue - b_returns[mb_inds]) ** 2
-                    v_clipped = b_values[mb_inds] + torch.clamp(
-                        newvalue - b_values[mb_inds],
-                        -args_sof.clip_coef,
-                        args_sof.clip_coef,
-                    )
-                    v_loss_clipped = (v_clipped - b_returns[mb_inds]) ** 2
-                    v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
-                    v_loss = 0.5 * v_loss_max.mean()
-                else:
-                    v_loss = 0.5 * ((newvalue - b_returns[mb_inds]) ** 2).mean()
-
-                # Entropy loss
-                entropy_loss = entropy.mean()
-
-                eta_loss = compute_eta_k_loss(agent, b_advantages, args_sof.epsilon_k)
-
-                # Lagrangian Objective (Adjusted with KL Hidden Distribution Constraint)
-                hidden_dist = compute_hidden_action_distribution(agent,
-                                                                b_obs_imitate[mb_inds],
-                                                                b_advantages[mb_inds],
-                                                                args_sof.epsilon_k,
-                                                                agent.eta_k
-                                                                )
-                kl_constraint_penalty = compute_lagrangian_kl_constraint(agent,
-                                                                         b_obs_imitate[mb_inds],
-                                                                         agent.eta_k,
-                                                                         args_sof.epsilon_k,
-                                                                         hidden_dist
-                                                                         )
-                recon_loss, forward_loss, inverse_loss, consistency_loss = compute_upn_loss(agent.upn,
-                                                                                            b_obs_imitate[mb_inds],
-                                                                                            b_actions_imitate[mb_inds],
-                                                                                            b_next_obs_imitate[mb_inds]
-                                                                                            )
-                ppo_loss = (pg_loss -
-                            args_sof.ent_coef * entropy_loss +
-                            v_loss * args_sof.vf_coef +
-                            approx_kl * args_sof.kl_coef +
-                            kl_constraint_penalty * args_sof.constrain_weights
-                            )
-                # Previously not on in sfmppo
-                upn_loss = args_sof.upn_coef * (recon_loss +
-                                            forward_loss +
-                                            inverse_loss +
-                                            consistency_loss
-                                            )
+                    # if args_sof.target_kl is not None and approx_kl > args_sof.target_kl:
+                    #     print(f"Early stopping at iteration {iteration} due to reaching target KL.")
+                    #     break
+
+                    eta_loss = compute_eta_k_loss(agent, b_advantages, args_sof.epsilon_k)
+
+                    # Lagrangian Objective (Adjusted with KL Hidden Distribution Constraint)
+                    hidden_dist = compute_hidden_action_distribution(agent,
+                                                                    b_obs_imitate[mb_inds],
+                                                                    b_advantages[mb_inds],
+                                                                    args_sof.epsilon_k,
+                                                                    agent.eta_k,
+                                                                    z=encoded_imitate[2].detach()
+                                                                    )
+                    # eta_k gradients of the PPO loss were always discarded by eta_optimizer.zero_grad()
+                    kl_constraint_penalty = compute_lagrangian_kl_constraint(agent,
+                                                                             b_obs_imitate[mb_inds],
+                                                                             agent.eta_k.detach(),
+                                                                             args_sof.epsilon_k,
+                                                                             hidden_dist,
+                                                                             z=encoded_imitate[2].detach()
+                                                                             )
+                    recon_loss, forward_loss, inverse_loss, consistency_loss = compute_upn_loss(agent.upn,
+                                                                                                b_obs_imitate[mb_inds],
+                                                                                                b_actions_imitate[mb_inds],
+                                                                                                b_next_obs_imitate[mb_inds],
+                                                                                                encoded=encoded_imitate
+                                                                                                )
+                    ppo_loss = (pg_loss -
+                                args_sof.ent_coef * entropy_loss +
+                                v_loss * args_sof.vf_coef +
+                                approx_kl * args_sof.kl_coef +
+                                kl_constraint_penalty * args_sof.constrain_weights
+                                )
+                    # Previously not on in sfmppo
+                    upn_loss = args_sof.upn_coef * (recon_loss +
+                                                forward_loss +
+                                                inverse_loss +
+                                                consistency_loss
+                                                )
                 
-                # PPO backward pass and optimization
-                ppo_optimizer.zero_grad()
-                ppo_loss.backward()
-                nn.utils.clip_grad_norm_(
-                    list(agent.actor_mean.parameters()) + 
-                    [agent.actor_logstd] + 
-                    list(agent.critic.parameters()), 
-                    args_sof.max_grad_norm
-                )
-                ppo_optimizer.step()
-
-                # UPN backward pass and optimization
-                upn_optimizer.zero_grad()
-                upn_loss.backward()
-                nn.utils.clip_grad_norm_(agent.upn.parameters(), args_sof.max_grad_norm)
-                upn_optimizer.step()
-
-                # Only backpropagate the KL penalty through eta_k
-                eta_optimizer.zero_grad()
-                eta_loss.backward()
-                eta_optimizer.step()
+                if args_sof.fused_update:
+                    fused_step(ppo_loss + upn_loss if args_sof.optimize_eta_k else ppo_loss + upn_loss + eta_loss)
+                else:
+                    # PPO backward pass and optimization
+                    ppo_optimizer.zero_grad()
+                    ppo_loss.backward()
+                    nn.utils.clip_grad_norm_(
+                        list(agent.actor_mean.parameters()) + 
+                        [agent.actor_logstd] + 
+                        list(agent.critic.parameters()), 
+                        args_sof.max_grad_norm
+                    )
+                    ppo_optimizer.step()
+
+                    # UPN backward pass and optimization
+                    upn_optimizer.zero_grad()
+                    upn_loss.backward()
+                    nn.utils.clip_grad_norm_(agent.upn.parameters(), args_sof.max_grad_norm)
+                    upn_optimizer.step()
+
+                    if not args_sof.optimize_eta_k:
+                        # Only backpropagate the KL penalty through eta_k
+                        eta_optimizer.zero_grad()
+                        eta_loss.backward()
+                        eta_optimizer.step()
+
+                if args_sof.optimize_eta_k:
+                    # Exact dual solve replaces the gradient step on eta_k
+                    with torch.no_grad():
+                        agent.eta_k.fill_(optimize_eta_k(b_advantages[mb_inds], args_sof.epsilon_k))
                 
                 # Clip eta_k to be positive
                 with torch.no_grad():
                     agent.eta_k.clamp_(min=1e-5)
 
-                for name, param in agent.named_parameters():
-                    if param.grad is not None and (torch.isnan(param.grad).any() or torch.isinf(param.grad).any()):
-                        print(f"NaN or Inf detected in gradients of {name}")
+                metrics.check_grads(agent.named_parameters())
                 
                 # grad_norms = []
                 # for name, param in agent.named_parameters():
@@ -289,101 +305,30 @@ def train_sofppo_agent():
                 # # optimizer.step()
 
         # Logging
-        y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
-        var_y = np.var(y_true)
-        explained_var = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
-
-        metrics["value_losses"].append(v_loss.item())
-        metrics["policy_losses"].append(pg_loss.item())
-        metrics['upn_losses'].append(upn_loss.item())
-        metrics['forward_losses'].append(forward_loss.item())
-        metrics['inverse_losses'].append(inverse_loss.item())
-        metrics["recon_losses"].append(recon_loss.item())
-        metrics["consist_losses"].append(consistency_loss.item())
-        metrics["entropies"].append(entropy_loss.item())
-        metrics["approx_kls"].append(approx_kl.item())
-        metrics["kl_constrained_penalty"].append(kl_constraint_penalty.item())
-        metrics["eta_k_loss"].append(eta_loss.item())
-        metrics["clipfracs"].append(np.mean(clipfracs_batch))
-        metrics["explained_variances"].append(explained_var)
+        var_y = b_returns.var(unbiased=False)
+        explained_var = torch.where(var_y == 0, torch.full_like(var_y, float("nan")),
+                                    1 - (b_returns - b_values).var(unbiased=False) / var_y)
+
+        metrics.set("value_losses", v_loss)
+        metrics.set("policy_losses", pg_loss)
+        metrics.set("upn_losses", upn_loss)
+        metrics.set("forward_losses", forward_loss)
+        metrics.set("inverse_losses", inverse_loss)
+        metrics.set("recon_losses", recon_loss)
+        metrics.set("consist_losses", consistency_loss)
+        metrics.set("entropies", entropy_loss)
+        metrics.set("approx_kls", approx_kl)
+        metrics.set("kl_constrained_penalty", kl_constraint_penalty)
+        metrics.set("eta_k_loss", eta_loss)
+        metrics.set("explained_variances", explained_var)
+        metrics.flush(global_step=global_step, iteration=iteration)
 
         sps = int(global_step / (time.time() - start_time))
-        print(f"SPS: {sps}")
+        print(f"SPS ({args_sof.vector_backend}, {args_sof.num_envs} envs): {sps}")
 
     envs.close()
-
-    # Plotting results
-    plt.figure(figsize=(20, 10))
-
-    plt.subplot(2, 3, 1)
-    plt.plot(metrics["episodic_returns"])
-
-    avg_interval = args_sof.graph_avg_interval
-    # Ensure that metrics["episodic_returns"] is a 1D list or array
-    episodic_returns = np.array(metrics["episodic_returns"]).flatten()
-
-    # Now apply np.convolve to calculate the rolling average
-    if len(episodic_returns) >= avg_interval:
-        avg_returns = np.convolve(episodic_returns, np.ones(avg_interval) / avg_interval, mode='valid')
-        plt.plot(range(avg_interval - 1, len(episodic_returns)), avg_returns, label=f"{avg_interval}-Episode Average", color="orange")
-
-    plt.title('Episodic Returns')
-    plt.xlabel('Episode')
-    plt.ylabel('Return')
-
-    # plt.subplot(2, 3, 2)
-    # plt.plot(metrics["episodic_lengths"])
-    # plt.title('Episodic Lengths')
-    # plt.xlabel('Episode')
-    # plt.ylabel('Length')
-
-    plt.subplot(2, 3, 2)
-    plt.plot(metrics["approx_kls"])
-    plt.title('Approx KLs')
-    plt.xlabel('Episode')
-    plt.ylabel('Approx KLs')
-
-    # plt.subplot(2, 3, 3)
-    # plt.plot(metrics["learning_rates"])
-    # plt.title('Learning Rate')
-    # plt.xlabel('Iteration')
-    # plt.ylabel('LR')
-
-    plt.subplot(2, 3, 3)
-    plt.plot(metrics["kl_constrained_penalty"])
-    plt.title('KL Constraint Penalty')
-    plt.xlabel('Iteration')
-    plt.ylabel('KL-CP')
-
-    plt.subplot(2, 3, 4)
-    plt.plot(metrics["value_losses"], label='Value Loss')
-    plt.plot(metrics["policy_losses"], label='Policy Loss')
-    plt.plot(metrics["upn_losses"], label='UPN Loss')
-    plt.plot(metrics["forward_losses"], label='Forward Loss')
-    plt.plot(metrics["inverse_losses"], label='Inverse Loss')
-    plt.plot(metrics["recon_losses"], label='Reconstruction Loss')
-    plt.plot(metrics["consist_losses"], label='Consistency Loss')
-    plt.plot(metrics["eta_k_loss"], label='Eta K Loss')
-    plt.title('Losses')
-    plt.xlabel('Iteration')
-    plt.ylabel('Loss')
-    plt.legend()
-
-    plt.subplot(2, 3, 5)
-    plt.plot(metrics["entropies"])
-    plt.title('Entropy')
-    plt.xlabel('Iteration')
-    plt.ylabel('Entropy')
-
-    plt.subplot(2, 3, 6)
-    plt.plot(metrics["explained_variances"])
-    plt.title('Explained Variance')
-    plt.xlabel('Iteration')
-    plt.ylabel('Variance')
-
-    plt.tight_layout()
-    plt.savefig('sofppo_vae_constrained.png')
-    plt.show()
+    logger.close()
+    print(f"Run log written to {logger.path}, plot it with report.py")
 
     # Save the model
     save_dir1 = os.path.join(os.getcwd(), 'sof', 'params', 'sofppo')
@@ -395,6 +340,7 @@ def train_sofppo_agent():
 
     print('Saved at: ', data1_path)
     torch.save(agent.state_dict(), data1_path)
+    envs.save(normalizer_path(data1_path))
 
     print('Saved at: ', data2_path)
     torch.save(agent.upn.state_dict(), data2_path)
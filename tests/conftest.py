@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the sfm scripts use flat imports, run from the repo root like the trainers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sfm"))
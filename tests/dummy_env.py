@@ -0,0 +1,37 @@
+import numpy as np
+import gymnasium as gym
+
+## Small HalfCheetah-shaped env for the wrapper tests, no MuJoCo needed
+
+class DummyCheetahEnv(gym.Env):
+    '''Random observations from the env's seeded generator, episodes of episode_length steps.
+    The last action the env received is kept in last_action.'''
+    def __init__(self, obs_dim=20, action_dim=6, episode_length=7):
+        self.observation_space = gym.spaces.Box(-np.inf, np.inf, (obs_dim,), np.float32)
+        self.action_space = gym.spaces.Box(-1.0, 1.0, (action_dim,), np.float32)
+        self.episode_length = episode_length
+        self.last_action = None
+        self.t = 0
+
+    def _obs(self):
+        return self.np_random.normal(size=self.observation_space.shape).astype(np.float32)
+
+    def reset(self, seed=None, options=None):
+        super().reset(seed=seed)
+        self.t = 0
+        return self._obs(), {}
+
+    def step(self, action):
+        self.t += 1
+        self.last_action = np.array(action, copy=True)
+        reward = float(self.np_random.normal())
+        return self._obs(), reward, self.t >= self.episode_length, False, {}
+
+def dummy_vector_env(episode_lengths, wrap=None, **kwargs):
+    '''SyncVectorEnv of DummyCheetahEnvs, each one wrapped with wrap(env) when given'''
+    def thunk(length):
+        def make():
+            env = DummyCheetahEnv(episode_length=length, **kwargs)
+            return wrap(env) if wrap is not None else env
+        return make
+    return gym.vector.SyncVectorEnv([thunk(length) for length in episode_lengths])
@@ -0,0 +1,190 @@
+import random
+from collections import deque
+
+import pytest
+
+np = pytest.importorskip("numpy")
+gym = pytest.importorskip("gymnasium")
+pytest.importorskip("torch")
+pytest.importorskip("matplotlib")
+
+import env_wrappers
+from dummy_env import DummyCheetahEnv, dummy_vector_env
+
+EPISODE_LENGTHS = [5, 7, 9, 11]
+
+def seed_global(seed=0):
+    # the single env wrappers draw from the global generators
+    random.seed(seed)
+    np.random.seed(seed)
+
+def random_actions(num_steps, num_envs, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-1, 1, (num_steps, num_envs, 6)).astype(np.float32)
+
+@pytest.mark.parametrize("name", ["TargetVelocity", "JumpReward", "NoisyObservation", "PartialObservability",
+                                  "ActionMasking", "NonLinearDynamics"])
+def test_vector_wrappers_wrap_gymnasium_vector_envs(name):
+    wrapper_class = getattr(env_wrappers, f"{name}VectorWrapper")
+    assert issubclass(wrapper_class, gym.vector.VectorEnvWrapper)
+    envs = wrapper_class(dummy_vector_env(EPISODE_LENGTHS), seed=0)
+    obs, _ = envs.reset(seed=0)
+    assert obs.shape == (len(EPISODE_LENGTHS), 20)
+    obs, rewards, terminations, truncations, _ = envs.step(random_actions(1, len(EPISODE_LENGTHS))[0])
+    assert obs.shape == (len(EPISODE_LENGTHS), 20) and rewards.shape == (len(EPISODE_LENGTHS),)
+
+@pytest.mark.parametrize("name, kwargs", [
+    ("TargetVelocity", {"target_velocity": 0.5, "tolerance": 2.0}),
+    ("JumpReward", {"jump_target_height": 2.0}),
+])
+def test_reward_wrappers_match_single_env(name, kwargs):
+    # rewards are a function of the observation, so they match step for step, across autoresets too
+    single = dummy_vector_env(EPISODE_LENGTHS, wrap=lambda env: getattr(env_wrappers, f"{name}Wrapper")(env, **kwargs))
+    vector = getattr(env_wrappers, f"{name}VectorWrapper")(dummy_vector_env(EPISODE_LENGTHS), **kwargs)
+    single_obs, _ = single.reset(seed=0)
+    vector_obs, _ = vector.reset(seed=0)
+    np.testing.assert_array_equal(single_obs, vector_obs)
+    finished = 0
+    for actions in random_actions(40, len(EPISODE_LENGTHS)):
+        single_obs, single_rewards, single_terms, _, _ = single.step(actions)
+        vector_obs, vector_rewards, vector_terms, _, _ = vector.step(actions)
+        np.testing.assert_array_equal(single_obs, vector_obs)
+        np.testing.assert_array_equal(single_terms, vector_terms)
+        np.testing.assert_allclose(single_rewards, vector_rewards, rtol=1e-5)
+        finished += single_terms.sum()
+    assert finished > len(EPISODE_LENGTHS)
+
+def test_noisy_observation_statistics_match_single_env():
+    seed_global()
+    single = env_wrappers.NoisyObservationWrapper(DummyCheetahEnv(), noise_scale=0.1)
+    single_noise = np.stack([single.observation(np.zeros(20, dtype=np.float32)) for _ in range(2000)])
+    vector = env_wrappers.NoisyObservationVectorWrapper(dummy_vector_env(EPISODE_LENGTHS), noise_scale=0.1, seed=0)
+    vector_noise = np.concatenate([vector.observation(np.zeros((len(EPISODE_LENGTHS), 20), dtype=np.float32)) for _ in range(500)])
+    for noise in (single_noise, vector_noise):
+        assert abs(noise.mean()) < 0.005
+        assert noise.std() == pytest.approx(0.1, rel=0.02)
+
+def test_partial_observability_statistics_match_single_env():
+    seed_global()
+    single = env_wrappers.PartialObservabilityWrapper(DummyCheetahEnv(), observable_ratio=0.3)
+    single_kept = np.mean([single.observation(np.ones(20, dtype=np.float32)).mean() for _ in range(2000)])
+    vector = env_wrappers.PartialObservabilityVectorWrapper(dummy_vector_env(EPISODE_LENGTHS), observable_ratio=0.3, seed=0)
+    vector_kept = np.mean([vector.observation(np.ones((len(EPISODE_LENGTHS), 20), dtype=np.float32)).mean() for _ in range(500)])
+    assert single_kept == pytest.approx(0.3, abs=0.01)
+    assert vector_kept == pytest.approx(0.3, abs=0.01)
+
+def received_actions(envs):
+    '''The action every dummy sub-env received last, below any wrappers'''
+    vector = envs
+    while not isinstance(vector, gym.vector.SyncVectorEnv):
+        vector = vector.env
+    return np.stack([env.unwrapped.last_action for env in vector.envs])
+
+def test_action_masking_statistics_match_single_env():
+    seed_global()
+    single = dummy_vector_env(EPISODE_LENGTHS, wrap=lambda env: env_wrappers.ActionMaskingWrapper(env, mask_prob=0.2))
+    vector = env_wrappers.ActionMaskingVectorWrapper(dummy_vector_env(EPISODE_LENGTHS), mask_prob=0.2, seed=0)
+    for envs in (single, vector):
+        envs.reset(seed=0)
+        masked = []
+        for actions in random_actions(2000, len(EPISODE_LENGTHS)):
+            envs.step(actions)
+            received = received_actions(envs)
+            zero = (received == 0).all(axis=1)
+            # every sub-env gets either its whole action or nothing
+            np.testing.assert_array_equal(received[~zero], actions[~zero])
+            masked.append(zero)
+        assert np.mean(masked) == pytest.approx(0.2, abs=0.02)
+
+def test_nonlinear_dynamics_statistics_match_single_env():
+    seed_global()
+    threshold = 10
+    single = dummy_vector_env(EPISODE_LENGTHS, wrap=lambda env: env_wrappers.NonLinearDynamicsWrapper(env, threshold))
+    vector = env_wrappers.NonLinearDynamicsVectorWrapper(dummy_vector_env(EPISODE_LENGTHS), threshold, seed=0)
+    for envs in (single, vector):
+        envs.reset(seed=0)
+        scales = []
+        for step, actions in enumerate(random_actions(1000, len(EPISODE_LENGTHS))):
+            envs.step(actions)
+            # one factor per sub-env and step, shared by all action dims
+            scale = received_actions(envs) / actions
+            np.testing.assert_allclose(scale, scale[:, :1].repeat(6, axis=1), rtol=1e-5)
+            if step < threshold:
+                np.testing.assert_allclose(scale, 1.0, rtol=1e-6)
+            else:
+                scales.append(scale[:, 0])
+        scales = np.concatenate(scales)
+        magnitude = np.maximum(scales, 1 / scales)
+        assert ((magnitude >= 1.2 - 1e-5) & (magnitude <= 2.0 + 1e-5)).all()
+        assert np.mean(scales > 1) == pytest.approx(0.5, abs=0.03)
+        assert magnitude.mean() == pytest.approx(1.6, abs=0.02)
+
+class DequeDelayedEnv(gym.Wrapper):
+    '''The deque implementation DelayedHalfCheetahEnv replaced, kept as the reference'''
+    def __init__(self, env, proprio_delay=2, force_delay=5):
+        super().__init__(env)
+        self.proprio_delay = proprio_delay
+        self.force_delay = force_delay
+        self.proprio_buffer = deque(maxlen=proprio_delay + 1)
+        self.force_buffer = deque(maxlen=force_delay + 1)
+        self.proprio_indices = list(range(0, 17))
+        self.force_indices = list(range(17, self.env.observation_space.shape[0]))
+
+    def _get_delayed_obs(self, observation):
+        delayed_obs = observation.copy()
+        if len(self.proprio_buffer) == self.proprio_delay + 1:
+            delayed_obs[self.proprio_indices] = self.proprio_buffer[0][self.proprio_indices]
+        if len(self.force_buffer) == self.force_delay + 1:
+            delayed_obs[self.force_indices] = self.force_buffer[0][self.force_indices]
+        return delayed_obs
+
+    def reset(self, **kwargs):
+        observation, info = self.env.reset(**kwargs)
+        self.proprio_buffer.clear()
+        self.force_buffer.clear()
+        for _ in range(max(self.proprio_delay, self.force_delay) + 1):
+            self.proprio_buffer.append(observation)
+            self.force_buffer.append(observation)
+        return self._get_delayed_obs(observation), info
+
+    def step(self, action):
+        observation, reward, terminated, truncated, info = self.env.step(action)
+        self.proprio_buffer.append(observation)
+        self.force_buffer.append(observation)
+        return self._get_delayed_obs(observation), reward, terminated, truncated, info
+
+@pytest.mark.parametrize("delays", [{}, {"proprio_delay": 1, "force_delay": 3}, {"proprio_delay": 4, "force_delay": 10}])
+def test_delayed_env_matches_deque_implementation(delays):
+    ring = env_wrappers.DelayedHalfCheetahEnv(DummyCheetahEnv(episode_length=1000), **delays)
+    reference = DequeDelayedEnv(DummyCheetahEnv(episode_length=1000), **delays)
+    for episode in range(3):
+        ring_obs, _ = ring.reset(seed=episode)
+        reference_obs, _ = reference.reset(seed=episode)
+        np.testing.assert_array_equal(ring_obs, reference_obs)
+        for action in random_actions(50, 1, seed=episode)[:, 0]:
+            ring_obs = ring.step(action)[0]
+            reference_obs = reference.step(action)[0]
+            np.testing.assert_array_equal(ring_obs, reference_obs)
+
+def test_delayed_env_is_a_gymnasium_env():
+    env = gym.wrappers.FlattenObservation(env_wrappers.DelayedHalfCheetahEnv(DummyCheetahEnv()))
+    obs, _ = env.reset(seed=0)
+    assert obs.shape == (20,)
+
+def test_delayed_vector_env_refills_history_on_autoreset():
+    # the per sub-env wrapper restarts its history in the autoreset, the vector version has to
+    # refill the finished sub-envs' rows of its shared buffer the same way
+    single = dummy_vector_env(EPISODE_LENGTHS, wrap=env_wrappers.DelayedHalfCheetahEnv)
+    vector = env_wrappers.DelayedObservationVectorEnv(dummy_vector_env(EPISODE_LENGTHS))
+    assert isinstance(vector, gym.vector.VectorEnvWrapper)
+    single_obs, _ = single.reset(seed=0)
+    vector_obs, _ = vector.reset(seed=0)
+    np.testing.assert_array_equal(single_obs, vector_obs)
+    finished = 0
+    for actions in random_actions(60, len(EPISODE_LENGTHS)):
+        single_obs, _, single_terms, _, _ = single.step(actions)
+        vector_obs, _, vector_terms, _, _ = vector.step(actions)
+        np.testing.assert_array_equal(single_terms, vector_terms)
+        np.testing.assert_array_equal(single_obs, vector_obs)
+        finished += single_terms.sum()
+    assert finished > len(EPISODE_LENGTHS)
@@ -0,0 +1,52 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from gae import compute_gae, compute_gae_loop
+
+GAMMA, GAE_LAMBDA = 0.99, 0.95
+
+def random_rollout(num_steps, num_envs, done_prob=0.05, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    rewards = torch.randn(num_steps, num_envs, generator=generator)
+    values = torch.randn(num_steps, num_envs, generator=generator)
+    dones = (torch.rand(num_steps, num_envs, generator=generator) < done_prob).float()
+    next_value = torch.randn(1, num_envs, generator=generator)
+    next_done = (torch.rand(num_envs, generator=generator) < 0.5).float()
+    return rewards, values, dones, next_value, next_done
+
+def assert_matches_loop(rollout):
+    adv_loop, ret_loop = compute_gae_loop(*rollout, GAMMA, GAE_LAMBDA)
+    adv_scan, ret_scan = compute_gae(*rollout, GAMMA, GAE_LAMBDA)
+    torch.testing.assert_close(adv_scan, adv_loop, atol=1e-5, rtol=1e-5)
+    torch.testing.assert_close(ret_scan, ret_loop, atol=1e-5, rtol=1e-5)
+
+@pytest.mark.parametrize("num_steps, num_envs", [(1, 1), (7, 3), (2048, 1), (2048, 16)])
+def test_gae_matches_loop(num_steps, num_envs):
+    assert_matches_loop(random_rollout(num_steps, num_envs))
+
+@pytest.mark.parametrize("done_prob", [0.0, 0.3, 1.0])
+def test_gae_matches_loop_with_mid_rollout_dones(done_prob):
+    assert_matches_loop(random_rollout(64, 4, done_prob=done_prob, seed=1))
+
+def test_gae_done_cuts_the_bootstrap():
+    # dones[t + 1] marks obs[t + 1] as the start of a new episode: step t neither bootstraps
+    # from values[t + 1] nor carries the advantage of the next episode back
+    rewards, values, dones, next_value, next_done = random_rollout(10, 2, done_prob=0.0, seed=2)
+    dones[5, 0] = 1.0
+    advantages, _ = compute_gae(rewards, values, dones, next_value, next_done, GAMMA, GAE_LAMBDA)
+    torch.testing.assert_close(advantages[4, 0], rewards[4, 0] - values[4, 0])
+    # the other env is untouched by env 0's episode boundary
+    reference, _ = compute_gae(rewards, values, torch.zeros_like(dones), next_value, next_done, GAMMA, GAE_LAMBDA)
+    torch.testing.assert_close(advantages[:, 1], reference[:, 1])
+    torch.testing.assert_close(advantages[5:, 0], reference[5:, 0])
+
+def test_gae_next_done_masks_the_last_step():
+    rewards, values, dones, next_value, _ = random_rollout(10, 3, done_prob=0.0, seed=3)
+    next_done = torch.tensor([1.0, 0.0, 1.0])
+    advantages, returns = compute_gae(rewards, values, dones, next_value, next_done, GAMMA, GAE_LAMBDA)
+    masked = next_done.bool()
+    torch.testing.assert_close(advantages[-1, masked], rewards[-1, masked] - values[-1, masked])
+    torch.testing.assert_close(advantages[-1, ~masked],
+                               rewards[-1, ~masked] + GAMMA * next_value[0, ~masked] - values[-1, ~masked])
+    torch.testing.assert_close(returns, advantages + values)
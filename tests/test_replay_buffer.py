@@ -0,0 +1,67 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+
+from replay_buffer import NStepAccumulator
+
+GAMMA = 0.9
+
+def random_steps(num_steps, num_envs, end_prob=0.2, seed=0):
+    rng = np.random.default_rng(seed)
+    obs = rng.normal(size=(num_steps + 1, num_envs, 3))
+    steps = []
+    for t in range(num_steps):
+        ends = rng.random(num_envs) < end_prob
+        terminations = ends & (rng.random(num_envs) < 0.5)
+        truncations = ends & ~terminations
+        steps.append((obs[t], obs[t + 1], rng.normal(size=(num_envs, 2)), rng.normal(size=num_envs),
+                      terminations.astype(np.float32), truncations))
+    return steps
+
+def reference_transition(steps, t, env, n_step):
+    '''n-step target of step t in one env, summed until the first termination or truncation'''
+    ret, discount = 0.0, 1.0
+    for k in range(t, min(t + n_step, len(steps))):
+        _, next_obs, _, rewards, terminations, truncations = steps[k]
+        ret += discount * rewards[env]
+        discount *= GAMMA
+        if terminations[env] or truncations[env]:
+            break
+    return ret, next_obs[env], float(terminations[env]), bool(truncations[env]), discount
+
+@pytest.mark.parametrize("n_step, num_envs", [(3, 1), (5, 1), (3, 4)])
+def test_every_step_is_emitted_once_with_its_n_step_target(n_step, num_envs):
+    steps = random_steps(60, num_envs, seed=n_step + num_envs)
+    accumulator = NStepAccumulator(n_step, GAMMA, num_envs)
+    emitted = []
+    for step in steps:
+        emitted += accumulator.push(*step)
+    emitted += accumulator.flush()
+    assert len(accumulator) == 0 and len(emitted) == len(steps)
+    for t, (obs, next_obs, actions, returns, dones, truncated, discounts) in enumerate(emitted):
+        np.testing.assert_array_equal(obs, steps[t][0])
+        np.testing.assert_array_equal(actions, steps[t][2])
+        for env in range(num_envs):
+            ret, ref_next_obs, done, trunc, discount = reference_transition(steps, t, env, n_step)
+            assert returns[env] == pytest.approx(ret)
+            np.testing.assert_array_equal(next_obs[env], ref_next_obs)
+            assert dones[env] == done and truncated[env] == trunc
+            assert discounts[env] == pytest.approx(discount)
+
+@pytest.mark.parametrize("end", ["termination", "truncation"])
+def test_episode_end_flushes_the_pending_window(end):
+    accumulator = NStepAccumulator(5, GAMMA, 1)
+    steps = random_steps(3, 1, end_prob=0.0)
+    for step in steps[:2]:
+        assert accumulator.push(*step) == []
+    obs, next_obs, actions, rewards, _, _ = steps[2]
+    terminations = np.array([end == "termination"], dtype=np.float32)
+    truncations = np.array([end == "truncation"])
+    emitted = accumulator.push(obs, next_obs, actions, rewards, terminations, truncations)
+    # all three steps of the finished episode come out at once, with 3, 2 and 1 step horizons
+    assert len(emitted) == 3 and len(accumulator) == 0
+    for t, transition in enumerate(emitted):
+        np.testing.assert_array_equal(transition[1], next_obs)
+        assert transition[4][0] == terminations[0] and transition[5][0] == truncations[0]
+        assert transition[6][0] == pytest.approx(GAMMA ** (3 - t))